@@ -3,12 +3,44 @@ import time
 import base64
 import requests
 import mimetypes
+import uuid
 from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+import logs
+import metrics
+import tracing
+from deadline import Cancelled, Deadline
+
+if TYPE_CHECKING:
+    from hailuo_callback import CallbackReceiver
+
+logger = logs.get_logger("hailuo")
 
 
 class HailuoVideoGenerator:
-    def __init__(self, api_key: str, base_url: str = "https://api.minimaxi.com/v1", output_dir: str = "output"):
+    # 查询任务状态的默认轮询间隔（秒）
+    POLL_INTERVAL = 10
+    # 启用回调时的兜底轮询间隔（秒）: 回调丢失时最多晚这么久发现状态变化
+    CALLBACK_POLL_INTERVAL = 60
+    # 回调中的状态 -> 查询接口返回的状态
+    CALLBACK_STATUS = {"queueing": "Queueing", "preparing": "Preparing", "processing": "Processing",
+                       "success": "Success", "failed": "Fail", "fail": "Fail"}
+    # 提交/查询请求和视频下载的超时上限（秒），另受调用方 Deadline 的剩余时间限制
+    REQUEST_TIMEOUT = 60
+    DOWNLOAD_TIMEOUT = 300
+
+    def __init__(self, api_key: str, base_url: str = "https://api.minimaxi.com/v1", output_dir: str = "output",
+                 callbacks: Optional["CallbackReceiver"] = None):
+        """
+        Args:
+            api_key: MiniMax API key
+            base_url: 接口地址
+            output_dir: 默认输出目录
+            callbacks: 回调接收端，提供后提交任务时带上 callback_url，等待任务时以回调为主、轮询兜底
+        """
         self.api_key = api_key
+        self.callbacks = callbacks
         self.base_url = base_url
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
         self.cur_dir = Path(__file__).parent
@@ -18,6 +50,8 @@ class HailuoVideoGenerator:
 
         # 创建目录
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        # task_id -> 提交时间, 用于统计排队时间
+        self._submitted = {}
 
     @staticmethod
     def image_to_data_url(image_path: str) -> str:
@@ -30,7 +64,8 @@ class HailuoVideoGenerator:
         return f"data:{mime_type};base64,{base64_str}"
 
     def invoke_text_to_video(self, prompt: str, model: str = "MiniMax-Hailuo-02",
-                             duration: int = 6, resolution: str = "768P") -> str:
+                             duration: int = 6, resolution: str = "768P",
+                             deadline: Optional[Deadline] = None) -> str:
         """通过文本发起视频生成任务，返回 task_id"""
         url = f"{self.base_url}/video_generation"
         payload = {
@@ -39,13 +74,12 @@ class HailuoVideoGenerator:
             "duration": duration,
             "resolution": resolution,
         }
-        response = requests.post(url, headers=self.headers, json=payload)
-        response.raise_for_status()
-        return response.json()["task_id"]
+        return self._submit(url, payload, deadline)
 
     def invoke_image_to_video(self, prompt: str, image_path: str,
                               model: str = "MiniMax-Hailuo-02",
-                              duration: int = 6, resolution: str = "768P") -> str:
+                              duration: int = 6, resolution: str = "768P",
+                              deadline: Optional[Deadline] = None) -> str:
         """通过本地首帧图像+文本描述发起视频生成任务，返回 task_id"""
         url = f"{self.base_url}/video_generation"
         img_base64 = self.image_to_data_url(image_path)
@@ -56,43 +90,128 @@ class HailuoVideoGenerator:
             "duration": duration,
             "resolution": resolution,
         }
-        response = requests.post(url, headers=self.headers, json=payload)
-        response.raise_for_status()
-        return response.json()["task_id"]
-
-    def query_task_status(self, task_id: str, poll_interval: int = 10) -> str:
-        """轮询任务状态直到成功或失败，返回 file_id"""
+        return self._submit(url, payload, deadline)
+
+    def _submit(self, url: str, payload: dict, deadline: Optional[Deadline] = None) -> str:
+        """提交视频生成任务，返回 task_id"""
+        deadline = deadline or Deadline()
+        if self.callbacks is not None:
+            payload["callback_url"] = self.callbacks.url
+        with metrics.track("hailuo", "submit", duration=payload.get("duration")) as span, deadline.guard():
+            response = requests.post(url, headers=self.headers, json=payload,
+                                     timeout=deadline.timeout_for(self.REQUEST_TIMEOUT))
+            response.raise_for_status()
+            span["task_id"] = task_id = response.json()["task_id"]
+        self._submitted[task_id] = time.time()
+        return task_id
+
+    def query_task_status(self, task_id: str, poll_interval: Optional[float] = None,
+                          deadline: Optional[Deadline] = None) -> str:
+        """等待任务成功或失败，返回 file_id（poll_interval 默认取 POLL_INTERVAL）
+
+        启用回调时主要等回调，只有 CALLBACK_POLL_INTERVAL 内没有收到回调才查询一次。
+        排队时间按提交到第一次得知 Processing 计算，生成时间从 Processing 算到 Success（轮询时精度为轮询间隔）。
+        到达 deadline 或被取消时立即停止等待并抛出 DeadlineExceeded / Cancelled
+        （MiniMax 没有取消任务的接口，服务商那边的任务仍会继续执行）。
+        """
         url = f"{self.base_url}/query/video_generation"
         params = {"task_id": task_id}
-        while True:
-            time.sleep(poll_interval)
-            response = requests.get(url, headers=self.headers, params=params)
+        poll_interval = self.POLL_INTERVAL if poll_interval is None else poll_interval
+        deadline = deadline or Deadline()
+        submitted = self._submitted.pop(task_id, time.time())
+        processing_since = None
+        last_status = None
+        metrics.INFLIGHT.inc(provider="hailuo", op="render")
+        try:
+            while True:
+                data = self._next_status(task_id, url, params, poll_interval, deadline)
+                status = data["status"]
+                # 状态变化时立即输出, 状态不变时限速输出
+                if status != last_status:
+                    logs.progress(logger, task_id, "任务 %s 状态: %s", task_id, status, force=True,
+                                  final=status in ("Success", "Fail"), provider="hailuo", task_id=task_id)
+                    last_status = status
+                else:
+                    logs.progress(logger, task_id, "任务 %s 仍在 %s, 已等待 %.0fs", task_id, status,
+                                  time.time() - submitted, provider="hailuo", task_id=task_id)
+                if status == "Processing" and processing_since is None:
+                    processing_since = time.time()
+                    metrics.QUEUE_SECONDS.observe(processing_since - submitted, provider="hailuo")
+                if status == "Success":
+                    finished = time.time()
+                    metrics.RENDER_SECONDS.observe(finished - (processing_since or submitted), provider="hailuo")
+                    if processing_since is not None:
+                        tracing.complete("hailuo.queue", submitted, processing_since, cat="provider",
+                                         track="Hailuo tasks", task_id=task_id)
+                    tracing.complete("hailuo.render", processing_since or submitted, finished, cat="provider",
+                                     track="Hailuo tasks", task_id=task_id)
+                    return data["file_id"]
+                elif status == "Fail":
+                    metrics.ERRORS.inc(provider="hailuo", op="render")
+                    raise RuntimeError(f"视频生成失败: {data.get('error_message', '未知错误')}")
+        except Cancelled as e:
+            metrics.INTERRUPTED.inc(provider="hailuo", op="render", reason=e.reason)
+            logger.warning("⏰ 放弃等待任务 %s (%s, 已等待 %.0fs): %s", task_id, last_status or "未知状态",
+                           time.time() - submitted, e, extra={"provider": "hailuo", "task_id": task_id})
+            raise
+        finally:
+            metrics.INFLIGHT.dec(provider="hailuo", op="render")
+            if self.callbacks is not None:
+                self.callbacks.discard(task_id)
+
+    def _next_status(self, task_id: str, url: str, params: dict, poll_interval: float, deadline: Deadline) -> dict:
+        """等到下一次状态: 有回调时直接用回调的内容，否则（或回调里缺少 file_id 时）查询一次"""
+        if self.callbacks is not None:
+            # 分段等待, 被取消时最多 1 秒内就能醒来
+            fallback_at = time.monotonic() + self.CALLBACK_POLL_INTERVAL
+            update = None
+            while update is None and time.monotonic() < fallback_at:
+                update = self.callbacks.wait(task_id, timeout=deadline.timeout_for(
+                    min(1.0, fallback_at - time.monotonic())))
+            if update is not None:
+                raw = str(update.get("status", ""))
+                status = self.CALLBACK_STATUS.get(raw.lower(), raw)
+                if status != "Success" or update.get("file_id"):
+                    data = {**update, "status": status}
+                    error = (update.get("base_resp") or {}).get("status_msg")
+                    if error and "error_message" not in data:
+                        data["error_message"] = error
+                    return data
+        else:
+            deadline.sleep(poll_interval)
+        with metrics.track("hailuo", "poll", task_id=task_id), deadline.guard():
+            response = requests.get(url, headers=self.headers, params=params,
+                                    timeout=deadline.timeout_for(self.REQUEST_TIMEOUT))
             response.raise_for_status()
-            data = response.json()
-            status = data["status"]
-            print(f"任务 {task_id} 当前状态: {status}")
-            if status == "Success":
-                return data["file_id"]
-            elif status == "Fail":
-                raise RuntimeError(f"视频生成失败: {data.get('error_message', '未知错误')}")
-
-    def fetch_video(self, file_id: str, save_path: str) -> Path:
+        return response.json()
+
+    def fetch_video(self, file_id: str, save_path: str, deadline: Optional[Deadline] = None) -> Path:
         """根据 file_id 获取下载链接并保存视频，返回文件路径"""
+        deadline = deadline or Deadline()
         url = f"{self.base_url}/files/retrieve"
         params = {"file_id": file_id}
-        response = requests.get(url, headers=self.headers, params=params)
-        response.raise_for_status()
+        with metrics.track("hailuo", "retrieve"), deadline.guard():
+            response = requests.get(url, headers=self.headers, params=params,
+                                    timeout=deadline.timeout_for(self.REQUEST_TIMEOUT))
+            response.raise_for_status()
         download_url = response.json()["file"]["download_url"]
 
-        video_response = requests.get(download_url)
-        video_response.raise_for_status()
+        started = time.perf_counter()
+        with metrics.track("hailuo", "download", file_id=file_id) as span, deadline.guard():
+            video_response = requests.get(download_url, timeout=deadline.timeout_for(self.DOWNLOAD_TIMEOUT))
+            video_response.raise_for_status()
+            span["bytes"] = len(video_response.content)
+        metrics.record_download("hailuo", time.perf_counter() - started, len(video_response.content))
 
         save_path = Path(save_path)
         save_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(save_path, "wb") as f:
+        # 先写临时文件再原子替换, 并发下载不会互相覆盖出半个文件
+        tmp_path = save_path.with_name(f".{save_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
             f.write(video_response.content)
+        os.replace(tmp_path, save_path)
 
-        print(f"✅ 视频已保存至 {save_path}")
+        logger.info("✅ 视频已保存至 %s", save_path, extra={"provider": "hailuo"})
         return save_path
 
 
@@ -1,11 +1,23 @@
 import base64
+import os
+import time
+import uuid
 import requests
 from pathlib import Path
-from volcenginesdkarkruntime import Ark
+from typing import Optional
+
+import metrics
+from deadline import Deadline
 
 
 class SeedreamImageGenerator:
+    # 生成请求和图片下载的超时上限（秒），另受调用方 Deadline 的剩余时间限制
+    GENERATE_TIMEOUT = 300
+    DOWNLOAD_TIMEOUT = 120
+
     def __init__(self, api_key: str, base_url: str = "https://ark.cn-beijing.volces.com/api/v3", output_dir: str = "output"):
+        # 方舟 SDK 导入较慢, 仅在真正创建客户端时导入
+        from volcenginesdkarkruntime import Ark
         self.client = Ark(base_url=base_url, api_key=api_key)
         self.cur_dir = Path(__file__).parent
         self.output_dir = Path(output_dir)
@@ -17,24 +29,42 @@ class SeedreamImageGenerator:
 
 
     def generate_image(self, prompt: str, model: str = "doubao-seedream-4-0-250828",
-                       size: str = "2K", watermark: bool = False) -> str:
+                       size: str = "2K", watermark: bool = False,
+                       deadline: Optional[Deadline] = None) -> str:
         """根据文本 prompt 生成图片，返回图片 URL"""
-        resp = self.client.images.generate(
-            model=model,
-            prompt=prompt,
-            size=size,
-            response_format="url",
-            watermark=watermark
-        )
+        deadline = deadline or Deadline()
+        with metrics.track("ark", "generate"), deadline.guard():
+            resp = self.client.images.generate(
+                model=model,
+                prompt=prompt,
+                size=size,
+                response_format="url",
+                watermark=watermark,
+                timeout=deadline.timeout_for(self.GENERATE_TIMEOUT)
+            )
         return resp.data[0].url
 
-    def save_image_from_url(self, url: str, filename: str):
-        """下载并保存图片"""
-        resp = requests.get(url)
-        resp.raise_for_status()
-        filepath = self.cur_dir / filename
-        with open(filepath, "wb") as f:
+    def save_image_from_url(self, url: str, filename: str, deadline: Optional[Deadline] = None):
+        """下载并保存图片
+
+        filename 为绝对路径时直接写入该路径，否则写到 output_dir 下。
+        先写同目录下的临时文件再原子替换，并发保存同一路径时不会留下半张图。
+        """
+        deadline = deadline or Deadline()
+        started = time.perf_counter()
+        with metrics.track("ark", "download") as span, deadline.guard():
+            resp = requests.get(url, timeout=deadline.timeout_for(self.DOWNLOAD_TIMEOUT))
+            resp.raise_for_status()
+            span["bytes"] = len(resp.content)
+        metrics.record_download("ark", time.perf_counter() - started, len(resp.content))
+        filepath = Path(filename)
+        if not filepath.is_absolute():
+            filepath = self.output_dir / filepath
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = filepath.with_name(f".{filepath.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
             f.write(resp.content)
+        os.replace(tmp_path, filepath)
         return filepath
 
     @staticmethod
@@ -45,17 +75,21 @@ class SeedreamImageGenerator:
 
     def edit_image(self, base_image_path: Path, prompt: str,
                 model: str = "doubao-seedream-4-0-250828",
-                size: str = "2560x1440", watermark: bool = False) -> str:
+                size: str = "2560x1440", watermark: bool = False,
+                deadline: Optional[Deadline] = None) -> str:
         """基于已有图片 + prompt 生成新图，返回图片 URL"""
+        deadline = deadline or Deadline()
         img_data_uri = self.image_to_base64(base_image_path)
-        resp = self.client.images.generate(
-            model=model,
-            prompt=prompt,
-            image=img_data_uri,
-            size=size,
-            response_format="url",
-            watermark=watermark
-        )
+        with metrics.track("ark", "edit"), deadline.guard():
+            resp = self.client.images.generate(
+                model=model,
+                prompt=prompt,
+                image=img_data_uri,
+                size=size,
+                response_format="url",
+                watermark=watermark,
+                timeout=deadline.timeout_for(self.GENERATE_TIMEOUT)
+            )
         return resp.data[0].url
 
 # 示例 main.py 集成用法
@@ -0,0 +1,245 @@
+"""
+生成素材的垃圾回收
+
+输出目录里每次重新生成都会留下旧版本，加上 ComfyUI 的下载和任务历史，
+磁盘很快就会被占满。只回收项目输出目录下的文件。回收规则：
+  - 当前版本、内存中分镜正在引用的文件、以及 min_age 内刚写入/用过的文件永远不删
+  - 每个分镜每类素材只保留最近 keep_versions 个版本，更早的版本直接删除
+  - 残留超过一天的临时文件直接删除
+  - 总占用超过 budget_bytes 时，其余文件（较新的历史版本、旧版时间戳文件、ComfyUI 下载和任务历史）
+    按最近使用时间从旧到新淘汰，直到回到预算以内
+回收可以在后台线程中小批量执行，每批只删除少量文件，不阻塞生成。
+"""
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import logs
+from artifact_store import ArtifactStore
+
+logger = logs.get_logger("gc")
+
+_SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(value) -> int:
+    """把 "500M"、"20G"、"1.5T" 或字节数转换为字节数"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无法识别的大小: {value!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size: int) -> str:
+    """把字节数格式化为便于阅读的大小"""
+    size = float(size)
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+class ArtifactGC:
+    """按版本数和磁盘预算回收素材存储及遗留输出"""
+    # 超过该时间（秒）的临时文件视为中断的下载
+    TMP_MAX_AGE = 24 * 3600
+    # 后台回收时每批之间的间隔（秒）
+    BATCH_PAUSE = 0.5
+
+    def __init__(self,
+                 store: ArtifactStore,
+                 budget_bytes: Optional[int] = None,
+                 keep_versions: int = 3,
+                 min_age: float = 600,
+                 legacy: Iterable[Tuple[str, str]] = (),
+                 pinned: Optional[Callable[[], Iterable[Optional[str]]]] = None):
+        """
+        Args:
+            store: 素材存储
+            budget_bytes: 磁盘预算（字节），为 None 时只按版本数和临时文件回收
+            keep_versions: 每个分镜每类素材保留的最近版本数（含当前版本）
+            min_age: 修改/访问时间在该秒数以内的文件不回收
+            legacy: 其他可回收文件 [(目录, glob 模式)]，目录应在项目输出目录之内
+            pinned: 返回当前仍被引用的文件路径（例如内存中分镜的 video_path），这些文件不回收
+        """
+        self.store = store
+        self.budget_bytes = budget_bytes
+        self.keep_versions = max(1, keep_versions)
+        self.min_age = min_age
+        self.legacy = [(Path(directory), pattern) for directory, pattern in legacy]
+        self.pinned = pinned
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_result: Optional[Dict[str, Any]] = None
+
+    def _classify_versions(self) -> Tuple[Set[str], Set[str], Set[str], Dict[str, Set[str]]]:
+        """读取所有版本记录
+
+        Returns:
+            (当前版本, 保留范围内的历史版本, 超出保留范围的版本, blob -> 引用它的 owner)，路径均为绝对路径
+        """
+        current, recent, old = set(), set(), set()
+        owners: Dict[str, Set[str]] = {}
+        for owner in self.store.owners():
+            for versions in self.store.load_record(owner).values():
+                for n, version in enumerate(reversed(versions)):
+                    path = str(self.store.root / version["path"])
+                    owners.setdefault(path, set()).add(owner)
+                    if n == 0:
+                        current.add(path)
+                    elif n < self.keep_versions:
+                        recent.add(path)
+                    else:
+                        old.add(path)
+        return current, recent, old, owners
+
+    def _scan(self) -> List[Tuple[str, int, float, str]]:
+        """列出所有受管理的文件: (路径, 大小, 最近使用时间, 类别)"""
+        sources = [
+            (self.store.root / ArtifactStore.BLOB_DIR, "**/*", "blob"),
+            (self.store.tmp_dir, "*", "tmp"),
+            (self.store.history_dir, "*", "legacy"),
+        ] + [(directory, pattern, "legacy") for directory, pattern in self.legacy]
+        files, seen = [], set()
+        for directory, pattern, category in sources:
+            if not directory.exists():
+                continue
+            for path in directory.glob(pattern):
+                key = str(path.resolve())
+                if key in seen or path.is_symlink() or not path.is_file():
+                    continue
+                seen.add(key)
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((key, stat.st_size, max(stat.st_atime, stat.st_mtime), category))
+        return files
+
+    def plan(self) -> Dict[str, Any]:
+        """计算本次需要删除的文件（不执行删除）
+
+        Returns:
+            {"total": 当前总占用, "expired": [...], "evict": [...]}，
+            列表项为 {"path", "size", "reason", "owners"}
+        """
+        now = time.time()
+        current, recent, old, owners = self._classify_versions()
+        protected = set(current)
+        if self.pinned:
+            protected |= {str(Path(p).resolve()) for p in self.pinned() if p}
+
+        files = self._scan()
+        total = sum(size for _, size, _, _ in files)
+        expired, evictable = [], []
+        for path, size, last_used, category in files:
+            if path in protected or now - last_used < self.min_age:
+                continue
+            entry = {"path": path, "size": size, "owners": sorted(owners.get(path, ())), "last_used": last_used}
+            if category == "tmp":
+                if now - last_used > self.TMP_MAX_AGE:
+                    expired.append({**entry, "reason": "stale_tmp"})
+            elif category == "blob" and path in old and path not in recent:
+                expired.append({**entry, "reason": "old_version"})
+            else:
+                evictable.append({**entry, "reason": "lru"})
+
+        evict = []
+        if self.budget_bytes is not None:
+            remaining = total - sum(e["size"] for e in expired)
+            for entry in sorted(evictable, key=lambda e: e["last_used"]):
+                if remaining <= self.budget_bytes:
+                    break
+                evict.append(entry)
+                remaining -= entry["size"]
+        return {"total": total, "expired": expired, "evict": evict}
+
+    def _delete(self, entry: Dict[str, Any]) -> bool:
+        """删除一个文件，并从版本记录中移除指向它的历史版本"""
+        path = entry["path"]
+        try:
+            # 规划之后文件可能又被用到（例如生成了相同内容的 blob）
+            stat = os.stat(path)
+            if time.time() - max(stat.st_atime, stat.st_mtime) < self.min_age:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        relative = os.path.relpath(path, self.store.root)
+        for owner in entry["owners"]:
+            self.store.forget(owner, {relative})
+        return True
+
+    def collect(self, max_deletes: Optional[int] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """执行一批回收
+
+        Args:
+            max_deletes: 本批最多删除的文件数，None 表示全部
+            dry_run: 只返回计划，不删除
+
+        Returns:
+            {"total", "deleted", "freed", "remaining": 计划中还没删除的文件数, "budget"}
+        """
+        with self._lock:
+            plan = self.plan()
+            queue = plan["expired"] + plan["evict"]
+            batch = queue if max_deletes is None else queue[:max_deletes]
+            deleted, freed = 0, 0
+            if not dry_run:
+                for entry in batch:
+                    if self._delete(entry):
+                        deleted += 1
+                        freed += entry["size"]
+            result = {
+                "total": plan["total"],
+                "deleted": deleted,
+                "freed": freed,
+                "remaining": len(queue) - (len(batch) if not dry_run else 0),
+                "budget": self.budget_bytes,
+            }
+            if dry_run:
+                result["plan"] = [{k: e[k] for k in ("path", "size", "reason")} for e in queue]
+            self.last_result = result
+            return result
+
+    def request_collect(self) -> None:
+        """通知后台线程尽快回收一次（例如新素材落盘后）"""
+        self._wakeup.set()
+
+    def _run(self, interval: float, batch_size: int) -> None:
+        while not self._stopped.is_set():
+            try:
+                result = self.collect(max_deletes=batch_size)
+                if result["deleted"]:
+                    logger.info("🧹 已回收 %d 个文件, 释放 %s", result["deleted"], format_size(result["freed"]))
+                backlog = result["remaining"] > 0 and result["deleted"] > 0
+            except Exception as e:
+                logger.error("❌ 素材回收失败: %s", e)
+                backlog = False
+            # 还有待删除的文件时短暂停顿后继续下一批, 否则等待下一个周期或通知
+            self._wakeup.wait(timeout=self.BATCH_PAUSE if backlog else interval)
+            self._wakeup.clear()
+
+    def start(self, interval: float = 300.0, batch_size: int = 50) -> None:
+        """启动后台回收线程，每 interval 秒或收到通知时回收，每批最多删除 batch_size 个文件"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval, batch_size), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """停止后台回收线程"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,192 @@
+"""
+内容寻址的生成素材存储
+
+所有客户端（Seedream/海螺/ComfyUI）生成的文件都先写到 tmp/ 下的唯一临时文件，
+完成后按内容 SHA-256 移入分片目录 blobs/ab/cd/<哈希>.<扩展名>：
+  - 不同线程同时生成同一个分镜也不会互相覆盖（临时文件名唯一，入库用 os.replace 原子完成）
+  - 内容相同的输出只保存一份
+每个分镜（owner）的各类素材版本记录在 records/<owner>.json，最新版本即当前版本，
+并在 current/<owner>_<kind>.<扩展名> 放一个指向当前版本的符号链接方便人工查看。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import logs
+
+logger = logs.get_logger("store")
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """按内容哈希保存生成素材，并记录每个分镜的版本"""
+    BLOB_DIR = "blobs"
+    TMP_DIR = "tmp"
+    RECORD_DIR = "records"
+    CURRENT_DIR = "current"
+    HISTORY_DIR = "history"
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: 存储根目录（通常就是项目的输出目录），目录在第一次写入时才创建
+        """
+        self.root = Path(root).resolve()
+        self._lock = threading.Lock()
+        # 新版本落盘后的回调 fn(owner, kind, path)，例如生成界面代理
+        self._listeners: List[Callable[[str, str, str], None]] = []
+
+    @property
+    def tmp_dir(self) -> Path:
+        return self.root / self.TMP_DIR
+
+    @property
+    def history_dir(self) -> Path:
+        """ComfyUI 任务历史等调试文件的目录"""
+        return self.root / self.HISTORY_DIR
+
+    def temp_path(self, suffix: str) -> str:
+        """返回一个唯一的临时文件路径，供客户端下载/写入，写完后交给 put 入库"""
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        return str(self.tmp_dir / f"{uuid.uuid4().hex}{suffix}")
+
+    def blob_path(self, digest: str, suffix: str) -> Path:
+        return self.root / self.BLOB_DIR / digest[:2] / digest[2:4] / f"{digest}{suffix}"
+
+    def ingest(self, path: str) -> Dict[str, Any]:
+        """把文件移入内容寻址存储，返回 {"path", "sha256", "size"}
+
+        内容已存在时删除传入的文件并复用已有 blob（刷新其修改时间，垃圾回收不会删除刚用过的 blob）。
+        """
+        digest = file_hash(path)
+        size = os.path.getsize(path)
+        target = self.blob_path(digest, Path(path).suffix.lower())
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.utime(target)
+            os.remove(path)
+        except FileNotFoundError:
+            os.replace(path, target)
+        return {"path": str(target), "sha256": digest, "size": size}
+
+    def _record_path(self, owner: str) -> Path:
+        return self.root / self.RECORD_DIR / f"{owner}.json"
+
+    def load_record(self, owner: str) -> Dict[str, List[Dict[str, Any]]]:
+        """读取某个 owner 的版本记录 {kind: [版本, ...]}（按时间先后）"""
+        path = self._record_path(owner)
+        if not path.exists():
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("artifacts", {})
+
+    def _save_record(self, owner: str, artifacts: Dict[str, List[Dict[str, Any]]]) -> None:
+        path = self._record_path(owner)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"owner": owner, "artifacts": artifacts}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    def _link_current(self, owner: str, kind: str, blob: str) -> None:
+        """把 current/<owner>_<kind> 符号链接指向当前版本（不支持符号链接的系统上忽略）"""
+        current_dir = self.root / self.CURRENT_DIR
+        link = current_dir / f"{owner}_{kind}{Path(blob).suffix}"
+        tmp = current_dir / f".{uuid.uuid4().hex}.tmp"
+        try:
+            current_dir.mkdir(parents=True, exist_ok=True)
+            os.symlink(os.path.relpath(blob, current_dir), tmp)
+            os.replace(tmp, link)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+    def record(self, owner: str, kind: str, blob: Dict[str, Any], meta: Optional[Dict[str, Any]] = None) -> str:
+        """把已入库的 blob 记为 owner 的 kind 类素材的最新版本，返回 blob 路径"""
+        entry = {
+            "path": os.path.relpath(blob["path"], self.root),
+            "sha256": blob["sha256"],
+            "size": blob["size"],
+            "created": round(time.time(), 3),
+            **(meta or {}),
+        }
+        with self._lock:
+            artifacts = self.load_record(owner)
+            artifacts.setdefault(kind, []).append(entry)
+            self._save_record(owner, artifacts)
+            self._link_current(owner, kind, blob["path"])
+        for listener in list(self._listeners):
+            try:
+                listener(owner, kind, blob["path"])
+            except Exception as e:
+                logger.warning("⚠️ 素材落盘回调失败: %s", e)
+        return blob["path"]
+
+    def add_listener(self, listener: Callable[[str, str, str], None]) -> None:
+        """注册新版本落盘后的回调 fn(owner, kind, path)"""
+        self._listeners.append(listener)
+
+    def put(self, owner: str, kind: str, path: str, meta: Optional[Dict[str, Any]] = None) -> str:
+        """把生成好的临时文件入库并记为当前版本，返回 blob 路径"""
+        return self.record(owner, kind, self.ingest(path), meta)
+
+    def reference(self, owner: str, kind: str, blob_path: str, meta: Optional[Dict[str, Any]] = None) -> str:
+        """让 owner 直接引用一个已在库中的 blob（不复制文件），例如重复分镜复用代表分镜的视频"""
+        digest = Path(blob_path).stem
+        blob = {"path": str(blob_path), "sha256": digest, "size": os.path.getsize(blob_path)}
+        return self.record(owner, kind, blob, meta)
+
+    def owners(self) -> List[str]:
+        """所有有版本记录的 owner"""
+        record_dir = self.root / self.RECORD_DIR
+        if not record_dir.exists():
+            return []
+        return sorted(path.stem for path in record_dir.glob("*.json"))
+
+    def forget(self, owner: str, paths: Set[str]) -> int:
+        """从 owner 的版本记录中删除指向给定 blob（相对 root 的路径）的历史版本，当前版本始终保留
+
+        Returns:
+            删除的版本数
+        """
+        with self._lock:
+            artifacts = self.load_record(owner)
+            removed = 0
+            for kind, versions in artifacts.items():
+                kept = [v for v in versions[:-1] if v["path"] not in paths] + versions[-1:]
+                removed += len(versions) - len(kept)
+                artifacts[kind] = kept
+            if removed:
+                self._save_record(owner, artifacts)
+        return removed
+
+    def current(self, owner: str, kind: str) -> Optional[str]:
+        """返回 owner 当前的 kind 类素材路径，没有或文件已不存在时返回 None"""
+        versions = self.load_record(owner).get(kind)
+        if not versions:
+            return None
+        path = self.root / versions[-1]["path"]
+        return str(path) if path.exists() else None
+
+    def contains(self, path: Optional[str]) -> bool:
+        """路径是否是本存储中的 blob"""
+        if not path:
+            return False
+        try:
+            Path(path).resolve().relative_to(self.root / self.BLOB_DIR)
+            return True
+        except ValueError:
+            return False
@@ -0,0 +1,242 @@
+"""
+MV 成片合成
+
+按歌曲时间轴（startTime）顺序把每个分镜的最佳素材（对口型结果优先，否则原视频）裁剪到歌曲时间轴上的长度，
+拼接后混入整首歌的音轨。
+
+裁剪尽量不重编码：切点正好落在关键帧上时直接流复制；否则只重编码切点所在的最后一个 GOP，
+前面的 GOP 仍然流复制。分辨率/帧率与成片不一致的素材才会整段重编码。
+每个分镜的裁剪任务在进程池中并行执行。
+"""
+import datetime
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import logs
+from media import VIDEO_CODEC_ARGS, concat_copy, normalize_filter, probe_keyframes, probe_video, run_ffmpeg
+from shot import parse_timecode, timeline_order
+
+logger = logs.get_logger("assembler")
+
+
+def _optional_time(value) -> Optional[float]:
+    if value in (None, ""):
+        return None
+    return parse_timecode(value)
+
+
+def build_timeline(shots: List[Any], tolerance: float = 0.05) -> List[Dict[str, Any]]:
+    """计算每个分镜在歌曲时间轴上的起点和时长
+
+    分镜按 startTime 排列（见 timeline_order，id 不代表时间顺序）；有 startTime 的分镜以它为起点，
+    没有的紧接上一个分镜；每个分镜一直持续到下一个分镜开始，保证画面与音轨对齐。
+
+    Raises:
+        ValueError: 分镜之间重叠超过 tolerance 秒，或某个分镜的时长不为正（渲染出来必然与音轨错位）
+    """
+    ordered = timeline_order(shots)
+    timeline, problems = [], []
+    cursor = 0.0
+    for n, shot in enumerate(ordered):
+        start = _optional_time(shot.start_time)
+        if start is None:
+            start = cursor
+        elif start < cursor - tolerance:
+            problems.append(f"shot {shot.id} 在 {start:.2f}s 开始, 与上一个分镜重叠 {cursor - start:.2f}s")
+        end = _optional_time(shot.end_time)
+        if end is not None and end <= start:
+            problems.append(f"shot {shot.id} 的 endTime 不晚于 startTime")
+        next_start = _optional_time(ordered[n + 1].start_time) if n + 1 < len(ordered) else None
+        if next_start is not None and end is not None and end > next_start + tolerance:
+            problems.append(f"shot {shot.id} 结束于 {end:.2f}s, 与 shot {ordered[n + 1].id} 重叠 {end - next_start:.2f}s")
+        if next_start is not None and next_start > start:
+            end = next_start
+        elif end is None or end <= start:
+            end = start + float(shot.duration)
+        if end <= start:
+            problems.append(f"shot {shot.id} 的时长不为正")
+        timeline.append({"shot": shot, "start": start, "duration": end - start})
+        cursor = end
+    if problems:
+        raise ValueError("时间轴无法合成: " + "; ".join(problems))
+    return timeline
+
+
+def best_artifact(shot: Any) -> Optional[str]:
+    """分镜当前可用于成片的素材：对口型结果优先，其次原视频"""
+    for path in (shot.lip_sync_path, shot.video_path):
+        if path and os.path.exists(path):
+            return str(path)
+    return None
+
+
+def _encode_range(source: str, start: float, length: float, available: float,
+                  target: Dict[str, Any], output: str) -> str:
+    """重编码 source 从 start 开始的 length 秒，素材不够长时定格最后一帧补足"""
+    pad = max(0.0, length - max(0.0, available - start))
+    vf = normalize_filter(target)
+    if pad > 0:
+        vf += f",tpad=stop_mode=clone:stop_duration={pad:.3f}"
+    run_ffmpeg(["-ss", f"{start:.3f}", "-i", source, "-t", f"{length:.3f}", "-an",
+                "-vf", vf, *VIDEO_CODEC_ARGS, "-f", "mpegts", output])
+    return output
+
+
+def _copy_range(source: str, end: float, output: str) -> str:
+    """流复制 source 的 [0, end) 区间，end 必须是关键帧"""
+    run_ffmpeg(["-i", source, "-t", f"{end:.3f}", "-an", "-c:v", "copy",
+                "-bsf:v", "h264_mp4toannexb", "-f", "mpegts", output])
+    return output
+
+
+def render_placeholder(duration: float, target: Dict[str, Any], output: str) -> str:
+    """生成指定时长的黑场片段"""
+    size = f"{target['width']}x{target['height']}"
+    run_ffmpeg(["-f", "lavfi", "-i", f"color=c=black:s={size}:r={target['fps']}",
+                "-t", f"{duration:.3f}", "-vf", f"format={target['pix_fmt']}",
+                *VIDEO_CODEC_ARGS, "-f", "mpegts", output])
+    return output
+
+
+def render_segment(job: Dict[str, Any]) -> Dict[str, Any]:
+    """（在子进程中执行）把一个分镜的素材裁剪成时间轴上的片段
+
+    Returns:
+        {"index", "pieces": 按顺序的 ts 片段, "mode": copy/smart/reencode/placeholder}
+    """
+    source, duration, target = job["source"], job["duration"], job["target"]
+    prefix = job["prefix"]
+    if not source:
+        return {"index": job["index"], "mode": "placeholder",
+                "pieces": [render_placeholder(duration, target, f"{prefix}_black.ts")]}
+
+    info = probe_video(source)
+    half_frame = 0.5 / target["fps"]
+    compatible = (
+        info["codec"] == "h264"
+        and all(info[k] == target[k] for k in ("width", "height", "pix_fmt"))
+        and abs(info["fps"] - target["fps"]) < 0.01
+    )
+    if not compatible:
+        return {"index": job["index"], "mode": "reencode",
+                "pieces": [_encode_range(source, 0.0, duration, info["duration"], target, f"{prefix}_full.ts")]}
+
+    clip = info["duration"]
+    cut = min(duration, clip)
+    keyframes = probe_keyframes(source)
+    needs_pad = duration > clip + half_frame
+    on_boundary = abs(cut - clip) <= half_frame or any(abs(k - cut) <= half_frame for k in keyframes)
+    if on_boundary and not needs_pad:
+        return {"index": job["index"], "mode": "copy",
+                "pieces": [_copy_range(source, cut, f"{prefix}_copy.ts")]}
+
+    # 只重编码切点所在的最后一个 GOP
+    last_key = max([k for k in keyframes if k < cut - half_frame] or [0.0])
+    if last_key <= 0:
+        return {"index": job["index"], "mode": "reencode",
+                "pieces": [_encode_range(source, 0.0, duration, clip, target, f"{prefix}_full.ts")]}
+    return {"index": job["index"], "mode": "smart", "pieces": [
+        _copy_range(source, last_key, f"{prefix}_copy.ts"),
+        _encode_range(source, last_key, duration - last_key, clip, target, f"{prefix}_tail.ts"),
+    ]}
+
+
+class MVAssembler:
+    """把所有分镜素材按歌曲时间轴合成为完整 MV"""
+    # 没有任何素材可参考时使用的成片参数（海螺 768P）
+    DEFAULT_TARGET = {"width": 1366, "height": 768, "fps": 24.0, "pix_fmt": "yuv420p"}
+
+    def __init__(self, shots: List[Any], audio_path: str, output_dir: str, max_workers: Optional[int] = None):
+        """初始化合成器
+
+        Args:
+            shots: 所有分镜
+            audio_path: 整首歌音轨
+            output_dir: 成片输出目录
+            max_workers: 进程池大小，默认 CPU 核数
+        """
+        self.shots = shots
+        self.audio_path = audio_path
+        self.output_dir = Path(output_dir)
+        self.max_workers = max_workers
+
+    def _choose_target(self, sources: List[str]) -> Dict[str, Any]:
+        """以出现最多的素材参数作为成片参数，尽量让更多片段可以流复制"""
+        votes: Dict[tuple, int] = {}
+        for source in sources:
+            info = probe_video(source)
+            key = (info["width"], info["height"], info["fps"], info["pix_fmt"])
+            votes[key] = votes.get(key, 0) + 1
+        if not votes:
+            return dict(self.DEFAULT_TARGET)
+        width, height, fps, pix_fmt = max(votes, key=votes.get)
+        return {"width": width, "height": height, "fps": fps, "pix_fmt": pix_fmt}
+
+    def plan(self, allow_missing: bool = False) -> List[Dict[str, Any]]:
+        """生成每个分镜的裁剪任务（不执行）"""
+        timeline = build_timeline(self.shots)
+        missing = [entry["shot"].id for entry in timeline if not best_artifact(entry["shot"])]
+        if missing and not allow_missing:
+            raise ValueError(f"以下分镜还没有可用视频: {missing}")
+        return [
+            {
+                "index": n,
+                "shot_id": entry["shot"].id,
+                "source": best_artifact(entry["shot"]),
+                "start": entry["start"],
+                "duration": entry["duration"],
+            }
+            for n, entry in enumerate(timeline)
+        ]
+
+    def assemble(self, output_path: Optional[str] = None, allow_missing: bool = False) -> Dict[str, Any]:
+        """执行合成
+
+        Args:
+            output_path: 成片路径，默认 output_dir/mv_<时间戳>.mp4
+            allow_missing: 缺少素材的分镜是否用黑场代替（否则报错）
+
+        Returns:
+            {"path", "duration", "segments": [{"shot_id", "mode"}]}
+        """
+        jobs = self.plan(allow_missing=allow_missing)
+        if not jobs:
+            raise ValueError("没有可合成的分镜")
+        target = self._choose_target([job["source"] for job in jobs if job["source"]])
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if not output_path:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_path = str(self.output_dir / f"mv_{timestamp}.mp4")
+
+        work_dir = tempfile.mkdtemp(prefix="assembly_", dir=self.output_dir)
+        try:
+            for job in jobs:
+                job["target"] = target
+                job["prefix"] = os.path.join(work_dir, f"{job['index']:04d}")
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                results = sorted(pool.map(render_segment, jobs), key=lambda r: r["index"])
+
+            pieces = [piece for result in results for piece in result["pieces"]]
+            offset = jobs[0]["start"]
+            total = sum(job["duration"] for job in jobs)
+            concat_copy(
+                pieces, output_path,
+                extra_inputs=["-ss", f"{offset:.3f}", "-i", str(self.audio_path)],
+                extra_args=["-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy",
+                            "-c:a", "aac", "-b:a", "192k", "-t", f"{total:.3f}",
+                            "-movflags", "+faststart"],
+            )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        logger.info("✅ MV 已合成: %s", output_path)
+        return {
+            "path": output_path,
+            "duration": round(total, 3),
+            "segments": [{"shot_id": job["shot_id"], "mode": r["mode"]} for job, r in zip(jobs, results)],
+        }
@@ -0,0 +1,298 @@
+"""
+歌曲节奏分析
+
+整首歌只用 ffmpeg 解码一次为单声道 PCM，然后用 NumPy 向量化计算：
+  - 起音强度包络（对数幅度谱的正向谱通量）
+  - 速度（包络自相关 + 以 120 BPM 为中心的对数高斯先验）
+  - 节拍网格（Ellis 动态规划节拍跟踪）
+结果按歌曲哈希缓存，之后可以把分镜边界吸附到节拍上、检查时间轴是否连续、
+并把数值时间写回分镜。
+"""
+import os
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from media import FFMPEG
+from shot import parse_timecode, timeline_order
+from song_preprocess import song_hash
+
+
+def _nearest(grid: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """有序网格中离每个时间点最近的值"""
+    if len(grid) == 1:
+        return np.full_like(times, grid[0])
+    idx = np.clip(np.searchsorted(grid, times), 1, len(grid) - 1)
+    left, right = grid[idx - 1], grid[idx]
+    return np.where(times - left <= right - times, left, right)
+
+
+class SongAnalysis:
+    """一首歌的节奏分析结果（时间单位均为秒）"""
+
+    def __init__(self, sr: int, hop: int, duration: float, tempo: float,
+                 onset_env: np.ndarray, beats: np.ndarray, onsets: np.ndarray):
+        self.sr = sr
+        self.hop = hop
+        self.duration = duration
+        self.tempo = tempo
+        self.onset_env = onset_env
+        self.beats = beats
+        self.onsets = onsets
+
+    @property
+    def beat_period(self) -> float:
+        return 60.0 / self.tempo if self.tempo else 0.0
+
+    def snap(self, times: np.ndarray, tolerance: Optional[float] = None) -> np.ndarray:
+        """把时间点吸附到最近的节拍；距离超过 tolerance（默认半拍）时尝试最近的起音点，仍然太远则保持不变"""
+        times = np.asarray(times, dtype=float)
+        tolerance = self.beat_period / 2 if tolerance is None else tolerance
+        snapped = times.copy()
+        # 先起音点后节拍, 两者都在容差内时节拍优先
+        for grid in (self.onsets, self.beats):
+            if len(grid) == 0:
+                continue
+            nearest = _nearest(grid, times)
+            snapped = np.where(np.abs(nearest - times) <= tolerance, nearest, snapped)
+        return snapped
+
+    def to_npz(self, path: str) -> None:
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, sr=self.sr, hop=self.hop, duration=self.duration, tempo=self.tempo,
+                 onset_env=self.onset_env, beats=self.beats, onsets=self.onsets)
+        os.replace(tmp, path)
+
+    @classmethod
+    def from_npz(cls, path: str) -> "SongAnalysis":
+        with np.load(path) as data:
+            return cls(int(data["sr"]), int(data["hop"]), float(data["duration"]), float(data["tempo"]),
+                       data["onset_env"], data["beats"], data["onsets"])
+
+
+def decode_audio(audio_path: str, sr: int = 22050) -> np.ndarray:
+    """用 ffmpeg 把音频解码为单声道 float32 PCM"""
+    result = subprocess.run(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-i", str(audio_path),
+         "-ac", "1", "-ar", str(sr), "-f", "f32le", "-"],
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"音频解码失败: {result.stderr.decode(errors='ignore').strip()[-500:]}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def _band_matrix(n_bins: int, sr: int, n_bands: int = 64, fmin: float = 30.0) -> np.ndarray:
+    """把线性频点汇总到对数间隔频带的矩阵（近似 Mel 刻度，低频分辨率更高）"""
+    freqs = np.linspace(0, sr / 2, n_bins)
+    edges = np.geomspace(fmin, sr / 2, n_bands + 1)
+    band_of = np.searchsorted(edges, freqs) - 1
+    matrix = np.zeros((n_bins, n_bands), dtype=np.float32)
+    valid = (band_of >= 0) & (band_of < n_bands)
+    matrix[np.flatnonzero(valid), band_of[valid]] = 1.0
+    counts = matrix.sum(axis=0)
+    matrix = matrix[:, counts > 0]
+    return matrix / matrix.sum(axis=0)
+
+
+def onset_strength(y: np.ndarray, sr: int = 22050, n_fft: int = 2048, hop: int = 512,
+                   chunk: int = 2048) -> np.ndarray:
+    """对数频带上的正向谱通量起音包络，每帧一个值，已归一化到 [0, 1]"""
+    padded = np.pad(y, n_fft // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft)[::hop]
+    window = np.hanning(n_fft).astype(np.float32)
+    bands = _band_matrix(n_fft // 2 + 1, sr)
+    log_energy = np.empty((len(frames), bands.shape[1]), dtype=np.float32)
+    # 分块做 FFT, 控制内存占用
+    for start in range(0, len(frames), chunk):
+        block = frames[start:start + chunk] * window
+        power = np.abs(np.fft.rfft(block, axis=1)) ** 2
+        log_energy[start:start + chunk] = 10.0 * np.log10(power @ bands + 1e-10)
+    # 与 librosa 一致: 以最大值为参考, 动态范围截断在 80dB
+    log_energy = np.maximum(log_energy, log_energy.max() - 80.0)
+    flux = np.maximum(np.diff(log_energy, axis=0, prepend=log_energy[:1]), 0.0).mean(axis=1)
+    flux -= flux.min()
+    peak = flux.max()
+    return flux / peak if peak > 0 else flux
+
+
+def estimate_tempo(env: np.ndarray, sr: int, hop: int,
+                   min_bpm: float = 60.0, max_bpm: float = 200.0, prior_bpm: float = 120.0) -> float:
+    """包络自相关估计速度（BPM）"""
+    centered = env - env.mean()
+    n = len(centered)
+    spectrum = np.fft.rfft(centered, 2 * n)
+    autocorr = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    frame_rate = sr / hop
+    # 最短延迟向上取整、最长延迟向下取整, 结果才不会超出 [min_bpm, max_bpm]
+    lags = np.arange(max(1, int(np.ceil(frame_rate * 60 / max_bpm))),
+                     min(n - 1, int(frame_rate * 60 / min_bpm)) + 1)
+    if len(lags) == 0:
+        return prior_bpm
+    bpms = 60.0 * frame_rate / lags
+    prior = np.exp(-0.5 * np.log2(bpms / prior_bpm) ** 2)
+    return float(bpms[np.argmax(autocorr[lags] * prior)])
+
+
+def track_beats(env: np.ndarray, tempo: float, sr: int, hop: int, tightness: float = 100.0) -> np.ndarray:
+    """Ellis 动态规划节拍跟踪，返回节拍所在帧"""
+    period = 60.0 * sr / hop / tempo
+    # 用宽度与节拍周期相关的高斯核平滑包络
+    kernel_t = np.arange(-period, period + 1)
+    kernel = np.exp(-0.5 * (kernel_t * 32.0 / period) ** 2)
+    local = np.convolve(env, kernel, mode="same")
+
+    offsets = np.arange(-int(round(2 * period)), -int(round(period / 2)) + 1)
+    penalty = -tightness * np.log(-offsets / period) ** 2
+    n = len(local)
+    cumscore = np.zeros(n)
+    backlink = np.full(n, -1)
+    for i in range(n):
+        prev = i + offsets
+        valid = prev >= 0
+        if valid.any():
+            candidates = cumscore[prev[valid]] + penalty[valid]
+            best = int(np.argmax(candidates))
+            cumscore[i] = local[i] + candidates[best]
+            backlink[i] = prev[valid][best]
+        else:
+            cumscore[i] = local[i]
+
+    # 从最后一个节拍周期内得分最高的位置回溯
+    tail = max(0, n - int(round(period)))
+    beat = tail + int(np.argmax(cumscore[tail:]))
+    beats = []
+    while beat >= 0:
+        beats.append(beat)
+        beat = backlink[beat]
+    beats = np.array(beats[::-1])
+    # 去掉开头和结尾包络很弱的节拍（前奏静音、结尾淡出）
+    strong = local[beats] > 0.1 * np.median(local[beats])
+    return beats[strong]
+
+
+def pick_onsets(env: np.ndarray, delta: float = 0.07, wait: int = 4) -> np.ndarray:
+    """包络的局部峰值，返回帧号"""
+    if len(env) < 3:
+        return np.array([], dtype=int)
+    is_peak = (env[1:-1] > env[:-2]) & (env[1:-1] >= env[2:]) & (env[1:-1] > env.mean() + delta)
+    peaks = np.flatnonzero(is_peak) + 1
+    if len(peaks) == 0:
+        return peaks
+    keep = np.concatenate(([True], np.diff(peaks) > wait))
+    return peaks[keep]
+
+
+def analyze_song(audio_path: str, cache_dir: str = "cache", sr: int = 22050, hop: int = 512) -> SongAnalysis:
+    """分析整首歌的节奏，结果缓存在 <cache_dir>/analysis/<歌曲哈希>_<sr>_<hop>.npz"""
+    cache_path = Path(cache_dir) / "analysis" / f"{song_hash(audio_path)}_{sr}_{hop}.npz"
+    if cache_path.exists():
+        return SongAnalysis.from_npz(str(cache_path))
+
+    y = decode_audio(audio_path, sr=sr)
+    env = onset_strength(y, sr=sr, hop=hop)
+    tempo = estimate_tempo(env, sr, hop)
+    frames_to_seconds = hop / sr
+    analysis = SongAnalysis(
+        sr=sr,
+        hop=hop,
+        duration=len(y) / sr,
+        tempo=tempo,
+        onset_env=env.astype(np.float32),
+        beats=track_beats(env, tempo, sr, hop) * frames_to_seconds,
+        onsets=pick_onsets(env) * frames_to_seconds,
+    )
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    analysis.to_npz(str(cache_path))
+    return analysis
+
+
+def _optional_time(value) -> Optional[float]:
+    return None if value in (None, "") else parse_timecode(value)
+
+
+def validate_timeline(shots: List[Any], song_duration: Optional[float] = None,
+                      tolerance: float = 0.05) -> List[str]:
+    """检查分镜时间轴是否连续、没有重叠、没有超出歌曲长度"""
+    problems = []
+    ordered = timeline_order(shots)
+    for prev, cur in zip(ordered, ordered[1:]):
+        prev_end, cur_start = _optional_time(prev.end_time), _optional_time(cur.start_time)
+        if prev_end is None or cur_start is None:
+            continue
+        if cur_start < prev_end - tolerance:
+            problems.append(f"shot {prev.id} 与 shot {cur.id} 重叠 {prev_end - cur_start:.2f}s")
+        elif cur_start > prev_end + tolerance:
+            problems.append(f"shot {prev.id} 与 shot {cur.id} 之间有 {cur_start - prev_end:.2f}s 空隙")
+    for shot in ordered:
+        start, end = _optional_time(shot.start_time), _optional_time(shot.end_time)
+        if start is not None and end is not None and end <= start:
+            problems.append(f"shot {shot.id} 的 endTime 不晚于 startTime")
+        if song_duration is not None and end is not None and end > song_duration + tolerance:
+            problems.append(f"shot {shot.id} 结束于 {end:.2f}s, 超出歌曲长度 {song_duration:.2f}s")
+    return problems
+
+
+def propose_timing(shots: List[Any], analysis: SongAnalysis,
+                   tolerance: Optional[float] = None) -> List[Dict[str, Any]]:
+    """为每个分镜（即每句歌词）给出吸附到节拍、首尾相接的时间
+
+    分镜按 timeline_order 排列；已有 startTime 的分镜以它为边界起点，没有的按 duration 顺延；
+    所有边界一次性向量化吸附，吸附后相邻边界落在同一拍上时退回原始值。
+
+    Returns:
+        [{"id", "start", "end", "duration", "moved"}]，按时间顺序
+
+    Raises:
+        ValueError: 原始边界不是严格递增的（例如两个分镜 startTime 相同，或最后一个分镜的起点已超出歌曲长度）
+    """
+    ordered = timeline_order(shots)
+    if not ordered:
+        return []
+    bounds = []
+    cursor = 0.0
+    for shot in ordered:
+        start = _optional_time(shot.start_time)
+        start = cursor if start is None else start
+        bounds.append(start)
+        end = _optional_time(shot.end_time)
+        cursor = end if end is not None and end > start else start + float(shot.duration)
+    bounds.append(min(cursor, analysis.duration))
+
+    raw = np.array(bounds)
+    collapsed = [i for i in range(1, len(raw)) if raw[i] <= raw[i - 1]]
+    if collapsed:
+        names = [f"shot {ordered[i].id}" if i < len(ordered) else "歌曲结尾" for i in collapsed]
+        raise ValueError(f"时间轴边界不是递增的, 请先修正 startTime/endTime: {', '.join(names)}")
+    snapped = analysis.snap(raw, tolerance)
+    snapped[0] = raw[0] if raw[0] < analysis.beat_period / 2 else snapped[0]
+    # 吸附后必须严格递增: 相邻边界吸附到同一拍（或交错）时两者都退回原始值，原始边界递增所以一定会收敛
+    while True:
+        crossed = np.flatnonzero(np.diff(snapped) <= 0)
+        if len(crossed) == 0:
+            break
+        snapped[crossed] = raw[crossed]
+        snapped[crossed + 1] = raw[crossed + 1]
+
+    return [
+        {
+            "id": shot.id,
+            "start": round(float(snapped[i]), 3),
+            "end": round(float(snapped[i + 1]), 3),
+            "duration": round(float(snapped[i + 1] - snapped[i]), 3),
+            "moved": round(float(max(abs(snapped[i] - raw[i]), abs(snapped[i + 1] - raw[i + 1]))), 3),
+        }
+        for i, shot in enumerate(ordered)
+    ]
+
+
+def apply_timing(shots: List[Any], proposals: List[Dict[str, Any]]) -> None:
+    """把数值时间写回分镜对象"""
+    by_id = {p["id"]: p for p in proposals}
+    for shot in shots:
+        if shot.id in by_id:
+            shot.start_time = by_id[shot.id]["start"]
+            shot.end_time = by_id[shot.id]["end"]
+            shot.duration = by_id[shot.id]["duration"]
@@ -0,0 +1,874 @@
+"""
+端到端流水线基准测试（本地模拟服务商，不花钱）
+
+threadtest.py 直接调用付费接口，只能偶尔手动跑一次。这里在本进程内起一个 HTTP 服务，
+模拟 MiniMax 海螺、方舟 Seedream 和 ComfyUI（含 /ws 推送）的接口并注入合成延迟，
+然后在子进程里用真实的 ShotsManager / Shot / 各客户端 / BatchRunner 跑完整流水线
+（参考图 -> 首帧 -> 视频 -> 对口型），按分镜数、并发数、轮询间隔、海螺等待方式（轮询/回调）、
+是否对冲长尾海螺任务做参数扫描。
+
+每组参数记录: 总耗时(makespan)、各阶段耗时的 p50/p95、子进程峰值内存和线程数、各接口请求次数，
+结果写成 JSON，用 --baseline 与之前版本的结果对比即可看出性能回退。
+
+示例:
+    python benchmark.py --shots 10,100,500 --workers 5,20 --poll 0.2,1 -o benchmarks/latest.json
+    python benchmark.py --shots 50 --baseline benchmarks/latest.json
+    python benchmark.py --shots 60 --workers 10 --poll 0.5 --tail-ratio 0.1 --hedge off,90
+"""
+import argparse
+import base64
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import platform
+import queue
+import random
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# 合成延迟（秒）: 每个值是中位数，实际耗时按对数正态分布抖动
+LATENCY = {
+    "request": 0.005,       # 每个 HTTP 请求的基础往返
+    "ark_generate": 0.3,    # Seedream 文生图
+    "ark_edit": 0.4,        # Seedream 图生图
+    "hailuo_queue": 0.5,    # 海螺任务最短排队时间
+    "hailuo_render": 2.0,   # 海螺生成 6s 片段（10s 片段按时长等比放大）
+    "comfyui_node": 0.2,    # ComfyUI 每个节点
+}
+# 服务商侧的并发上限（超出的任务排队）
+SLOTS = {"ark": 20, "hailuo": 10, "comfyui": 1}
+JITTER = 0.25
+# 海螺长尾任务: 按比例抽中的任务生成时间乘以该倍数（--tail-ratio / --tail-factor）
+TAIL_FACTOR = 4.0
+# 流水线阶段（不含需要真实音视频的合成阶段）
+STAGES = ["reference", "first_frame", "video", "lip_sync"]
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """最近秩百分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 3)
+
+
+class FakeProviders:
+    """在一个 HTTP 端口上模拟三个服务商
+
+    路由:
+        /minimax/v1/...       海螺: 提交任务、查询状态、获取下载链接
+        /ark/api/v3/...       方舟: images/generations（文生图与图生图）
+        /files/<名字>         生成结果下载
+        /prompt /upload/image /history/<id> /view /ws   ComfyUI
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: Optional[Dict[str, float]] = None, slots: Optional[Dict[str, int]] = None,
+                 image_kb: int = 512, video_kb: int = 2048, seed: int = 0,
+                 tail_ratio: float = 0.0, tail_factor: float = TAIL_FACTOR):
+        """
+        Args:
+            host, port: 监听地址，port 为 0 时自动选择
+            latency: 覆盖 LATENCY 中的延迟
+            slots: 覆盖 SLOTS 中的并发上限
+            image_kb, video_kb: 生成的图片/视频大小
+            seed: 延迟抖动的随机种子
+            tail_ratio, tail_factor: 多大比例的海螺任务生成时间变为 tail_factor 倍
+        """
+        self.latency = {**LATENCY, **(latency or {})}
+        self.slots = {**SLOTS, **(slots or {})}
+        self.sizes = {"image": image_kb * 1024, "video": video_kb * 1024}
+        self._rng = random.Random(seed)
+        self.tail = {"ratio": tail_ratio, "factor": tail_factor}
+        self._lock = threading.Lock()
+        self.requests: Counter = Counter()
+        # 生成结果暂存在私有临时目录, stop 时整体删除
+        self._file_dir = tempfile.mkdtemp(prefix="mvbench_files_")
+        self._files: Dict[str, str] = {}
+        self._ark_slots = threading.BoundedSemaphore(self.slots["ark"])
+        # 海螺: task_id -> [开始生成时间, 完成时间, 结果文件]; 各生成槽位的空闲时间（小顶堆）
+        self._tasks: Dict[str, list] = {}
+        self._hailuo_free = [0.0] * self.slots["hailuo"]
+        self._result_lock = threading.Lock()
+        # 海螺回调: 待推送的 (时间, 地址, task_id, 状态) 小顶堆, 已通过验证的回调地址
+        self._callbacks: List[tuple] = []
+        self._callback_cond = threading.Condition()
+        self._verified: set = set()
+        # ComfyUI: 待执行的 prompt、历史记录、client_id -> 该客户端的 ws 消息队列
+        self._prompts: "queue.Queue" = queue.Queue()
+        self._history: Dict[str, Dict[str, Any]] = {}
+        self._sockets: Dict[str, List[queue.Queue]] = {}
+
+        handler = type("Handler", (_FakeHandler,), {"fake": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.address = f"{host}:{self.server.server_port}"
+        self._threads = [
+            threading.Thread(target=self.server.serve_forever, name="fake-http", daemon=True),
+            threading.Thread(target=self._callback_worker, name="fake-hailuo-callback", daemon=True),
+            *(threading.Thread(target=self._comfyui_worker, name=f"fake-comfyui-{n}", daemon=True)
+              for n in range(self.slots["comfyui"])),
+        ]
+
+    # ---- 生命周期 ----
+    def start(self) -> "FakeProviders":
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self._file_dir, ignore_errors=True)
+
+    def reset_counts(self) -> Dict[str, int]:
+        """返回并清空请求计数"""
+        with self._lock:
+            counts = dict(sorted(self.requests.items()))
+            self.requests.clear()
+        return counts
+
+    @property
+    def endpoints(self) -> Dict[str, str]:
+        base = f"http://{self.address}"
+        return {"hailuo": f"{base}/minimax/v1", "ark": f"{base}/ark/api/v3", "comfyui": self.address}
+
+    # ---- 工具 ----
+    def _delay(self, key: str, scale: float = 1.0) -> float:
+        with self._lock:
+            jitter = self._rng.lognormvariate(0, JITTER)
+        return self.latency[key] * scale * jitter
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.requests[name] += 1
+
+    def _new_file(self, kind: str, suffix: str) -> str:
+        """生成一个内容唯一的结果文件，返回文件名"""
+        name = f"{uuid.uuid4().hex}{suffix}"
+        path = os.path.join(self._file_dir, name)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+            f.write(os.urandom(self.sizes[kind]))
+        with self._lock:
+            self._files[name] = path
+        return name
+
+    def _take_file(self, name: str) -> Optional[bytes]:
+        """读取并删除结果文件（每个结果只会被下载一次）"""
+        with self._lock:
+            path = self._files.pop(name, None)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+        return data
+
+    # ---- 海螺 ----
+    def hailuo_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        render = self._delay("hailuo_render", payload.get("duration", 6) / 6)
+        with self._lock:
+            if self._rng.random() < self.tail["ratio"]:
+                render *= self.tail["factor"]
+        earliest = time.time() + self._delay("hailuo_queue")
+        callback_url = payload.get("callback_url")
+        if callback_url and not self._verify_callback(callback_url):
+            callback_url = None
+        with self._lock:
+            start = max(earliest, heapq.heappop(self._hailuo_free))
+            heapq.heappush(self._hailuo_free, start + render)
+            task_id = uuid.uuid4().hex
+            self._tasks[task_id] = [start, start + render, None]
+        if callback_url:
+            with self._callback_cond:
+                heapq.heappush(self._callbacks, (start, callback_url, task_id, "processing"))
+                heapq.heappush(self._callbacks, (start + render, callback_url, task_id, "success"))
+                self._callback_cond.notify()
+        return {"task_id": task_id, "base_resp": {"status_code": 0, "status_msg": "success"}}
+
+    def _hailuo_result(self, task_id: str) -> str:
+        """任务的结果文件，第一次需要时才写出"""
+        task = self._tasks[task_id]
+        with self._result_lock:
+            if task[2] is None:
+                task[2] = self._new_file("video", ".mp4")
+        return task[2]
+
+    def hailuo_query(self, task_id: str) -> Dict[str, Any]:
+        task = self._tasks[task_id]
+        now = time.time()
+        if now < task[0]:
+            return {"task_id": task_id, "status": "Queueing"}
+        if now < task[1]:
+            return {"task_id": task_id, "status": "Processing"}
+        return {"task_id": task_id, "status": "Success", "file_id": self._hailuo_result(task_id)}
+
+    def _post(self, url: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(url, data=json.dumps(data).encode(), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=3) as response:
+            return json.loads(response.read() or b"{}")
+
+    def _verify_callback(self, url: str) -> bool:
+        """与 MiniMax 一样，第一次使用某个回调地址时先发 challenge 验证"""
+        if url in self._verified:
+            return True
+        challenge = uuid.uuid4().hex
+        self._count("hailuo.challenge")
+        try:
+            ok = self._post(url, {"challenge": challenge}).get("challenge") == challenge
+        except (OSError, ValueError):
+            ok = False
+        if ok:
+            self._verified.add(url)
+        return ok
+
+    def _callback_worker(self) -> None:
+        """按时间顺序向回调地址推送任务状态（processing / success）"""
+        while True:
+            with self._callback_cond:
+                while not self._callbacks or self._callbacks[0][0] > time.time():
+                    timeout = self._callbacks[0][0] - time.time() if self._callbacks else None
+                    self._callback_cond.wait(timeout)
+                _, url, task_id, status = heapq.heappop(self._callbacks)
+            data = {"task_id": task_id, "status": status, "base_resp": {"status_code": 0, "status_msg": "success"}}
+            if status == "success":
+                data["file_id"] = self._hailuo_result(task_id)
+            self._count("hailuo.callback")
+            try:
+                self._post(url, data)
+            except (OSError, ValueError):
+                # 回调失败时客户端靠兜底轮询发现状态
+                pass
+
+    # ---- 方舟 ----
+    def ark_generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        with self._ark_slots:
+            time.sleep(self._delay("ark_edit" if payload.get("image") else "ark_generate"))
+        name = self._new_file("image", ".png")
+        return {"model": payload.get("model"), "created": int(time.time()),
+                "data": [{"url": f"http://{self.address}/files/{name}", "size": payload.get("size")}]}
+
+    # ---- ComfyUI ----
+    def comfyui_queue(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        prompt_id = str(uuid.uuid4())
+        self._prompts.put((prompt_id, payload.get("client_id"), payload["prompt"]))
+        return {"prompt_id": prompt_id, "number": self._prompts.qsize(), "node_errors": {}}
+
+    def _broadcast(self, client_id: str, message: Dict[str, Any]) -> None:
+        with self._lock:
+            targets = list(self._sockets.get(client_id, []))
+        for target in targets:
+            target.put(json.dumps(message))
+
+    def _comfyui_worker(self) -> None:
+        """模拟 GPU: 依次执行排队的 prompt，逐节点推送 executing/progress 消息"""
+        while True:
+            prompt_id, client_id, workflow = self._prompts.get()
+            # 对口型工作流结果在节点 131（视频），人声分离在节点 4（音频）
+            lipsync = "131" in workflow
+            nodes = [n for n in ("228", "194", "128", "131") if n in workflow] if lipsync else ["1", "3", "4"]
+            for node in nodes:
+                self._broadcast(client_id, {"type": "executing", "data": {"node": node, "prompt_id": prompt_id}})
+                duration = self._delay("comfyui_node", 3 if node == "128" else 1)
+                steps = 4 if node == "128" else 1
+                for step in range(steps):
+                    time.sleep(duration / steps)
+                    if steps > 1:
+                        self._broadcast(client_id, {"type": "progress",
+                                                    "data": {"value": step + 1, "max": steps, "prompt_id": prompt_id}})
+            if lipsync:
+                outputs = {"131": {"gifs": [{"filename": self._new_file("video", ".mp4"), "subfolder": "",
+                                             "type": "output"}]}}
+            else:
+                outputs = {"4": {"audio": [{"filename": self._new_file("image", ".flac"), "subfolder": "",
+                                            "type": "output"}]}}
+            with self._lock:
+                self._history[prompt_id] = {prompt_id: {"outputs": outputs, "status": {"completed": True}}}
+            self._broadcast(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    def comfyui_history(self, prompt_id: str) -> Dict[str, Any]:
+        with self._lock:
+            return self._history.pop(prompt_id, {})
+
+    def open_socket(self, client_id: str) -> "queue.Queue":
+        outbox: "queue.Queue" = queue.Queue()
+        with self._lock:
+            self._sockets.setdefault(client_id, []).append(outbox)
+        return outbox
+
+    def close_socket(self, client_id: str, outbox: "queue.Queue") -> None:
+        with self._lock:
+            sockets = self._sockets.get(client_id, [])
+            if outbox in sockets:
+                sockets.remove(outbox)
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    fake: FakeProviders = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, data: Any, status: int = 200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _bytes(self, data: Optional[bytes]) -> None:
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        fake = self.fake
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        time.sleep(fake.latency["request"])
+        if url.path == "/ws":
+            fake._count("comfyui.ws")
+            return self._websocket(query.get("clientId", ""))
+        if url.path == "/minimax/v1/query/video_generation":
+            fake._count("hailuo.query")
+            return self._json(fake.hailuo_query(query["task_id"]))
+        if url.path == "/minimax/v1/files/retrieve":
+            fake._count("hailuo.retrieve")
+            return self._json({"file": {"file_id": query["file_id"],
+                                        "download_url": f"http://{fake.address}/files/{query['file_id']}"}})
+        if url.path.startswith("/files/"):
+            fake._count("download")
+            return self._bytes(fake._take_file(url.path[len("/files/"):]))
+        if url.path.startswith("/history/"):
+            fake._count("comfyui.history")
+            return self._json(fake.comfyui_history(url.path[len("/history/"):]))
+        if url.path == "/view":
+            fake._count("comfyui.view")
+            return self._bytes(fake._take_file(query.get("filename", "")))
+        self.send_error(404)
+
+    def do_POST(self):
+        fake = self.fake
+        path = urlparse(self.path).path
+        body = self._body()
+        time.sleep(fake.latency["request"])
+        if path == "/minimax/v1/video_generation":
+            fake._count("hailuo.submit")
+            return self._json(fake.hailuo_submit(json.loads(body)))
+        if path == "/ark/api/v3/images/generations":
+            fake._count("ark.generate")
+            return self._json(fake.ark_generate(json.loads(body)))
+        if path == "/upload/image":
+            fake._count("comfyui.upload")
+            return self._json({"name": f"{uuid.uuid4().hex}", "subfolder": "", "type": "input"})
+        if path == "/prompt":
+            fake._count("comfyui.prompt")
+            return self._json(fake.comfyui_queue(json.loads(body)))
+        if path in ("/queue", "/interrupt"):
+            # 超时/取消时客户端撤下任务; 模拟服务只计数
+            fake._count(f"comfyui.{path.strip('/')}")
+            return self._json({})
+        self.send_error(404)
+
+    # ---- 最小 WebSocket 服务端（只发文本帧，回应 ping/close）----
+    def _websocket(self, client_id: str) -> None:
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        self.wfile.flush()
+        outbox = self.fake.open_socket(client_id)
+        try:
+            while True:
+                try:
+                    self._send_frame(0x1, outbox.get(timeout=0.2).encode())
+                except queue.Empty:
+                    pass
+                while select.select([self.connection], [], [], 0)[0]:
+                    opcode, payload = self._read_frame()
+                    if opcode is None or opcode == 0x8:
+                        return
+                    if opcode == 0x9:
+                        self._send_frame(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            self.fake.close_socket(client_id, outbox)
+            self.close_connection = True
+
+    def _send_frame(self, opcode: int, payload: bytes) -> None:
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 1 << 16:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def _read_frame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            return None, b""
+        opcode, length = head[0] & 0x0F, head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+        data = self.rfile.read(length)
+        return opcode, bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+
+# ---------------- 子进程: 用真实代码跑一次流水线 ----------------
+
+def write_script(path: Path, shots: int, character_ratio: float, sing_ratio: float,
+                 long_ratio: float, seed: int) -> None:
+    """生成一份合成脚本: 提示词各不相同（不触发重复分镜复用），时长只有 6s/10s（不需要 ffmpeg 拼接）"""
+    rng = random.Random(seed)
+    data = {"character_description": "一位穿红色外套的年轻歌手, 短发, 城市夜景", "shots": []}
+    clock = 0.0
+    for n in range(shots):
+        duration = 10 if rng.random() < long_ratio else 6
+        data["shots"].append({
+            "id": n + 1,
+            "lyric": f"第 {n + 1} 句歌词",
+            "stable": f"镜头 {n + 1}: 歌手站在第 {n + 1} 条街道的路口, 霓虹灯编号 {rng.randrange(10 ** 6)}",
+            "dynamic": f"镜头缓慢推近, 动作 {n + 1}",
+            "duration": duration,
+            "character": rng.random() < character_ratio,
+            "sing": rng.random() < sing_ratio,
+            "startTime": round(clock, 2),
+            "endTime": round(clock + duration, 2),
+        })
+        clock += duration
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+class _Sampler:
+    """后台采样当前进程的线程数和内存"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    @staticmethod
+    def _os_threads() -> int:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return threading.active_count()
+
+    @staticmethod
+    def _rss() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return 0
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak_threads = max(self.peak_threads, self._os_threads())
+            self.peak_rss = max(self.peak_rss, self._rss())
+            self._stop.wait(self.interval)
+
+    def start(self) -> "_Sampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        self._thread.join()
+        peak_rss = self.peak_rss
+        try:
+            import resource
+            # Linux 上 ru_maxrss 的单位是 KB, macOS 上是字节
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak_rss = max(peak_rss, maxrss if sys.platform == "darwin" else maxrss * 1024)
+        except ImportError:
+            pass
+        return {"peak_rss_mb": round(peak_rss / 2 ** 20, 1), "peak_threads": self.peak_threads,
+                "threads_after": self._os_threads()}
+
+
+def run_once(config: Dict[str, Any]) -> Dict[str, Any]:
+    """（在子进程中执行）按 config 跑一次流水线，返回测量结果"""
+    # 只在子进程里导入项目代码, 父进程的模拟服务不计入内存和线程
+    sys.path.insert(0, str(REPO_DIR))
+    import logs
+    from HailuoVideoGenerator import HailuoVideoGenerator
+    from hailuo_callback import get_receiver
+    from hedging import DEFAULT_BUDGET_RATIO, HedgePolicy
+    from cli import BatchRunner
+    from shots_manager import ShotsManager
+
+    endpoints = config["endpoints"]
+
+    class BenchManager(ShotsManager):
+        """客户端指向本地模拟服务的 ShotsManager"""
+        COMFYUI_SERVER = endpoints["comfyui"]
+
+        def _create_seedream(self):
+            from SeedreamImageGenerator import SeedreamImageGenerator
+            return SeedreamImageGenerator(api_key="bench", base_url=endpoints["ark"], output_dir=self.output_dir)
+
+        def _create_hailuo(self):
+            callbacks = get_receiver(0) if config["hailuo_mode"] == "callback" else None
+            return HailuoVideoGenerator(api_key="bench", base_url=endpoints["hailuo"], output_dir=self.output_dir,
+                                        callbacks=callbacks)
+
+        def _create_comfyui(self):
+            client = super()._create_comfyui()
+            client.WORKFLOW_DIR = str(REPO_DIR / "workflows" / "lipsync.json")
+            return client
+
+    HailuoVideoGenerator.POLL_INTERVAL = config["poll_interval"]
+    work_dir = Path(config["work_dir"])
+    # 日志照常输出（计入开销），但写到文件里, stderr 只留给异常
+    log_file = open(work_dir / "run.log", "w", encoding="utf-8")
+    logs.setup(stream=log_file)
+    script = work_dir / "shots.json"
+    write_script(script, config["shots"], config["character_ratio"], config["sing_ratio"],
+                 config["long_ratio"], config["seed"])
+    audio = work_dir / "song.mp3"
+    audio.write_bytes(os.urandom(256 * 1024))
+
+    sampler = _Sampler().start()
+    started = time.perf_counter()
+    manager = BenchManager(str(script), str(work_dir / "output"))
+    hedge = None
+    if config.get("hedge") is not None:
+        budget = config.get("hedge_budget")
+        if budget is None:
+            budget = manager.estimate_batch_cost()["video"] * DEFAULT_BUDGET_RATIO
+        hedge = HedgePolicy(config["hedge"], budget=budget)
+    with open(os.devnull, "w") as devnull:
+        runner = BatchRunner(
+            manager,
+            stages=config["stages"],
+            audio_path=str(audio),
+            workers={"seedream": config["workers"], "hailuo": config["workers"], "comfyui": 1},
+            trace_path=str(work_dir / "trace.json"),
+            timeouts=config.get("stage_timeouts"),
+            hedge=hedge,
+            spend_limit=config.get("spend_limit"),
+            stream=devnull,
+        )
+        summary = runner.run()
+    makespan = time.perf_counter() - started
+    resources = sampler.stop()
+    logs.shutdown()
+    log_file.close()
+
+    durations: Dict[str, List[float]] = {}
+    failures: Dict[str, int] = {}
+    timeouts: Dict[str, int] = {}
+    for record in summary["shots"]:
+        for stage, entry in record["stages"].items():
+            if entry["status"] == "success":
+                durations.setdefault(stage, []).append(entry["duration"])
+            elif entry["status"] == "failed":
+                failures[stage] = failures.get(stage, 0) + 1
+            elif entry["status"] == "timeout":
+                timeouts[stage] = timeouts.get(stage, 0) + 1
+    if summary["reference"].get("status") == "success":
+        durations["reference"] = [summary["reference"]["duration"]]
+    stages = {
+        stage: {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                "max": round(max(values), 3)}
+        for stage, values in durations.items()
+    }
+    return {
+        "makespan": round(makespan, 3),
+        "stages": stages,
+        "failures": failures,
+        "timeouts": timeouts,
+        "shot_status": summary["counts"],
+        "cost": summary["total_cost"],
+        "hedging": summary["hedging"],
+        "budget": summary["budget"],
+        **resources,
+    }
+
+
+# ---------------- 父进程: 参数扫描与结果对比 ----------------
+
+def _git_version() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                                capture_output=True, text=True, timeout=10)
+        return result.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_sweep(shot_counts: List[int], worker_counts: List[int], poll_intervals: List[float],
+              stages: List[str], hailuo_modes: Optional[List[str]] = None, repeat: int = 1,
+              character_ratio: float = 0.6, sing_ratio: float = 0.1,
+              long_ratio: float = 0.3, latency: Optional[Dict[str, float]] = None,
+              slots: Optional[Dict[str, int]] = None, image_kb: int = 512, video_kb: int = 2048,
+              seed: int = 0, timeout: float = 3600,
+              stage_timeouts: Optional[Dict[str, Optional[float]]] = None,
+              hedges: Optional[List[Optional[float]]] = None, hedge_budget: Optional[float] = None,
+              tail_ratio: float = 0.0, tail_factor: float = TAIL_FACTOR,
+              spend_limit: Optional[float] = None) -> Dict[str, Any]:
+    """启动模拟服务商，对所有参数组合各跑 repeat 次，返回完整结果
+
+    hedges 中的每一项是对冲的百分位，None 表示不对冲。
+    """
+    fake = FakeProviders(latency=latency, slots=slots, image_kb=image_kb, video_kb=video_kb, seed=seed,
+                         tail_ratio=tail_ratio, tail_factor=tail_factor).start()
+    runs = []
+    combos = list(itertools.product(shot_counts, worker_counts, poll_intervals, hailuo_modes or ["poll"],
+                                    hedges or [None], range(repeat)))
+    try:
+        for n, (shots, workers, poll, mode, hedge, attempt) in enumerate(combos, 1):
+            label = (f"shots={shots} workers={workers} poll={poll}s hailuo={mode} hedge={_hedge_label(hedge)}"
+                     + (f" #{attempt + 1}" if repeat > 1 else ""))
+            print(f"[{n}/{len(combos)}] {label}", file=sys.stderr, flush=True)
+            with tempfile.TemporaryDirectory(prefix="mvbench_") as work_dir:
+                config = {
+                    "shots": shots, "workers": workers, "poll_interval": poll, "hailuo_mode": mode, "stages": stages,
+                    "character_ratio": character_ratio, "sing_ratio": sing_ratio, "long_ratio": long_ratio,
+                    "seed": seed + attempt, "endpoints": fake.endpoints, "work_dir": work_dir,
+                    "stage_timeouts": stage_timeouts or {}, "hedge": hedge, "hedge_budget": hedge_budget,
+                    "spend_limit": spend_limit,
+                }
+                config_path = Path(work_dir) / "config.json"
+                result_path = Path(work_dir) / "result.json"
+                config_path.write_text(json.dumps(config), encoding="utf-8")
+                fake.reset_counts()
+                try:
+                    process = subprocess.run(
+                        [sys.executable, str(Path(__file__).resolve()), "--run-one", str(config_path),
+                         "--result", str(result_path)],
+                        cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=timeout)
+                    error = None if process.returncode == 0 else process.stderr.strip()[-2000:]
+                except subprocess.TimeoutExpired:
+                    error = f"超过 {timeout}s 未完成"
+                requests_made = fake.reset_counts()
+                run = {"shots": shots, "workers": workers, "poll_interval": poll, "hailuo_mode": mode,
+                       "hedge": hedge, "attempt": attempt}
+                if error is None:
+                    run.update(json.loads(result_path.read_text(encoding="utf-8")))
+                else:
+                    run["error"] = error
+                run["requests"] = requests_made
+                runs.append(run)
+            if "error" in run:
+                print(f"  ❌ {run['error'].splitlines()[-1] if run['error'] else '子进程失败'}", file=sys.stderr)
+            else:
+                p95 = {s: v["p95"] for s, v in run["stages"].items()}
+                print(f"  ✅ makespan={run['makespan']}s p95={p95} rss={run['peak_rss_mb']}MB "
+                      f"threads={run['peak_threads']} requests={sum(requests_made.values())}", file=sys.stderr)
+                if run["hedging"]:
+                    h = run["hedging"]
+                    print(f"  🔁 对冲 {h['launched']} 次 (对冲胜 {h['hedge_won']}), 额外花费 {h['spent']} 元, "
+                          f"估计节省 {h['saved_seconds']}s", file=sys.stderr)
+    finally:
+        fake.stop()
+    return {
+        "version": _git_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": stages,
+        "workload": {"character_ratio": character_ratio, "sing_ratio": sing_ratio, "long_ratio": long_ratio,
+                     "image_kb": image_kb, "video_kb": video_kb, "seed": seed},
+        "latency": fake.latency,
+        "slots": fake.slots,
+        "tail": fake.tail,
+        "spend_limit": spend_limit,
+        "stage_timeouts": stage_timeouts or {},
+        "runs": runs,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """按 (分镜数, 并发数, 轮询间隔, 海螺模式, 对冲百分位) 对比两次结果中的 makespan、各阶段 p95 和峰值内存（取各次重复的中位数）"""
+    def index(result):
+        grouped: Dict[tuple, List[Dict[str, Any]]] = {}
+        for run in result["runs"]:
+            if "error" not in run:
+                key = (run["shots"], run["workers"], run["poll_interval"], run.get("hailuo_mode", "poll"),
+                       run.get("hedge"))
+                grouped.setdefault(key, []).append(run)
+        return grouped
+
+    def median(runs, getter):
+        return percentile([v for v in (getter(r) for r in runs) if v is not None], 50)
+
+    old_runs = index(baseline)
+    rows = []
+    for key, runs in sorted(index(current).items(), key=lambda item: (*item[0][:4], item[0][4] or 0)):
+        if key not in old_runs:
+            continue
+        row = {"shots": key[0], "workers": key[1], "poll_interval": key[2], "hailuo_mode": key[3], "hedge": key[4]}
+        metrics = {"makespan": lambda r: r["makespan"], "peak_rss_mb": lambda r: r["peak_rss_mb"],
+                   "cost": lambda r: r.get("cost")}
+        for stage in current["stages"]:
+            metrics[f"{stage}.p95"] = lambda r, s=stage: r["stages"].get(s, {}).get("p95")
+        for name, getter in metrics.items():
+            new, old = median(runs, getter), median(old_runs[key], getter)
+            if new is None or old is None:
+                continue
+            row[name] = {"baseline": old, "current": new,
+                         "change": round((new - old) / old * 100, 1) if old else None}
+        rows.append(row)
+    return rows
+
+
+def _number_list(text: str, cast=float) -> List:
+    return [cast(x) for x in text.split(",") if x.strip()]
+
+
+def _hedge_list(text: str) -> List[Optional[float]]:
+    """"off,90" -> [None, 90.0]"""
+    return [None if x.strip() in ("off", "0") else float(x) for x in text.split(",") if x.strip()]
+
+
+def _hedge_label(hedge: Optional[float]) -> str:
+    return "off" if hedge is None else f"P{hedge:g}"
+
+
+def _overrides(items: List[str], cast=float) -> Dict[str, Any]:
+    result = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        result[key.strip()] = cast(value)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="MV 流水线基准测试（本地模拟服务商）")
+    parser.add_argument("--shots", default="10,50,200,500", help="逗号分隔的分镜数")
+    parser.add_argument("--workers", default="5,10,20", help="逗号分隔的 Seedream/海螺并发数（ComfyUI 固定为 1）")
+    parser.add_argument("--poll", default="0.5,2", help="逗号分隔的海螺轮询间隔(秒)")
+    parser.add_argument("--hailuo-mode", default="poll",
+                        help="逗号分隔的海螺等待方式: poll（只轮询）、callback（回调 + 兜底轮询）")
+    parser.add_argument("--hedge", default="off",
+                        help="逗号分隔的海螺对冲百分位，off 表示不对冲（同 cli.py run --hedge-percentile）")
+    parser.add_argument("--hedge-budget", type=float, help="每次运行对冲的额外花费上限(元)，默认为视频费用估算的 10%%")
+    parser.add_argument("--spend-limit", type=float, help="每次运行的花费上限(元)（同 cli.py run --spend-limit）")
+    parser.add_argument("--tail-ratio", type=float, default=0.0, help="生成时间变为 --tail-factor 倍的海螺任务比例")
+    parser.add_argument("--tail-factor", type=float, default=TAIL_FACTOR, help="长尾海螺任务的生成时间倍数")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"逗号分隔的阶段，可选: {','.join(STAGES)}")
+    parser.add_argument("--repeat", type=int, default=1, help="每组参数重复次数")
+    parser.add_argument("--character-ratio", type=float, default=0.6, help="角色出镜（需要首帧）的分镜比例")
+    parser.add_argument("--sing-ratio", type=float, default=0.1, help="唱歌（需要对口型）的分镜比例")
+    parser.add_argument("--long-ratio", type=float, default=0.3, help="10s 分镜的比例")
+    parser.add_argument("--latency", action="append", default=[], metavar="KEY=SECONDS",
+                        help=f"覆盖合成延迟，可重复指定，键: {','.join(LATENCY)}")
+    parser.add_argument("--slots", action="append", default=[], metavar="PROVIDER=N",
+                        help=f"覆盖服务商并发上限，可重复指定，键: {','.join(SLOTS)}")
+    parser.add_argument("--image-kb", type=int, default=512, help="模拟图片大小(KB)")
+    parser.add_argument("--video-kb", type=int, default=2048, help="模拟视频大小(KB)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=3600, help="单次运行的超时(秒)")
+    parser.add_argument("--stage-timeout", action="append", default=[], metavar="STAGE=SECONDS",
+                        help="流水线各阶段的时限（同 cli.py run --timeout），用于观察超时阶段的释放")
+    parser.add_argument("-o", "--output", help="结果 JSON 路径，默认 benchmarks/bench_<版本>_<时间>.json")
+    parser.add_argument("--baseline", help="与之前的结果 JSON 对比")
+    # 内部使用: 子进程执行单次运行
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        config = json.loads(Path(args.run_one).read_text(encoding="utf-8"))
+        result = run_once(config)
+        Path(args.result).write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+        return 0
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        print(f"未知阶段: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    from deadline import parse_timeouts
+
+    result = run_sweep(
+        shot_counts=_number_list(args.shots, int),
+        worker_counts=_number_list(args.workers, int),
+        poll_intervals=_number_list(args.poll),
+        hailuo_modes=[m.strip() for m in args.hailuo_mode.split(",") if m.strip()],
+        stages=stages,
+        repeat=args.repeat,
+        character_ratio=args.character_ratio,
+        sing_ratio=args.sing_ratio,
+        long_ratio=args.long_ratio,
+        latency=_overrides(args.latency),
+        slots=_overrides(args.slots, int),
+        image_kb=args.image_kb,
+        video_kb=args.video_kb,
+        seed=args.seed,
+        timeout=args.timeout,
+        stage_timeouts=parse_timeouts(args.stage_timeout),
+        hedges=_hedge_list(args.hedge),
+        hedge_budget=args.hedge_budget,
+        tail_ratio=args.tail_ratio,
+        tail_factor=args.tail_factor,
+        spend_limit=args.spend_limit,
+    )
+    if args.baseline:
+        result["comparison"] = {
+            "baseline": args.baseline,
+            "baseline_version": json.loads(Path(args.baseline).read_text(encoding="utf-8")).get("version"),
+        }
+        result["comparison"]["rows"] = compare(result, json.loads(Path(args.baseline).read_text(encoding="utf-8")))
+
+    output = Path(args.output or REPO_DIR / "benchmarks" /
+                  f"bench_{result['version'] or 'unknown'}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"✅ 结果已保存: {output}", file=sys.stderr)
+    for row in result.get("comparison", {}).get("rows", []):
+        changes = {k: f"{v['change']:+.1f}%" for k, v in row.items() if isinstance(v, dict) and v["change"] is not None}
+        print(f"  shots={row['shots']} workers={row['workers']} poll={row['poll_interval']}s "
+              f"hailuo={row['hailuo_mode']} hedge={_hedge_label(row['hedge'])}: {changes}",
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+"""
+把生成阶段分发给其他机器上的工作进程
+
+原先所有任务都在 Gradio 进程的线程里执行，一台机器的网络、内存和文件描述符就是吞吐上限。
+设置了队列（cli ui --broker 或环境变量 MV_BROKER）后，任务服务（JobService）只负责排队、预算和进度，
+首帧/视频/对口型交给队列，由任意台机器上的工作进程（cli worker，见 worker.py）领取执行:
+    - 协调端把任务需要的输入（脚本、参考图、首帧、视频、音频）按内容哈希放进队列的素材区，
+      任务只携带哈希，工作进程下载后在本地执行 ShotsManager.run_job，再把结果文件放回素材区；
+    - 工作进程领取任务时拿到一个租约（默认 60 秒），执行期间定时续约；进程崩溃或失联后租约过期，
+      任务被其他工作进程重新领取（最多 MAX_ATTEMPTS 次），用固定 --worker-id 重启的工作进程会立即交回自己的任务；
+    - 协调端取消或超时的任务在下一次续约时通知工作进程放弃；
+    - 结果（含工作进程记下的真实花费）由协调端取回、存入本项目的素材存储后确认删除。
+      协调端重启时重新提交的任务会直接挂到队列里已有的同一任务上，已完成的结果不会白白重跑。
+
+Broker 是后端接口，SQLiteBroker 是基于一个目录（SQLite 数据库 + 素材文件）的实现，适合单机多进程测试，
+或放在各机器都能访问的共享目录上；其他后端用 register_backend 注册 URL 前缀后即可通过 open_broker 使用。
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import budget
+import logs
+import metrics
+from artifact_store import file_hash
+from deadline import Cancelled, DeadlineExceeded, Deadline, for_stage
+from job_service import job_key
+
+logger = logs.get_logger("broker")
+
+# 交给工作进程执行的阶段（复用类任务只是在本地存储里建引用，仍在协调端执行）
+REMOTE_STAGES = ("first_frame", "video", "lip_sync")
+# 阶段结果对应的素材类型和 Shot 上的属性
+RESULT_KINDS = {"first_frame": "image", "video": "video", "lip_sync": "lip_sync"}
+KIND_ATTRS = {"image": "image_path", "video": "video_path", "lip_sync": "lip_sync_path"}
+FINISHED = ("done", "failed", "timeout", "cancelled")
+# 默认租约时长(秒), 工作进程每隔三分之一租约续约一次
+LEASE_SECONDS = 60.0
+# 同一任务最多被领取的次数（租约过期一次算一次）
+MAX_ATTEMPTS = 3
+# 协调端查询任务状态的间隔(秒)
+POLL_INTERVAL = 1.0
+
+
+class Broker:
+    """任务队列后端接口
+
+    任务: {"key", "stage", "payload": dict, "attempt"}；状态: {"status", "worker", "attempts", "result", "error"}，
+    status 为 queued / leased / done / failed / timeout / cancelled。
+    素材以 {"sha256", "suffix"} 引用。所有方法都应可以被多个线程、多个进程同时调用。
+    """
+
+    def publish(self, key: str, stage: str, payload: Dict[str, Any]) -> None:
+        """发布任务；同一键的任务排队中、执行中或已完成但还没被确认（ack）时直接沿用它，失败或取消的重新排队"""
+        raise NotImplementedError
+
+    def lease(self, worker: str, stages: Iterable[str], lease_seconds: float = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """领取一个排队中（或租约已过期）的任务，没有时返回 None"""
+        raise NotImplementedError
+
+    def renew(self, worker: str, keys: Iterable[str], lease_seconds: float = LEASE_SECONDS) -> List[str]:
+        """为执行中的任务续约，返回应当放弃的任务键（已被取消或租约已被接管）"""
+        raise NotImplementedError
+
+    def complete(self, key: str, worker: str, status: str, result: Optional[Dict[str, Any]] = None,
+                 error: Optional[str] = None) -> bool:
+        """报告任务结果，租约已不属于该工作进程时返回 False（结果被丢弃）
+
+        协调端已经取消（不再等待）的任务直接删除，结果和其中的花费只留在工作进程的日志里。
+        """
+        raise NotImplementedError
+
+    def release_worker(self, worker: str) -> int:
+        """工作进程重启: 把它名下执行中的任务交回队列，返回任务数"""
+        raise NotImplementedError
+
+    def status(self, key: str) -> Optional[Dict[str, Any]]:
+        """任务状态，任务不存在时返回 None"""
+        raise NotImplementedError
+
+    def cancel(self, key: str, reason: str = "已取消") -> None:
+        """取消任务（协调端不再等待它）: 排队中的直接删除，执行中的在下一次续约时通知工作进程"""
+        raise NotImplementedError
+
+    def ack(self, key: str) -> None:
+        """协调端已取回结果，删除任务"""
+        raise NotImplementedError
+
+    def put_blob(self, path: str) -> Dict[str, str]:
+        """把文件放进素材区，返回 {"sha256", "suffix"}"""
+        raise NotImplementedError
+
+    def fetch_blob(self, ref: Dict[str, str], dest: str) -> str:
+        """把素材区的文件复制到 dest，返回 dest"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        """{"jobs": {状态: 数量}, "workers": {工作进程: 执行中的任务数}}"""
+        raise NotImplementedError
+
+
+class SQLiteBroker(Broker):
+    """一个目录里的 SQLite 队列 + 素材文件（<root>/broker.sqlite3, <root>/blobs/）"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS broker_jobs (
+        key TEXT PRIMARY KEY,
+        stage TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        worker TEXT,
+        lease_until REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        cancel TEXT,
+        result TEXT,
+        error TEXT,
+        queued_at REAL,
+        finished_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS broker_jobs_status ON broker_jobs (status, stage, queued_at);
+    """
+
+    def __init__(self, root: str, max_attempts: int = MAX_ATTEMPTS):
+        """
+        Args:
+            root: 队列目录，不存在时创建
+            max_attempts: 同一任务最多被领取的次数
+        """
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max_attempts
+        # 多个进程共用数据库文件, 不使用 WAL（共享目录上的 WAL 不可靠）; 本进程内的线程由 _lock 串行化
+        self._db = sqlite3.connect(str(self.root / "broker.sqlite3"), timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript(self.SCHEMA)
+
+    def _transaction(self, fn: Callable[[], Any]) -> Any:
+        """在一个写事务里执行 fn（BEGIN IMMEDIATE, 其他进程的写入在此期间等待）"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self._db.execute("COMMIT")
+                return result
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def publish(self, key: str, stage: str, payload: Dict[str, Any]) -> None:
+        def run():
+            row = self._db.execute("SELECT status FROM broker_jobs WHERE key = ?", (key,)).fetchone()
+            if row and row["status"] in ("queued", "leased", "done"):
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO broker_jobs (key, stage, payload, status, queued_at) "
+                "VALUES (?, ?, ?, 'queued', ?)",
+                (key, stage, json.dumps(payload, ensure_ascii=False), time.time()))
+        self._transaction(run)
+
+    def lease(self, worker: str, stages: Iterable[str], lease_seconds: float = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        stages = list(stages)
+        marks = ",".join("?" * len(stages))
+
+        def run():
+            now = time.time()
+            while True:
+                row = self._db.execute(
+                    f"SELECT * FROM broker_jobs WHERE stage IN ({marks}) AND "
+                    f"(status = 'queued' OR (status = 'leased' AND lease_until < ?)) "
+                    f"ORDER BY queued_at LIMIT 1", (*stages, now)).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == "leased":
+                    # 上一个工作进程失联
+                    metrics.BROKER_REDISPATCHED.inc(stage=row["stage"])
+                    if row["cancel"]:
+                        # 协调端已经不再等待
+                        self._db.execute("DELETE FROM broker_jobs WHERE key = ?", (row["key"],))
+                        continue
+                    if row["attempts"] >= self.max_attempts:
+                        self._db.execute(
+                            "UPDATE broker_jobs SET status = 'failed', error = ?, worker = NULL, finished_at = ? "
+                            "WHERE key = ?",
+                            (f"工作进程 {row['worker']} 失联, 已重试 {row['attempts']} 次", now, row["key"]))
+                        continue
+                    logger.warning("♻️ 工作进程 %s 的租约已过期, 任务 %s 重新派发", row["worker"], row["key"])
+                self._db.execute(
+                    "UPDATE broker_jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE key = ?", (worker, now + lease_seconds, row["key"]))
+                return {"key": row["key"], "stage": row["stage"], "payload": json.loads(row["payload"]),
+                        "attempt": row["attempts"] + 1}
+        return self._transaction(run)
+
+    def renew(self, worker: str, keys: Iterable[str], lease_seconds: float = LEASE_SECONDS) -> List[str]:
+        keys = list(keys)
+        if not keys:
+            return []
+
+        def run():
+            lost = []
+            until = time.time() + lease_seconds
+            for key in keys:
+                row = self._db.execute("SELECT status, worker, cancel FROM broker_jobs WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is None or row["status"] != "leased" or row["worker"] != worker or row["cancel"]:
+                    lost.append(key)
+                    continue
+                self._db.execute("UPDATE broker_jobs SET lease_until = ? WHERE key = ?", (until, key))
+            return lost
+        return self._transaction(run)
+
+    def complete(self, key: str, worker: str, status: str, result: Optional[Dict[str, Any]] = None,
+                 error: Optional[str] = None) -> bool:
+        if status not in FINISHED:
+            raise ValueError(f"未知的任务状态: {status}")
+        def run():
+            row = self._db.execute("SELECT status, worker, cancel FROM broker_jobs WHERE key = ?", (key,)).fetchone()
+            if row is None or row["status"] != "leased" or row["worker"] != worker:
+                return False
+            if row["cancel"]:
+                self._db.execute("DELETE FROM broker_jobs WHERE key = ?", (key,))
+                return True
+            self._db.execute(
+                "UPDATE broker_jobs SET status = ?, result = ?, error = ?, lease_until = NULL, finished_at = ? "
+                "WHERE key = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                 time.time(), key))
+            return True
+        return self._transaction(run)
+
+    def release_worker(self, worker: str) -> int:
+        def run():
+            # 协调端已取消的任务没有人在等, 直接删除
+            cancelled = self._db.execute(
+                "DELETE FROM broker_jobs WHERE status = 'leased' AND worker = ? AND cancel IS NOT NULL",
+                (worker,)).rowcount
+            return cancelled + self._db.execute(
+                "UPDATE broker_jobs SET status = 'queued', worker = NULL, lease_until = NULL "
+                "WHERE status = 'leased' AND worker = ?", (worker,)).rowcount
+        return self._transaction(run)
+
+    def status(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, worker, attempts, result, error FROM broker_jobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {**dict(row), "result": json.loads(row["result"]) if row["result"] else None}
+
+    def cancel(self, key: str, reason: str = "已取消") -> None:
+        def run():
+            # 协调端不再等待: 排队中的直接删除, 执行中的由工作进程在放弃后删除（见 complete）
+            self._db.execute("DELETE FROM broker_jobs WHERE key = ? AND status = 'queued'", (key,))
+            self._db.execute("UPDATE broker_jobs SET cancel = ? WHERE key = ? AND status = 'leased'", (reason, key))
+        self._transaction(run)
+
+    def ack(self, key: str) -> None:
+        self._transaction(lambda: self._db.execute("DELETE FROM broker_jobs WHERE key = ?", (key,)))
+
+    def _blob_path(self, ref: Dict[str, str]) -> Path:
+        digest = ref["sha256"]
+        return self.blob_dir / digest[:2] / f"{digest}{ref['suffix']}"
+
+    def put_blob(self, path: str) -> Dict[str, str]:
+        ref = {"sha256": file_hash(path), "suffix": Path(path).suffix.lower()}
+        target = self._blob_path(ref)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp = target.with_name(f".{uuid.uuid4().hex}.tmp")
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+        return ref
+
+    def fetch_blob(self, ref: Dict[str, str], dest: str) -> str:
+        source = self._blob_path(ref)
+        if not source.exists():
+            raise FileNotFoundError(f"队列素材区中没有 {ref['sha256']}{ref['suffix']}")
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, dest)
+        return dest
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = {r["status"]: r["n"] for r in self._db.execute(
+                "SELECT status, COUNT(*) AS n FROM broker_jobs GROUP BY status")}
+            workers = {r["worker"]: r["n"] for r in self._db.execute(
+                "SELECT worker, COUNT(*) AS n FROM broker_jobs WHERE status = 'leased' GROUP BY worker")}
+        return {"jobs": jobs, "workers": workers}
+
+
+# URL 前缀 -> 创建后端的函数 fn(地址)
+BACKENDS: Dict[str, Callable[[str], Broker]] = {"sqlite": SQLiteBroker}
+
+
+def register_backend(scheme: str, factory: Callable[[str], Broker]) -> None:
+    """注册队列后端，之后 open_broker("<scheme>://<地址>") 即用 factory(地址) 创建"""
+    BACKENDS[scheme] = factory
+
+
+def open_broker(url: str) -> Broker:
+    """按 URL 打开队列: "sqlite:///共享目录" 或直接给出目录（即 SQLiteBroker）"""
+    scheme, sep, address = url.partition("://")
+    if not sep:
+        return SQLiteBroker(url)
+    if scheme not in BACKENDS:
+        raise ValueError(f"未知的队列后端: {scheme}（可选: {', '.join(BACKENDS)}）")
+    return BACKENDS[scheme](address)
+
+
+class RemoteRunner:
+    """任务服务的 runner: 把生成阶段发布到队列并等待工作进程完成（签名与 ShotsManager.run_job 相同）"""
+
+    def __init__(self, broker: Broker, manager, project: Optional[str] = None):
+        """
+        Args:
+            broker: 任务队列
+            manager: 本项目的 ShotsManager（提供分镜、脚本和素材存储）
+            project: 任务键的前缀，多个项目共用一个队列时区分彼此，默认取输出目录名
+        """
+        self.broker = broker
+        self.manager = manager
+        self.project = project or manager.output_dir.resolve().name
+        self._script: Optional[tuple] = None
+
+    def _script_ref(self) -> Dict[str, str]:
+        """脚本的素材引用（脚本修改后重新上传）"""
+        mtime = os.path.getmtime(self.manager.json_path)
+        if self._script is None or self._script[0] != mtime:
+            self._script = (mtime, self.broker.put_blob(str(self.manager.json_path)))
+        return self._script[1]
+
+    def _inputs(self, stage: str, shot, params: Dict[str, Any]) -> Dict[str, Dict[str, str]]:
+        """本阶段需要带给工作进程的输入文件"""
+        inputs = {}
+        if stage == "first_frame":
+            reference = params.get("reference_dir") or self.manager.reference_pic_dir
+            if reference:
+                inputs["reference"] = self.broker.put_blob(reference)
+        elif stage == "video":
+            if params.get("use_image") and shot.image_path:
+                inputs["image"] = self.broker.put_blob(shot.image_path)
+        elif stage == "lip_sync":
+            if not shot.video_path:
+                raise ValueError("本shot没有要对口型的视频!")
+            inputs["video"] = self.broker.put_blob(shot.video_path)
+            inputs["audio"] = self.broker.put_blob(params["audio_path"])
+        return inputs
+
+    def __call__(self, stage: str, shot_index: int, params: Dict[str, Any],
+                 deadline: Optional[Deadline] = None) -> Optional[str]:
+        if stage not in REMOTE_STAGES:
+            return self.manager.run_job(stage, shot_index, params, deadline=deadline)
+        deadline = deadline or for_stage(stage)
+        shot = self.manager.shots[shot_index]
+        key = f"{self.project}:{job_key(shot.id, stage, params)}"
+        self.broker.publish(key, stage, {
+            "project": self.project,
+            "script": self._script_ref(),
+            "shot_index": shot_index,
+            "shot_id": shot.id,
+            "params": {k: v for k, v in params.items() if k not in ("reference_dir", "audio_path")},
+            "inputs": self._inputs(stage, shot, params),
+            "timeout": deadline.remaining(),
+        })
+        try:
+            while True:
+                state = self.broker.status(key)
+                if state is None:
+                    raise RuntimeError(f"任务 {key} 已从队列中消失")
+                if state["status"] in FINISHED:
+                    break
+                deadline.sleep(POLL_INTERVAL)
+        except Cancelled as e:
+            self.broker.cancel(key, str(e))
+            raise
+        try:
+            result = state["result"] or {}
+            # 工作进程的真实花费记到本地预算上（包括失败前已经提交的付费请求）
+            budget.charge(result.get("spent", 0.0))
+            if state["status"] == "done":
+                return self._import(shot, stage, result, state["worker"])
+            error = f"工作进程 {state['worker'] or '-'}: {state['error']}"
+            if state["status"] == "timeout":
+                raise DeadlineExceeded(error)
+            if state["status"] == "cancelled":
+                raise Cancelled(error)
+            raise RuntimeError(error)
+        finally:
+            self.broker.ack(key)
+
+    def _import(self, shot, stage: str, result: Dict[str, Any], worker: Optional[str]) -> str:
+        """把工作进程的结果存入本项目的素材存储并设为分镜的当前版本"""
+        kind = RESULT_KINDS[stage]
+        tmp_path = self.manager.store.temp_path(result["suffix"])
+        try:
+            self.broker.fetch_blob(result, tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        path = self.manager.store.put(shot.owner, kind, tmp_path, {**result.get("meta", {}), "worker": worker})
+        setattr(shot, KIND_ATTRS[kind], path)
+        logger.info("📥 Shot %s: 已取回工作进程 %s 的%s结果 %s", shot.id, worker, stage, path)
+        return path
@@ -0,0 +1,178 @@
+"""
+按花费上限调度生成任务
+
+原先费用只在批量按钮上估一个价（首帧 ¥0.2，6s/10s 片段 ¥2/¥4），点下去之后花多少就是多少。
+这里把同一套费用模型（Shot.IMAGE_COST / VIDEO_COST）变成调度约束:
+    - 一次运行（cli run 或界面的任务服务）有一个花费上限 Budget；
+    - 调度器派发付费任务前按费用模型预留预估费用，放不下时暂停派发（任务留在队列里），不会超支；
+    - 真实花费在付费请求成功提交的地方记账（charge），按阶段累计，对冲、长镜头的多个片段都会如实计入；
+      任务结束后没用完的预留退回；
+    - 花费、预留和剩余额度通过 report() 和 /metrics（mv_budget_*）实时可见。
+
+记账通过上下文变量找到当前任务所属的 Budget（见 charging），客户端和 Shot 不需要知道预算的存在。
+"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import logs
+import metrics
+
+logger = logs.get_logger("budget")
+
+# 当前线程的记账目标: (预算, 阶段, 任务键)
+_ledger: ContextVar[Optional[Tuple["Budget", str, Optional[str]]]] = ContextVar("mv_budget_ledger", default=None)
+
+
+class BudgetExceeded(RuntimeError):
+    """任务的预估费用超过了剩余额度"""
+
+
+class Budget:
+    """一次运行的花费上限（线程安全）"""
+
+    def __init__(self, limit: Optional[float] = None, spent: Optional[Dict[str, float]] = None,
+                 on_charge: Optional[Callable[[str, float, Optional[str]], None]] = None):
+        """
+        Args:
+            limit: 花费上限（元），None 表示不限（仍然记账）
+            spent: 已有的各阶段花费
+            on_charge: 每次记账后的回调 fn(阶段, 金额, 任务键)，例如写入数据库
+        """
+        self.limit = limit
+        self.by_stage: Dict[str, float] = dict(spent or {})
+        self.on_charge = on_charge
+        # 任务键 -> 还没被真实花费抵掉的预留
+        self._reserved: Dict[str, float] = {}
+        # 调度器因额度不足暂停派发时的原因
+        self.paused: Optional[str] = None
+        self._lock = threading.Lock()
+        self._publish()
+
+    @property
+    def spent(self) -> float:
+        return sum(self.by_stage.values())
+
+    @property
+    def reserved(self) -> float:
+        return sum(self._reserved.values())
+
+    def remaining(self) -> Optional[float]:
+        """上限减去已花费和预留，不限额时返回 None"""
+        if self.limit is None:
+            return None
+        with self._lock:
+            return self.limit - self.spent - self.reserved
+
+    def set_limit(self, limit: Optional[float]) -> None:
+        """调整上限（提高上限后调度器会继续派发暂停的任务）"""
+        with self._lock:
+            self.limit = limit
+            self.paused = None
+        logger.info("💰 花费上限调整为 %s", "不限" if limit is None else f"¥{limit:g}")
+        self._publish()
+
+    def reset(self) -> None:
+        """从零开始重新计算花费（执行中任务的预留保留）"""
+        with self._lock:
+            self.by_stage = {stage: 0.0 for stage in self.by_stage}
+            self.paused = None
+        logger.info("💰 花费已清零, 重新开始计算")
+        self._publish()
+
+    def affordable(self, amount: float) -> bool:
+        remaining = self.remaining()
+        return remaining is None or amount <= remaining + 1e-9
+
+    def reserve(self, key: str, amount: float) -> bool:
+        """为即将派发的任务预留预估费用，剩余额度不够时返回 False（不预留）"""
+        with self._lock:
+            if self.limit is not None and self.spent + self.reserved + amount > self.limit + 1e-9:
+                return False
+            if amount > 0:
+                self._reserved[key] = self._reserved.get(key, 0.0) + amount
+        self._publish()
+        return True
+
+    def release(self, key: str) -> None:
+        """任务结束，退回没用完的预留"""
+        with self._lock:
+            self._reserved.pop(key, None)
+        self._publish()
+
+    def pause(self, reason: str) -> None:
+        """记录调度器暂停派发（只在状态变化时输出日志）"""
+        with self._lock:
+            changed, self.paused = self.paused != reason, reason
+        if changed:
+            logger.warning("⏸️ %s", reason)
+
+    def resume(self) -> None:
+        with self._lock:
+            self.paused = None
+
+    def record(self, stage: str, amount: float, key: Optional[str] = None) -> None:
+        """记一笔真实花费，先抵掉该任务的预留"""
+        with self._lock:
+            self.by_stage[stage] = self.by_stage.get(stage, 0.0) + amount
+            if key in self._reserved:
+                left = self._reserved[key] - amount
+                if left > 0:
+                    self._reserved[key] = left
+                else:
+                    del self._reserved[key]
+        if self.on_charge:
+            self.on_charge(stage, amount, key)
+        self._publish()
+
+    def _publish(self) -> None:
+        with self._lock:
+            by_stage = dict(self.by_stage)
+            remaining = None if self.limit is None else self.limit - self.spent - self.reserved
+            reserved = self.reserved
+        for stage, amount in by_stage.items():
+            metrics.BUDGET_SPENT.set(amount, stage=stage)
+        metrics.BUDGET_RESERVED.set(reserved)
+        if remaining is not None:
+            metrics.BUDGET_REMAINING.set(remaining)
+
+    def report(self) -> Dict[str, Any]:
+        """{"limit", "spent", "reserved", "remaining", "by_stage", "paused"}"""
+        with self._lock:
+            spent, reserved = self.spent, self.reserved
+            return {
+                "limit": self.limit,
+                "spent": round(spent, 2),
+                "reserved": round(reserved, 2),
+                "remaining": None if self.limit is None else round(self.limit - spent - reserved, 2),
+                "by_stage": {stage: round(amount, 2) for stage, amount in self.by_stage.items()},
+                "paused": self.paused,
+            }
+
+
+@contextmanager
+def charging(budget: Optional[Budget], stage: str, key: Optional[str] = None) -> Iterator[None]:
+    """在 with 块内把 charge 记到 budget 的 stage 阶段（budget 为 None 时什么也不做）"""
+    if budget is None:
+        yield
+        return
+    token = _ledger.set((budget, stage, key))
+    try:
+        yield
+    finally:
+        _ledger.reset(token)
+
+
+def current() -> Optional[Budget]:
+    """当前线程记账的预算"""
+    ledger = _ledger.get()
+    return ledger[0] if ledger else None
+
+
+def charge(amount: float) -> None:
+    """付费请求已被服务商接受，记一笔花费（不在任何预算下执行时忽略）"""
+    ledger = _ledger.get()
+    if ledger is not None and amount:
+        budget, stage, key = ledger
+        budget.record(stage, amount, key)
@@ -1,7 +1,16 @@
-import datetime
+import os
+import shutil
 from pathlib import Path
-from typing import Optional
-from SeedreamImageGenerator import SeedreamImageGenerator 
+from typing import Optional, TYPE_CHECKING
+
+import logs
+from artifact_store import ArtifactStore
+from deadline import Cancelled, Deadline, for_stage
+
+logger = logs.get_logger("character")
+
+if TYPE_CHECKING:
+    from SeedreamImageGenerator import SeedreamImageGenerator
 
 class CharacterReference:
     """
@@ -17,12 +26,15 @@ class CharacterReference:
     """
     # 默认的保存地址
     DEFAULT_OUTPUT_DIR = "outputs"
+    # 在素材存储中的记录名
+    OWNER = "character"
     
     def __init__(
         self, 
-        seedream_client: SeedreamImageGenerator, 
+        seedream_client: "SeedreamImageGenerator", 
         character_config: str, 
-        output_dir: str = DEFAULT_OUTPUT_DIR
+        output_dir: str = DEFAULT_OUTPUT_DIR,
+        store: Optional[ArtifactStore] = None
     ) -> None:
         """
         初始化角色参考生成器
@@ -31,6 +43,7 @@ class CharacterReference:
             seedream_client: Seedream图像生成客户端实例
             character_config: 角色描述配置文本
             output_dir: 图像输出目录，默认为'outputs'
+            store: 素材存储，为 None 时在 output_dir 下单独创建
             
         Raises:
             ValueError: 当必需参数为None或空时
@@ -38,15 +51,15 @@ class CharacterReference:
         # 基本设置
         self.description = character_config
         
-        # 保存地址设置
+        # 保存地址设置（首次生成时才创建目录）
         self.output_dir = Path(output_dir)
-        self._initialize_output_directory()
+        self.store = store or ArtifactStore(output_dir)
 
         # API 客户端
         self.seedream = seedream_client
 
-        # 中间结果
-        self.image_path: Optional[str] = None
+        # 中间结果（从素材存储中恢复上次的参考图）
+        self.image_path: Optional[str] = self.store.current(self.OWNER, "reference")
         
     def _initialize_output_directory(self) -> None:
         """创建输出目录，确保目录存在[8](@ref)"""
@@ -57,41 +70,57 @@ class CharacterReference:
         except OSError as e:
             raise OSError(f"创建输出目录失败: {e}") from e
         
-    def _generate_filename(self) -> str:
-        """生成基于时间戳的唯一文件名[8](@ref)"""
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        return f"character_reference_{timestamp}.png"
+    def _export(self, path: str, filename: str) -> None:
+        """在输出目录下以指定文件名放一份参考图（优先硬链接）"""
+        self._initialize_output_directory()
+        tmp = self.store.temp_path(Path(filename).suffix)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, self.output_dir / filename)
     
-    def generate_image(self, prompt: Optional[str] = None, filename: Optional[str] = None) -> str:
+    def generate_image(self, prompt: Optional[str] = None, filename: Optional[str] = None,
+                       deadline: Optional[Deadline] = None) -> str:
         """
         生成角色参考图像
         
         Args:
             prompt: 生成提示词，如为None则使用角色描述
-            filename: 输出文件名，如为None则自动生成
+            filename: 额外在输出目录下保存的文件名，如为None则只保存在素材存储中
+            deadline: 截止时间/取消令牌，默认按 "reference" 阶段的时限
             
         Returns:
             生成的图像文件路径
             
         Raises:
             RuntimeError: 图像生成或保存失败时
+            DeadlineExceeded / Cancelled: 超过时限或被取消时
         """
+        deadline = deadline or for_stage("reference")
         final_prompt = prompt or self.description
-        final_filename = filename or self._generate_filename()
-        save_path = str(self.output_dir / final_filename)
+        tmp_path = self.store.temp_path(".png")
         
         try:
             # 调用API生成图像[1](@ref)
-            image_url = self.seedream.generate_image(prompt=final_prompt, size='2K')
+            image_url = self.seedream.generate_image(prompt=final_prompt, size='2K', deadline=deadline)
             
             # 保存图像到本地
-            self.seedream.save_image_from_url(image_url, save_path)
+            self.seedream.save_image_from_url(image_url, tmp_path, deadline=deadline)
+            save_path = self.store.put(self.OWNER, "reference", tmp_path, {"prompt": final_prompt})
+            if filename:
+                self._export(save_path, filename)
             self.image_path = save_path
             
-            print(f"✅ 角色参考图已保存: {save_path}")
+            logger.info("✅ 角色参考图已保存: %s", save_path)
             return save_path
             
         except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, Cancelled):
+                logger.warning("⏰ 角色参考图未完成: %s", e)
+                raise
             error_msg = f"生成角色参考图失败: {str(e)}"
-            print(f"❌ {error_msg}")
+            logger.error("❌ %s", error_msg)
             raise RuntimeError(error_msg) from e
\ No newline at end of file
@@ -0,0 +1,983 @@
+"""
+MV 批量生成的命令行入口（不依赖 Gradio）
+
+示例:
+    python cli.py validate shots.json
+    python cli.py list shots.json
+    python cli.py align shots.json --audio song.mp3 --write
+    python cli.py dedup shots.json
+    python cli.py gc shots.json -o output_final --budget 20G --dry-run
+    python cli.py run shots.json -o output_final --audio song.mp3 \
+        --seedream-workers 10 --hailuo-workers 10 --comfyui-workers 1
+    python cli.py multi projects.json --hailuo-workers 20
+    python cli.py worker --broker /mnt/mv-queue --stages lip_sync --concurrency 1
+
+进度逐行输出到 stderr，结束后把机器可读的 JSON 汇总输出到 stdout
+（或 --summary 指定的文件），退出码: 0 全部成功，1 存在失败、超时或被取消的分镜。
+每个阶段有时限（--timeout 阶段=秒数），Ctrl-C 取消所有执行中的阶段后照常输出汇总。
+--hedge-percentile 打开海螺长尾任务的对冲重投，额外花费受 --hedge-budget 限制。
+--spend-limit 给整次运行设花费上限: 放不下的分镜不再开始（记为 paused），从未生成过的分镜先于重新生成的分镜执行。
+worker 从任务队列（ui --broker）领取生成阶段在本机执行，见 broker.py / worker.py。
+multi 在一个进程里同时执行多个项目，服务商并发上限由所有项目共享，按项目权重公平调度（见 projects.py）。
+"""
+import time
+
+# 启动计时从导入开始, list/validate 会报告耗时是否超出启动预算
+_STARTED = time.perf_counter()
+
+import argparse
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import logs
+import metrics
+import tracing
+from budget import Budget, BudgetExceeded, charging
+from deadline import STAGE_TIMEOUTS, Cancelled, Deadline, for_stage, parse_timeouts
+from hedging import DEFAULT_BUDGET_RATIO, MIN_SAMPLES, HedgePolicy
+from shots_manager import ShotsManager
+
+# list/validate 这类只读命令的启动预算(秒), 不应触发任何 SDK 或 Gradio 导入
+STARTUP_BUDGET = 0.5
+
+
+class BatchRunner:
+    """按分镜流水线执行 首帧 -> 视频 -> 对口型，每个服务商有独立的并发上限"""
+    STAGES = ("reference", "first_frame", "video", "lip_sync", "assemble")
+    # 各服务商的默认并发数
+    DEFAULT_WORKERS = {"seedream": 10, "hailuo": 10, "comfyui": 1}
+
+    def __init__(self,
+                 manager: ShotsManager,
+                 stages: Optional[List[str]] = None,
+                 audio_path: Optional[str] = None,
+                 reference_path: Optional[str] = None,
+                 workers: Optional[Dict[str, int]] = None,
+                 json_progress: bool = False,
+                 preview: bool = False,
+                 dedup: bool = True,
+                 gc_budget: Optional[int] = None,
+                 trace_path: Optional[str] = None,
+                 timeouts: Optional[Dict[str, Optional[float]]] = None,
+                 hedge: Optional[HedgePolicy] = None,
+                 spend_limit: Optional[float] = None,
+                 executors: Optional[Dict[str, Any]] = None,
+                 name: Optional[str] = None,
+                 stream=sys.stderr):
+        """初始化批量执行器
+
+        Args:
+            manager: 已加载脚本的 ShotsManager
+            stages: 需要执行的阶段，默认全部
+            audio_path: 对口型使用的整首歌音频，为 None 时跳过对口型
+            reference_path: 已有的角色参考图，提供后不再重新生成
+            workers: 各服务商的并发数 {"seedream": n, "hailuo": n, "comfyui": n}
+            json_progress: 进度是否以 JSON 行输出
+            preview: 是否在生成过程中维护实时预览播放列表
+            dedup: 重复分镜是否复用代表分镜的首帧和视频（按簇关闭见 ShotsManager.set_cluster_reuse）
+            gc_budget: 素材磁盘预算（字节），提供后在生成过程中后台回收旧素材
+            trace_path: 本次运行的 Chrome trace 输出路径，默认 <输出目录>/trace.json
+            timeouts: 各阶段的时限(秒)，从阶段开始执行时算起，默认 manager.stage_timeouts
+            hedge: 海螺长尾任务的对冲策略（本批次专用），为 None 时不对冲
+            spend_limit: 本次运行的花费上限（元），None 为不限（仍然记账）
+            executors: 外部提供的各服务商执行器（例如多项目共享的 FairScheduler 通道），此时 workers 不再生效
+            name: 项目名，多个项目共用进度输出时写进每条进度和日志
+            stream: 进度输出流
+        """
+        self.manager = manager
+        self.stages = list(stages or self.STAGES)
+        self.audio_path = audio_path
+        self.reference_path = reference_path
+        self.workers = {**self.DEFAULT_WORKERS, **(workers or {})}
+        self.json_progress = json_progress
+        self.preview = manager.preview(audio_path) if preview else None
+        self.dedup = dedup
+        self.gc = manager.garbage_collector(budget_bytes=gc_budget) if gc_budget is not None else None
+        self.trace_path = trace_path or str(manager.output_dir / "trace.json")
+        self.timeouts = {**manager.stage_timeouts, **(timeouts or {})}
+        self.hedge = hedge
+        self.budget = Budget(spend_limit)
+        self.name = name
+        self.stream = stream
+        self._shared_executors = executors
+        # 整次运行的取消令牌, 各阶段的 Deadline 都是它的子令牌
+        self.token = Deadline(name="batch")
+
+        self._lock = threading.Lock()
+        self._all_done = threading.Event()
+        self._pending = 0
+        self._executors: Dict[str, Any] = {}
+        self.records: Dict[int, Dict[str, Any]] = {}
+        # 代表分镜下标 -> 等待复用其素材的重复分镜下标
+        self._followers: Dict[int, List[int]] = {}
+        # 已经预留过流水线费用的分镜下标
+        self._reserved: set = set()
+
+    def cancel(self, reason: str = "已取消") -> None:
+        """取消整次运行: 执行中的阶段在下一次请求或等待时放弃，尚未开始的阶段直接记为 cancelled"""
+        self.token.cancel(reason)
+        self._emit("run.cancelled", reason=reason)
+
+    def _emit(self, event: str, **fields) -> None:
+        """输出一条进度信息"""
+        if self.name:
+            fields = {"project": self.name, **fields}
+        with self._lock:
+            if self.json_progress:
+                line = json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False)
+            else:
+                detail = " ".join(f"{k}={v}" for k, v in fields.items())
+                line = f"[{time.strftime('%H:%M:%S')}] {event} {detail}"
+            print(line, file=self.stream, flush=True)
+
+    def _record_stage(self, index: int, stage: str, status: str,
+                      started: float, path: Optional[str] = None,
+                      cost: float = 0.0, error: Optional[str] = None) -> None:
+        """记录某个分镜某个阶段的执行结果"""
+        entry = {"status": status, "duration": round(time.perf_counter() - started, 3), "cost": cost}
+        metrics.STAGE_SECONDS.observe(entry["duration"], stage=stage)
+        metrics.JOBS_TOTAL.inc(stage=stage, status="done" if status == "success" else status)
+        if path:
+            entry["path"] = str(path)
+        if error:
+            entry["error"] = error
+        with self._lock:
+            self.records[index]["stages"][stage] = entry
+        shot_id = self.records[index]["id"]
+        self._emit(f"{stage}.{status}", shot=shot_id, duration=entry["duration"], **({"error": error} if error else {}))
+
+    def _run_stage(self, index: int, stage: str, func, cost: float, then=None) -> None:
+        """向对应服务商的线程池提交阶段任务，完成后进入下一阶段
+
+        func 接收该阶段的 Deadline；超时或被取消的阶段记为 timeout / cancelled，流水线就此结束。
+        分镜的第一个付费阶段开始时为整条流水线预留费用（见 _reserve_shot），放不下时记为 paused。
+        """
+        provider = {"first_frame": "seedream", "video": "hailuo", "lip_sync": "comfyui"}[stage]
+        started = time.perf_counter()
+        self._emit(f"{stage}.submitted", shot=self.records[index]["id"])
+
+        def done(future):
+            ok = False
+            try:
+                try:
+                    path = future.result()
+                except Cancelled as e:
+                    self._record_stage(index, stage, e.reason, started, error=str(e))
+                except BudgetExceeded as e:
+                    self._record_stage(index, stage, "paused", started, error=str(e))
+                except Exception as e:
+                    self._record_stage(index, stage, "failed", started, error=str(e))
+                else:
+                    self._record_stage(index, stage, "success", started, path=path, cost=cost)
+                    ok = True
+                if ok and then:
+                    then(index)
+                    return
+            except Exception as e:
+                # Future 会吞掉回调里的异常, 分镜不结束的话 run() 会一直等下去
+                try:
+                    self._record_stage(index, stage, "failed", started, cost=cost if ok else 0.0,
+                                       error=f"阶段回调出错: {e}")
+                except Exception:
+                    pass
+            self._finish_shot(index)
+
+        def traced_call():
+            # 在服务商线程池里排队等待的时间记在阶段 span 上
+            waited = round(time.perf_counter() - started, 3)
+            shot_id = self.records[index]["id"]
+            # 时限从阶段开始执行时算起, 在线程池里排队的时间不计入
+            deadline = for_stage(stage, parent=self.token, timeouts=self.timeouts)
+            with logs.context(shot=shot_id, stage=stage), \
+                    charging(self.budget, stage, f"shot:{index}"), \
+                    tracing.span(f"stage.{stage}", shot=shot_id, stage=stage, provider=provider, waited=waited):
+                deadline.check()
+                if cost:
+                    self._reserve_shot(index)
+                return func(deadline)
+
+        try:
+            future = self._executors[provider].submit(traced_call)
+        except Exception as e:
+            # 线程池已关闭（例如 FairScheduler 已停止）
+            self._record_stage(index, stage, "failed", started, error=f"无法提交: {e}")
+            self._finish_shot(index)
+            return
+        future.add_done_callback(done)
+
+    def _shot_cost(self, index: int) -> float:
+        """按费用模型估算一个分镜在所选阶段里的花费"""
+        shot = self.manager.shots[index]
+        cost = shot.IMAGE_COST if "first_frame" in self.stages and shot.character_in_scene else 0.0
+        if "video" in self.stages:
+            cost += shot.estimate_video_cost()
+        return cost
+
+    def _is_rerun(self, index: int) -> bool:
+        """分镜是否已有所选阶段的素材（重新生成的价值低于从未生成过的分镜）"""
+        shot = self.manager.shots[index]
+        if "video" in self.stages:
+            return bool(shot.video_path)
+        return "first_frame" in self.stages and bool(shot.image_path)
+
+    def _reserve_shot(self, index: int) -> None:
+        """为分镜的整条流水线预留费用（只在第一个付费阶段预留一次），避免只生成了首帧就没钱生成视频
+
+        一旦有分镜放不下就停止开始新的付费分镜，已经开始的分镜照常完成。
+        """
+        key = f"shot:{index}"
+        with self._lock:
+            if index in self._reserved:
+                return
+            self._reserved.add(index)
+        cost = self._shot_cost(index)
+        if self.budget.paused or not self.budget.reserve(key, cost):
+            reason = self.budget.paused or (f"花费上限不足: 预计 ¥{cost:g}, 剩余 ¥{self.budget.remaining():.2f}")
+            if not self.budget.paused:
+                self.budget.pause(reason)
+                self._emit("budget.paused", **self.budget.report())
+            raise BudgetExceeded(reason)
+
+    def _skip_stage(self, index: int, stage: str, reason: str) -> None:
+        with self._lock:
+            self.records[index]["stages"][stage] = {"status": "skipped", "reason": reason}
+
+    def _start_first_frame(self, index: int) -> None:
+        shot = self.manager.shots[index]
+        if "first_frame" not in self.stages or not shot.character_in_scene:
+            self._skip_stage(index, "first_frame", "无角色" if not shot.character_in_scene else "未选择该阶段")
+            return self._start_video(index)
+        self._run_stage(
+            index, "first_frame",
+            lambda deadline: self.manager.generate_first_frame(
+                shot_index=index,
+                reference_dir=self.manager.reference_pic_dir,
+                prompt=self.manager.prompts[index]["pic"],
+                deadline=deadline),
+            cost=shot.IMAGE_COST,
+            then=self._start_video,
+        )
+
+    def _start_video(self, index: int) -> None:
+        shot = self.manager.shots[index]
+        if "video" not in self.stages:
+            self._skip_stage(index, "video", "未选择该阶段")
+            return self._start_lip_sync(index)
+        self._run_stage(
+            index, "video",
+            lambda deadline: shot.generate_video(
+                prompt=self.manager.prompts[index]["vid"],
+                duration=shot.duration,
+                use_image=shot.character_in_scene,
+                deadline=deadline,
+                hedge=self.hedge),
+            cost=shot.estimate_video_cost(),
+            then=self._start_lip_sync,
+        )
+
+    def _release_followers(self, index: int, final: bool = False) -> None:
+        """代表分镜的视频结束后，让同簇的重复分镜复用它的素材
+
+        音频区间与代表分镜相同的唱歌分镜要等代表分镜整条流水线结束（final）后才能直接复用其对口型；
+        代表分镜没有生成出视频时，重复分镜退回各自单独生成。
+        """
+        shots = self.manager.shots
+        leader = shots[index]
+        with self._lock:
+            waiting = self._followers.get(index)
+            if not waiting:
+                return
+            video_ok = self.records[index]["stages"].get("video", {}).get("status") == "success"
+            window = self.manager.audio_window(index)
+            same_audio = [
+                m for m in waiting
+                if leader.sing and shots[m].sing and window is not None and self.manager.audio_window(m) == window
+            ]
+            ready = waiting if final or not video_ok else [m for m in waiting if m not in same_audio]
+            self._followers[index] = [m for m in waiting if m not in ready]
+
+        for member in ready:
+            shot = shots[member]
+            if not video_ok:
+                self._emit("reuse.fallback", shot=shot.id, leader=leader.id)
+                self._start_first_frame(member)
+                continue
+            needs_lip_sync = self.manager.reuse_from_representative(member, index)
+            reused = {"status": "reused", "from": leader.id, "cost": 0.0}
+            with self._lock:
+                stages = self.records[member]["stages"]
+                if shot.character_in_scene and shot.image_path:
+                    stages["first_frame"] = dict(reused)
+                else:
+                    stages["first_frame"] = {"status": "skipped", "reason": "无角色"}
+                stages["video"] = dict(reused)
+            self._emit("shot.reused", shot=shot.id, leader=leader.id)
+            if shot.sing and not needs_lip_sync:
+                with self._lock:
+                    self.records[member]["stages"]["lip_sync"] = dict(reused)
+                self._finish_shot(member)
+            else:
+                self._start_lip_sync(member)
+
+    def _start_lip_sync(self, index: int) -> None:
+        self._release_followers(index)
+        shot = self.manager.shots[index]
+        if "lip_sync" not in self.stages or not shot.sing:
+            self._skip_stage(index, "lip_sync", "不唱歌" if not shot.sing else "未选择该阶段")
+        elif not self.audio_path:
+            self._skip_stage(index, "lip_sync", "未提供 --audio")
+        elif not shot.video_path:
+            self._skip_stage(index, "lip_sync", "没有可对口型的视频")
+        else:
+            return self._run_stage(
+                index, "lip_sync",
+                lambda deadline: shot.video_lip_sync(audio_path=self.audio_path, deadline=deadline)[-1],
+                cost=0.0,
+            )
+        self._finish_shot(index)
+
+    def _finish_shot(self, index: int) -> None:
+        """某个分镜的流水线结束（重复调用无副作用）"""
+        with self._lock:
+            if self.records[index]["status"] != "pending":
+                return
+        self._release_followers(index, final=True)
+        with self._lock:
+            record = self.records[index]
+            if record["status"] != "pending":
+                return
+            statuses = [s["status"] for s in record["stages"].values()]
+            if "failed" in statuses:
+                record["status"] = "failed"
+            elif "timeout" in statuses:
+                record["status"] = "timeout"
+            elif "cancelled" in statuses:
+                record["status"] = "cancelled"
+            elif "paused" in statuses:
+                record["status"] = "paused"
+            elif "success" in statuses:
+                record["status"] = "success"
+            elif "reused" in statuses:
+                record["status"] = "reused"
+            else:
+                record["status"] = "skipped"
+            record["duration"] = round(sum(s.get("duration", 0) for s in record["stages"].values()), 3)
+            record["cost"] = round(sum(s.get("cost", 0) for s in record["stages"].values()), 2)
+            self._pending -= 1
+            remaining = self._pending
+        # 没用完的预留退回
+        self.budget.release(f"shot:{index}")
+        spend = {"spent": round(self.budget.spent, 2)}
+        if self.budget.limit is not None:
+            spend["budget_left"] = self.budget.report()["remaining"]
+        self._emit("shot.done", shot=record["id"], status=record["status"], remaining=remaining, **spend)
+        if self.preview:
+            self.preview.request_refresh()
+        if self.gc:
+            self.gc.request_collect()
+        if remaining == 0:
+            self._all_done.set()
+
+    def _prepare_reference(self) -> Dict[str, Any]:
+        """生成（或复用）全局角色参考图"""
+        needs_reference = "first_frame" in self.stages and any(s.character_in_scene for s in self.manager.shots)
+        if self.reference_path:
+            self.manager.reference_pic_dir = self.reference_path
+            return {"status": "skipped", "reason": "使用已有参考图", "path": self.reference_path}
+        if "reference" not in self.stages or not needs_reference:
+            return {"status": "skipped", "reason": "不需要参考图"}
+        cost = self.manager.shots[0].IMAGE_COST
+        if not self.budget.reserve("reference", cost):
+            reason = f"花费上限不足: 参考图预计 ¥{cost:g}"
+            self.budget.pause(reason)
+            self._emit("reference.paused", error=reason)
+            return {"status": "paused", "error": reason}
+        started = time.perf_counter()
+        self._emit("reference.submitted")
+        try:
+            with charging(self.budget, "reference", "reference"):
+                path = self.manager.generate_reference(
+                    deadline=for_stage("reference", parent=self.token, timeouts=self.timeouts))
+        except Cancelled as e:
+            self._emit(f"reference.{e.reason}", error=str(e))
+            return {"status": e.reason, "duration": round(time.perf_counter() - started, 3), "error": str(e)}
+        except Exception as e:
+            self._emit("reference.failed", error=str(e))
+            return {"status": "failed", "duration": round(time.perf_counter() - started, 3), "error": str(e)}
+        finally:
+            self.budget.release("reference")
+        duration = round(time.perf_counter() - started, 3)
+        self._emit("reference.success", duration=duration, path=path)
+        return {"status": "success", "duration": duration, "path": path, "cost": cost}
+
+    def _assemble(self) -> Dict[str, Any]:
+        """所有分镜结束后合成完整 MV"""
+        if "assemble" not in self.stages:
+            return {"status": "skipped", "reason": "未选择该阶段"}
+        if not self.audio_path:
+            return {"status": "skipped", "reason": "未提供 --audio"}
+        if self.token.cancelled:
+            return {"status": "skipped", "reason": "运行已取消"}
+        started = time.perf_counter()
+        self._emit("assemble.submitted")
+        try:
+            result = self.manager.assemble(self.audio_path)
+        except Exception as e:
+            self._emit("assemble.failed", error=str(e))
+            return {"status": "failed", "duration": round(time.perf_counter() - started, 3), "error": str(e)}
+        duration = round(time.perf_counter() - started, 3)
+        self._emit("assemble.success", duration=duration, path=result["path"])
+        return {"status": "success", "duration": duration, **result}
+
+    def run(self) -> Dict[str, Any]:
+        """执行所有阶段并返回汇总"""
+        with logs.context(project=self.name):
+            return self._run()
+
+    def _run(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        trace_since = tracing.now()
+        reference = self._prepare_reference()
+        if reference["status"] in ("failed", "timeout", "cancelled", "paused") and "first_frame" in self.stages:
+            # 没有参考图就无法生成带角色的首帧
+            self.stages = [s for s in self.stages if s != "first_frame"]
+
+        shots = self.manager.shots
+        self.records = {
+            i: {"id": shot.id, "index": i, "status": "pending", "stages": {}}
+            for i, shot in enumerate(shots)
+        }
+        self._pending = len(shots)
+        if not shots:
+            self._all_done.set()
+
+        # 重复分镜不单独生成, 等代表分镜的视频完成后直接复用
+        reuse_plan = self.manager.reuse_plan() if self.dedup else {}
+        self._followers = {}
+        for member, leader in sorted(reuse_plan.items()):
+            self._followers.setdefault(leader, []).append(member)
+        if reuse_plan:
+            self._emit("dedup.planned", clusters=len(self._followers), reused_shots=len(reuse_plan))
+
+        self._executors = self._shared_executors or {
+            provider: ThreadPoolExecutor(max_workers=max(1, n), thread_name_prefix=provider)
+            for provider, n in self.workers.items()
+        }
+        if self.audio_path and "lip_sync" in self.stages and any(s.sing for s in shots):
+            # 在首帧/视频生成期间提前完成整首歌的人声分离; 它同样占用 ComfyUI, 走 comfyui 通道才受并发上限约束
+            # （多个项目共用 FairScheduler 时也一样），时限从开始执行时算起
+            def prefetch_vocals():
+                self.manager.song_preprocessor.get_vocals(
+                    self.audio_path, deadline=for_stage("vocals", parent=self.token, timeouts=self.timeouts))
+
+            def prefetched(future):
+                if not future.cancelled() and future.exception() is not None:
+                    # 对口型阶段会再试一次
+                    self._emit("vocals.failed", error=str(future.exception()))
+
+            self._executors["comfyui"].submit(prefetch_vocals).add_done_callback(prefetched)
+        if self.preview:
+            self.preview.start()
+            self._emit("preview.started", playlist=str(self.preview.playlist_path))
+        if self.gc:
+            self.gc.start()
+        try:
+            # 先开始从未生成过的分镜, 花费上限不够时被暂停的是重新生成的分镜
+            for i in sorted(range(len(shots)), key=lambda i: (self._is_rerun(i), i)):
+                if i not in reuse_plan:
+                    self._start_first_frame(i)
+            try:
+                self._all_done.wait()
+            except KeyboardInterrupt:
+                # 执行中的阶段最多一秒内放弃, 排队中的阶段一开始就结束, 然后照常输出汇总
+                self.cancel("用户中断")
+                self._all_done.wait()
+        finally:
+            if self.hedge:
+                # 被对冲掉的原任务不再跟踪, 否则要等它们跑完才能退出
+                self.hedge.close()
+            for executor in self._executors.values():
+                executor.shutdown(wait=True)
+            if self.preview:
+                self.preview.stop()
+                try:
+                    self.preview.refresh()
+                except Exception as e:
+                    self._emit("preview.failed", error=str(e))
+            if self.gc:
+                self.gc.stop()
+
+        assembly = self._assemble()
+        trace = None
+        if tracing.TRACER.enabled:
+            tracing.export(self.trace_path, since=trace_since,
+                           metadata={"script": str(self.manager.json_path), "stages": self.stages})
+            trace = self.trace_path
+            self._emit("trace.saved", path=trace)
+
+        shot_records = [self.records[i] for i in range(len(shots))]
+        reused = [
+            i for i in reuse_plan
+            if self.records[i]["stages"].get("video", {}).get("status") == "reused"
+        ]
+        saved_cost = sum(
+            (shots[i].IMAGE_COST if shots[i].character_in_scene else 0) + shots[i].estimate_video_cost()
+            for i in reused
+        )
+        counts: Dict[str, int] = {}
+        for record in shot_records:
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        return {
+            **({"project": self.name} if self.name else {}),
+            "script": str(self.manager.json_path),
+            "output_dir": str(self.manager.output_dir),
+            "wall_time": round(time.perf_counter() - started, 3),
+            "total_cost": round(reference.get("cost", 0) + sum(r["cost"] for r in shot_records)
+                                + (self.hedge.spent if self.hedge else 0), 2),
+            "counts": counts,
+            "reference": reference,
+            "assembly": assembly,
+            "preview": str(self.preview.playlist_path) if self.preview else None,
+            "trace": trace,
+            "dedup": {"clusters": len(self._followers), "reused_shots": len(reused), "saved_cost": round(saved_cost, 2)},
+            "hedging": self.hedge.report() if self.hedge else None,
+            "budget": self.budget.report(),
+            "shots": shot_records,
+        }
+
+
+def _add_callback_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--hailuo-callback-port", type=int,
+                        help="在该端口接收海螺任务回调，轮询只作兜底（默认读取 HAILUO_CALLBACK_PORT）")
+    parser.add_argument("--hailuo-callback-url",
+                        help="服务商访问回调接收端的地址，如 https://example.com/hailuo/callback（默认读取 HAILUO_CALLBACK_URL）")
+
+
+def _apply_callback_arguments(manager: ShotsManager, args) -> None:
+    if args.hailuo_callback_port is not None:
+        manager.hailuo_callback_port = args.hailuo_callback_port
+    if args.hailuo_callback_url:
+        manager.hailuo_callback_url = args.hailuo_callback_url
+
+
+def _add_timeout_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--timeout", action="append", default=[], metavar="STAGE=SECONDS",
+                        help="阶段时限，可重复指定，0 表示不限时（默认: "
+                             + ", ".join(f"{k}={v:g}" for k, v in STAGE_TIMEOUTS.items()) + "）")
+
+
+def _apply_timeout_argument(manager: ShotsManager, args) -> bool:
+    """把 --timeout 写入 manager.stage_timeouts，格式或阶段名错误时输出原因并返回 False"""
+    try:
+        timeouts = parse_timeouts(args.timeout)
+    except ValueError as e:
+        print(f"无效的 --timeout: {e}", file=sys.stderr)
+        return False
+    unknown = [stage for stage in timeouts if stage not in STAGE_TIMEOUTS]
+    if unknown:
+        print(f"未知阶段: {', '.join(unknown)}（可选: {','.join(STAGE_TIMEOUTS)}）", file=sys.stderr)
+        return False
+    manager.stage_timeouts.update(timeouts)
+    return True
+
+
+def _add_hedge_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--hedge-percentile", type=float, metavar="P",
+                        help="海螺任务耗时超过本批次已完成任务的第 P 百分位时重新提交一份，取先完成的（默认不对冲）")
+    parser.add_argument("--hedge-budget", type=float, metavar="YUAN",
+                        help=f"对冲最多额外花费多少元，默认为本批次视频费用估算的 {DEFAULT_BUDGET_RATIO * 100:g}%%")
+    parser.add_argument("--hedge-min-samples", type=int, default=MIN_SAMPLES,
+                        help="每种片段时长至少完成多少个任务后才开始对冲")
+
+
+def _hedge_policy(manager: ShotsManager, args, dedup: bool = True) -> Optional[HedgePolicy]:
+    """按 --hedge-* 创建本批次的对冲策略，没有指定 --hedge-percentile 时返回 None"""
+    if args.hedge_percentile is None:
+        return None
+    budget = args.hedge_budget
+    if budget is None:
+        budget = manager.estimate_batch_cost(reuse=dedup)["video"] * DEFAULT_BUDGET_RATIO
+    return HedgePolicy(args.hedge_percentile, budget=budget, min_samples=args.hedge_min_samples)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="MV 分镜批量生成（无界面）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    validate = sub.add_parser("validate", help="校验脚本结构与时间轴")
+    validate.add_argument("script", help="shots.json 路径")
+
+    listing = sub.add_parser("list", help="以 JSON 列出脚本中的分镜")
+    listing.add_argument("script", help="shots.json 路径")
+
+    align = sub.add_parser("align", help="分析歌曲节拍并把分镜起止时间吸附到节拍上")
+    align.add_argument("script", help="shots.json 路径")
+    align.add_argument("--audio", required=True, help="整首歌音频")
+    align.add_argument("-o", "--output-dir", default="output_final", help="输出目录（分析缓存位于其 cache/ 下）")
+    align.add_argument("--tolerance", type=float, help="吸附容差(秒)，默认半拍")
+    align.add_argument("--write", action="store_true", help="把数值时间写回 shots.json")
+
+    dedup = sub.add_parser("dedup", help="列出提示词重复的分镜簇及复用可省下的费用")
+    dedup.add_argument("script", help="shots.json 路径")
+    dedup.add_argument("--threshold", type=float, default=ShotsManager.DUPLICATE_THRESHOLD,
+                       help="提示词相似度阈值(0-1)")
+
+    gc = sub.add_parser("gc", help="回收旧版本素材，使输出目录不超过磁盘预算")
+    gc.add_argument("script", help="shots.json 路径")
+    gc.add_argument("-o", "--output-dir", default="output_final", help="输出目录")
+    gc.add_argument("--budget", help="磁盘预算，如 500M、20G；默认读取环境变量 ARTIFACT_BUDGET")
+    gc.add_argument("--keep", type=int, default=3, help="每个分镜每类素材保留的版本数")
+    gc.add_argument("--dry-run", action="store_true", help="只列出将被删除的文件")
+
+    ui = sub.add_parser("ui", help="启动 Gradio 界面")
+    ui.add_argument("script", nargs="?", default="shots.json", help="shots.json 路径")
+    ui.add_argument("--port", type=int, default=7860)
+    ui.add_argument("--audio", help="整首歌音频，用于对口型和合成成片")
+    ui.add_argument("--gc-budget", help="素材磁盘预算（如 20G），提供后在后台持续回收旧素材")
+    ui.add_argument("--spend-limit", type=float, metavar="YUAN",
+                    help="后台任务的花费上限（元），超出时批量任务暂停派发（默认读取 MV_BUDGET，界面上可随时调整）")
+    ui.add_argument("--broker", metavar="URL",
+                    help="把生成阶段发布到该任务队列，由 cli worker 执行（目录或 sqlite:///目录，默认读取 MV_BROKER）")
+    ui.add_argument("--metrics-port", type=int, default=9464, help="Prometheus 指标端点端口，0 表示不启动")
+    ui.add_argument("--log-json", action="store_true", help="日志以 JSON 行输出到 stderr（默认读取 MV_LOG_FORMAT）")
+    _add_callback_arguments(ui)
+    _add_timeout_argument(ui)
+
+    run = sub.add_parser("run", help="执行全部生成阶段")
+    run.add_argument("script", help="shots.json 路径")
+    run.add_argument("-o", "--output-dir", default="output_final", help="输出目录")
+    run.add_argument("--audio", help="整首歌音频，用于对口型和合成成片")
+    run.add_argument("--reference", help="已有的角色参考图路径")
+    run.add_argument("--stages", default=",".join(BatchRunner.STAGES),
+                     help=f"逗号分隔的阶段列表，可选: {','.join(BatchRunner.STAGES)}")
+    run.add_argument("--seedream-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["seedream"])
+    run.add_argument("--hailuo-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["hailuo"])
+    run.add_argument("--comfyui-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["comfyui"])
+    run.add_argument("--json-progress", action="store_true", help="进度以 JSON 行输出")
+    run.add_argument("--preview", action="store_true", help="生成过程中维护 <输出目录>/preview/index.m3u8 实时预览")
+    run.add_argument("--no-dedup", action="store_true", help="不复用重复分镜的素材，每个分镜单独生成")
+    run.add_argument("--no-reuse", type=int, action="append", default=[], metavar="CLUSTER_ID",
+                     help="对指定的重复簇（簇 id 即代表分镜 id，见 dedup 命令）关闭复用，可重复指定")
+    run.add_argument("--gc-budget", help="素材磁盘预算（如 20G），提供后在生成过程中后台回收旧素材")
+    run.add_argument("--summary", help="汇总 JSON 写入该文件，默认输出到 stdout")
+    run.add_argument("--trace", help="Chrome trace 输出路径（chrome://tracing 或 Perfetto 打开），默认 <输出目录>/trace.json")
+    run.add_argument("--metrics-port", type=int, default=0, help="运行期间在该端口提供 Prometheus 指标端点")
+    run.add_argument("--log-json", action="store_true", help="日志以 JSON 行输出到 stderr（默认读取 MV_LOG_FORMAT）")
+    _add_callback_arguments(run)
+    _add_timeout_argument(run)
+    _add_hedge_arguments(run)
+    run.add_argument("--spend-limit", type=float, metavar="YUAN",
+                     help="本次运行的花费上限（元），放不下的分镜不再开始并记为 paused（默认不限）")
+
+    multi = sub.add_parser("multi", help="同时执行多个项目，共享服务商并发上限并按权重公平调度")
+    multi.add_argument("projects", help="项目清单 JSON（数组，每项至少包含 script，见 projects.py）")
+    multi.add_argument("--stages", default=",".join(BatchRunner.STAGES),
+                       help=f"逗号分隔的阶段列表，可选: {','.join(BatchRunner.STAGES)}")
+    multi.add_argument("--seedream-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["seedream"],
+                       help="所有项目合计的 Seedream 并发数")
+    multi.add_argument("--hailuo-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["hailuo"],
+                       help="所有项目合计的海螺并发数")
+    multi.add_argument("--comfyui-workers", type=int, default=BatchRunner.DEFAULT_WORKERS["comfyui"],
+                       help="所有项目合计的 ComfyUI 并发数")
+    multi.add_argument("--json-progress", action="store_true", help="进度以 JSON 行输出（每条带 project 字段）")
+    multi.add_argument("--stats-interval", type=float, default=30.0,
+                       help="每隔多少秒输出一次各项目的吞吐统计，0 表示只在结束时汇总")
+    multi.add_argument("--summary", help="汇总 JSON 写入该文件，默认输出到 stdout")
+    multi.add_argument("--metrics-port", type=int, default=0, help="运行期间在该端口提供 Prometheus 指标端点")
+    multi.add_argument("--log-json", action="store_true", help="日志以 JSON 行输出到 stderr（默认读取 MV_LOG_FORMAT）")
+    _add_callback_arguments(multi)
+    _add_timeout_argument(multi)
+
+    worker = sub.add_parser("worker", help="从任务队列领取生成阶段并在本机执行（可在任意台机器上启动多个）")
+    worker.add_argument("--broker", required=True, metavar="URL", help="任务队列（目录或 sqlite:///目录）")
+    worker.add_argument("--work-dir", default="worker_data", help="本机工作目录（输入缓存和素材）")
+    worker.add_argument("--worker-id", help="工作进程名，重启时沿用可立即交回未完成的任务（默认 <主机名>-<进程号>）")
+    worker.add_argument("--stages", default="first_frame,video,lip_sync", help="只领取这些阶段，逗号分隔")
+    worker.add_argument("--concurrency", type=int, default=4, help="同时执行的任务数")
+    worker.add_argument("--lease", type=float, default=60.0, help="租约时长(秒)，失联超过该时长的任务被重新派发")
+    worker.add_argument("--stage-limit", action="append", default=[], metavar="STAGE=N",
+                        help="某个阶段同时执行的任务数上限，可重复（默认 lip_sync=1，ComfyUI 客户端一次只跟踪一个工作流）")
+    worker.add_argument("--comfyui-server", help="本机使用的 ComfyUI 地址，如 localhost:8190")
+    worker.add_argument("--metrics-port", type=int, default=0, help="在该端口提供 Prometheus 指标端点")
+    worker.add_argument("--log-json", action="store_true", help="日志以 JSON 行输出到 stderr（默认读取 MV_LOG_FORMAT）")
+    return parser
+
+
+def _report_startup(command: str) -> None:
+    """把命令耗时输出到 stderr, 超出启动预算时给出警告"""
+    elapsed = time.perf_counter() - _STARTED
+    print(f"{command} 耗时 {elapsed * 1000:.0f}ms (预算 {STARTUP_BUDGET * 1000:.0f}ms)", file=sys.stderr)
+    if elapsed > STARTUP_BUDGET:
+        heavy = [m for m in ("gradio", "volcenginesdkarkruntime", "websockets") if m in sys.modules]
+        print(f"⚠️ 超出启动预算, 已导入的重量级模块: {', '.join(heavy) or '无'}", file=sys.stderr)
+
+
+def _cmd_validate(args) -> int:
+    try:
+        with open(args.script, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(json.dumps({"script": args.script, "valid": False, "problems": [str(e)]}, ensure_ascii=False, indent=2))
+        return 1
+    problems = ShotsManager.validate_script(data)
+    print(json.dumps({"script": args.script, "valid": not problems, "problems": problems}, ensure_ascii=False, indent=2))
+    _report_startup("validate")
+    return 1 if problems else 0
+
+
+def _cmd_list(args) -> int:
+    manager = ShotsManager(args.script)
+    shots = [
+        {
+            "id": shot.id,
+            "lyric": shot.lyric,
+            "duration": shot.duration,
+            "sing": shot.sing,
+            "character": shot.character_in_scene,
+            "startTime": shot.start_time,
+            "endTime": shot.end_time,
+            "video_cost": shot.estimate_video_cost(),
+        }
+        for shot in manager.shots
+    ]
+    print(json.dumps({"script": args.script, "count": len(shots), "shots": shots}, ensure_ascii=False, indent=2))
+    _report_startup("list")
+    return 0
+
+
+def _cmd_align(args) -> int:
+    manager = ShotsManager(args.script, args.output_dir)
+    try:
+        report = manager.align_to_song(args.audio, tolerance=args.tolerance, write=args.write)
+    except ValueError as e:
+        print(f"❌ 无法对齐: {e}", file=sys.stderr)
+        return 1
+    report["written"] = args.write
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+def _cmd_dedup(args) -> int:
+    manager = ShotsManager(args.script)
+    clusters = manager.find_duplicate_shots(threshold=args.threshold)
+    shots = manager.shots
+    report = {
+        "script": args.script,
+        "threshold": args.threshold,
+        "clusters": [
+            {
+                "id": c["id"],
+                "shot_ids": c["shot_ids"],
+                "similarity": c["similarity"],
+                "exact": c["exact"],
+                # 复用视频后仍需对口型的重复分镜（音频区间相同时直接复用代表分镜的结果）
+                "lip_sync": [
+                    shots[m].id for m in c["members"]
+                    if shots[m].sing and manager.audio_window(m) != manager.audio_window(c["representative"])
+                ],
+                "lyrics": sorted({shots[i].lyric for i in [c["representative"], *c["members"]]}),
+            }
+            for c in clusters
+        ],
+        "cost": manager.estimate_batch_cost(),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+def _cmd_gc(args) -> int:
+    from artifact_gc import parse_size
+    manager = ShotsManager(args.script, args.output_dir)
+    budget = parse_size(args.budget) if args.budget else None
+    gc = manager.garbage_collector(budget_bytes=budget, keep_versions=args.keep)
+    result = gc.collect(dry_run=args.dry_run)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+def _cmd_ui(args) -> int:
+    if args.log_json:
+        logs.setup(fmt="json")
+    # Gradio 只在启动界面时导入
+    from main import MVGeneratorUI
+    ui = MVGeneratorUI(args.script, audio_path=args.audio) if args.audio else MVGeneratorUI(args.script)
+    _apply_callback_arguments(ui.manager, args)
+    if not _apply_timeout_argument(ui.manager, args):
+        return 2
+    if args.spend_limit is not None:
+        ui.jobs.set_budget(args.spend_limit or None)
+    if args.broker:
+        ui.manager.use_broker(args.broker)
+    if args.gc_budget:
+        from artifact_gc import parse_size
+        ui.manager.garbage_collector(budget_bytes=parse_size(args.gc_budget)).start()
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    demo = ui.create_ui()
+    demo.launch(server_name="0.0.0.0", server_port=args.port, share=False)
+    return 0
+
+
+def _cmd_run(args) -> int:
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in BatchRunner.STAGES]
+    if unknown:
+        print(f"未知阶段: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    gc_budget = None
+    if args.gc_budget:
+        from artifact_gc import parse_size
+        gc_budget = parse_size(args.gc_budget)
+
+    if args.log_json:
+        logs.setup(fmt="json")
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    manager = ShotsManager(args.script, args.output_dir)
+    _apply_callback_arguments(manager, args)
+    if not _apply_timeout_argument(manager, args):
+        return 2
+    for cluster_id in args.no_reuse:
+        manager.set_cluster_reuse(cluster_id, False)
+    try:
+        hedge = _hedge_policy(manager, args, dedup=not args.no_dedup)
+    except ValueError as e:
+        print(f"无效的 --hedge-percentile: {e}", file=sys.stderr)
+        return 2
+    runner = BatchRunner(
+        manager,
+        stages=stages,
+        audio_path=args.audio,
+        reference_path=args.reference,
+        workers={
+            "seedream": args.seedream_workers,
+            "hailuo": args.hailuo_workers,
+            "comfyui": args.comfyui_workers,
+        },
+        json_progress=args.json_progress,
+        preview=args.preview,
+        dedup=not args.no_dedup,
+        gc_budget=gc_budget,
+        trace_path=args.trace,
+        hedge=hedge,
+        spend_limit=args.spend_limit,
+    )
+    summary = runner.run()
+
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    failed = (any(summary["counts"].get(status, 0) for status in ("failed", "timeout", "cancelled", "paused"))
+              or summary["reference"]["status"] in ("failed", "timeout", "cancelled", "paused")
+              or summary["assembly"]["status"] == "failed")
+    return 1 if failed else 0
+
+
+def _cmd_multi(args) -> int:
+    # 只有多项目运行才需要共享调度器
+    from projects import ProjectService, load_projects
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in BatchRunner.STAGES]
+    if unknown:
+        print(f"未知阶段: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    try:
+        projects = load_projects(args.projects)
+    except (OSError, ValueError) as e:
+        print(f"无效的项目清单: {e}", file=sys.stderr)
+        return 2
+
+    if args.log_json:
+        logs.setup(fmt="json")
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    service = ProjectService(
+        workers={
+            "seedream": args.seedream_workers,
+            "hailuo": args.hailuo_workers,
+            "comfyui": args.comfyui_workers,
+        },
+        stages=stages,
+        json_progress=args.json_progress,
+    )
+    for project in projects:
+        manager = ShotsManager(project["script"], project["output_dir"])
+        _apply_callback_arguments(manager, args)
+        if not _apply_timeout_argument(manager, args):
+            return 2
+        try:
+            service.add(project["script"], name=project["name"], weight=project["weight"],
+                        audio=project["audio"], reference=project["reference"],
+                        spend_limit=project["spend_limit"], dedup=project["dedup"], manager=manager)
+        except ValueError as e:
+            print(f"无效的项目清单: {e}", file=sys.stderr)
+            return 2
+    summary = service.run(stats_interval=args.stats_interval)
+
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    failed = False
+    for result in summary["projects"].values():
+        if not result or "error" in result:
+            failed = True
+            continue
+        failed = failed or (any(result["counts"].get(status, 0) for status in ("failed", "timeout", "cancelled", "paused"))
+                            or result["reference"]["status"] in ("failed", "timeout", "cancelled", "paused")
+                            or result["assembly"]["status"] == "failed")
+    return 1 if failed else 0
+
+
+def _cmd_worker(args) -> int:
+    from broker import open_broker
+    from worker import Worker
+    if args.log_json:
+        logs.setup(fmt="json")
+    try:
+        limits = {}
+        for item in args.stage_limit:
+            stage, sep, value = item.partition("=")
+            if not sep or not stage.strip():
+                raise ValueError(f"--stage-limit 格式应为 阶段=数量: {item!r}")
+            limits[stage.strip()] = max(1, int(value))
+        node = Worker(open_broker(args.broker), work_dir=args.work_dir, worker_id=args.worker_id,
+                      stages=[s.strip() for s in args.stages.split(",") if s.strip()],
+                      concurrency=args.concurrency, lease_seconds=args.lease, comfyui_server=args.comfyui_server,
+                      stage_limits=limits)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    node.run_forever()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _build_parser().parse_args(argv)
+    commands = {
+        "validate": _cmd_validate,
+        "list": _cmd_list,
+        "align": _cmd_align,
+        "dedup": _cmd_dedup,
+        "gc": _cmd_gc,
+        "ui": _cmd_ui,
+        "run": _cmd_run,
+        "multi": _cmd_multi,
+        "worker": _cmd_worker,
+    }
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,44 @@
 import json
 import requests
-import websockets
 import asyncio
 import threading
 import uuid
 import os
+import time
 from typing import Dict, Any, Optional, List
 
+import logs
+import metrics
+import tracing
+from deadline import Cancelled, Deadline
+
+logger = logs.get_logger("comfyui")
+
 class ComfyUIClient:
     """
     ComfyUI API客户端类，封装了工作流提交、状态监控和结果下载功能。
     """
     WORKFLOW_DIR = "/root/shared-nvme/shuyiwang/MusicVideo_ProduXer/workflows/lipsync.json"
+    VOCAL_WORKFLOW = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows", "vocal_separation.json")
+    # 单次 HTTP 请求（提交、查询历史）和上传/下载的超时上限（秒），另受调用方 Deadline 的剩余时间限制
+    REQUEST_TIMEOUT = 30
+    TRANSFER_TIMEOUT = 300
     
-    def __init__(self, server_address: str = "localhost:8190", save_dir: str = "./generated_videos"):
+    def __init__(self, server_address: str = "localhost:8190", save_dir: str = "./generated_videos",
+                 history_dir: Optional[str] = None):
         """
         初始化ComfyUI客户端
         
         :param server_address: ComfyUI服务器地址，格式为"host:port"
+        :param save_dir: 默认的结果下载目录
+        :param history_dir: 任务历史 history_<prompt_id>.json 的保存目录，默认 <save_dir>/history
         """
         self.server_address = server_address
         self.comfy_api_url = f"http://{server_address}"
         self.ws_url = f"ws://{server_address}/ws"
         self.client_id = str(uuid.uuid4())
         self.save_dir = save_dir
+        self.history_dir = history_dir or os.path.join(save_dir, "history")
         
         # 任务状态跟踪
         self.task_status = {
@@ -31,45 +46,60 @@ class ComfyUIClient:
             "progress": 0,
             "max_progress": 1,
             "status": "pending",  # pending, executing, completed, failed
-            "prompt_id": None
+            "prompt_id": None,
+            # 任务失败时 ComfyUI 报告的错误
+            "error": None,
+            # 指标统计用: 入队时间、第一个节点开始执行的时间、当前节点开始执行的时间
+            "queued_at": None,
+            "execution_started": None,
+            "node_started": None,
         }
+        # 最近提交的工作流 {节点 id: class_type}, 用于给节点耗时打标签
+        self._node_types: Dict[str, str] = {}
+        # 当前任务提交时的日志上下文（分镜、阶段等），WebSocket 线程的日志沿用它
+        self._log_context: Dict[str, Any] = {}
         
         # WebSocket相关
         self.websocket_thread = None
         self.should_listen = True
 
+        # 已上传文件 {(路径, 大小, 修改时间): 上传信息}，同一文件（例如整首歌）只上传一次
+        self._uploaded: Dict[tuple, Dict[str, Any]] = {}
+
     async def _listen_for_updates(self):
         """
         内部方法：WebSocket监听器，用于实时监控任务状态[1,3](@ref)
         """
+        import websockets
         ws_url_with_client = f"{self.ws_url}?clientId={self.client_id}"
         
         try:
             async with websockets.connect(ws_url_with_client) as websocket:
-                print(f"WebSocket连接已建立，客户端ID: {self.client_id}")
+                logger.debug("WebSocket连接已建立，客户端ID: %s", self.client_id)
                 
                 while self.should_listen:
                     try:
                         raw_message = await websocket.recv()
                         
                         if isinstance(raw_message, bytes):
-                            print(f"收到二进制数据，长度: {len(raw_message)}字节")
+                            logger.debug("收到二进制数据，长度: %d字节", len(raw_message))
                             continue
                             
                         data = json.loads(raw_message)
                         message_type = data.get('type')
                         
-                        await self._handle_websocket_message(message_type, data)
+                        with logs.context(**self._log_context):
+                            await self._handle_websocket_message(message_type, data)
                         
                     except json.JSONDecodeError as e:
-                        print(f"消息JSON解析错误: {e}")
+                        logger.warning("消息JSON解析错误: %s", e)
                     except UnicodeDecodeError as e:
-                        print(f"消息解码错误: {e}")
+                        logger.warning("消息解码错误: %s", e)
                         
         except websockets.exceptions.ConnectionClosed:
-            print("WebSocket连接已关闭")
+            logger.debug("WebSocket连接已关闭")
         except Exception as e:
-            print(f"WebSocket监听错误: {e}")
+            logger.warning("WebSocket监听错误: %s", e)
 
     async def _handle_websocket_message(self, message_type: str, data: Dict[str, Any]):
         """
@@ -77,40 +107,77 @@ class ComfyUIClient:
         """
         if message_type == 'status':
             status_data = data.get('data', {})
-            print(f"队列状态: {status_data}")
+            logger.debug("队列状态: %s", status_data)
             
         elif message_type == 'executing':
             execution_data = data.get('data', {})
             node_id = execution_data.get('node')
             prompt_id_from_msg = execution_data.get('prompt_id')
             
+            if prompt_id_from_msg == self.task_status["prompt_id"]:
+                self._record_node_timing(node_id)
             if node_id is None and prompt_id_from_msg == self.task_status["prompt_id"]:
-                print("🎉 任务执行已完成！")
+                logger.info("🎉 任务执行已完成！")
                 self.task_status["status"] = "completed"
             elif node_id is not None:
                 self.task_status["current_node"] = node_id
                 self.task_status["status"] = "executing"
-                print(f"正在执行节点: {node_id}")
+                logger.debug("正在执行节点: %s", node_id)
                 
         elif message_type == 'progress':
             progress_data = data.get('data', {})
             self.task_status["progress"] = progress_data.get('value', 0)
             self.task_status["max_progress"] = progress_data.get('max', 1)
             progress_percent = (self.task_status["progress"] / self.task_status["max_progress"]) * 100
-            print(f"任务进度: {self.task_status['progress']}/{self.task_status['max_progress']} ({progress_percent:.1f}%)")
+            logs.progress(logger, f"comfyui:{self.task_status['prompt_id']}", "任务进度: %s/%s (%.1f%%)",
+                          self.task_status["progress"], self.task_status["max_progress"], progress_percent,
+                          force=self.task_status["progress"] >= self.task_status["max_progress"])
             
         elif message_type == 'execution_error':
             error_data = data.get('data', {})
-            print(f"❌ 任务执行出错: {error_data}")
+            logger.error("❌ 任务执行出错: %s", error_data)
+            metrics.ERRORS.inc(provider="comfyui", op="execute")
+            self.task_status["error"] = (f"节点 {error_data.get('node_id')} ({error_data.get('node_type')}): "
+                                         f"{error_data.get('exception_message', '').strip() or error_data}")
             self.task_status["status"] = "failed"
 
+    def _record_node_timing(self, node_id: Optional[str]):
+        """根据 executing 消息记录排队时间、上一个节点的执行时间, 以及任务结束时的总执行时间
+
+        ComfyUI 在开始执行每个节点时发送 executing(node), 全部执行完发送 executing(None)，
+        因此一个节点的耗时就是它与下一条 executing 消息的间隔。
+        """
+        now = time.time()
+        status = self.task_status
+        if status["node_started"] is not None:
+            previous = status["current_node"]
+            class_type = self._node_types.get(str(previous), "unknown")
+            metrics.COMFYUI_NODE_SECONDS.observe(now - status["node_started"], node=previous, class_type=class_type)
+            tracing.complete(f"node {previous} {class_type}", status["node_started"], now, cat="comfyui",
+                             track="ComfyUI nodes", prompt_id=status["prompt_id"])
+        elif node_id is not None and status["queued_at"] is not None:
+            metrics.QUEUE_SECONDS.observe(now - status["queued_at"], provider="comfyui")
+            status["execution_started"] = now
+        if node_id is None:
+            if status["execution_started"] is not None:
+                metrics.RENDER_SECONDS.observe(now - status["execution_started"], provider="comfyui")
+                tracing.complete("comfyui.queue", status["queued_at"], status["execution_started"], cat="provider",
+                                 track="ComfyUI nodes", prompt_id=status["prompt_id"])
+            status["node_started"] = None
+        else:
+            status["node_started"] = now
+
     def _start_websocket_listener(self, prompt_id: str):
         """
         启动WebSocket监听线程[4](@ref)
         """
         self.task_status["prompt_id"] = prompt_id
         self.task_status["status"] = "pending"
+        self.task_status["error"] = None
+        self.task_status["execution_started"] = None
+        self.task_status["node_started"] = None
         self.should_listen = True
+        self._log_context = {**logs.current(), "provider": "comfyui", "prompt_id": prompt_id}
         
         def run_async():
             loop = asyncio.new_event_loop()
@@ -121,51 +188,81 @@ class ComfyUIClient:
         self.websocket_thread = threading.Thread(target=run_async)
         self.websocket_thread.daemon = True
         self.websocket_thread.start()
-        print("WebSocket监听器已启动")
+        logger.debug("WebSocket监听器已启动")
 
-    def _wait_for_completion(self, timeout: int = 3600) -> str:
+    def _wait_for_completion(self, deadline: Deadline) -> str:
         """
-        等待任务完成，带有超时机制
+        等待任务完成（completed/failed），到达 deadline 或被取消时抛出 DeadlineExceeded / Cancelled
         """
-        import time
         start_time = time.time()
         
-        while time.time() - start_time < timeout:
+        while True:
             if self.task_status["status"] in ["completed", "failed"]:
                 return self.task_status["status"]
             
             if self.task_status["status"] == "executing":
                 progress_percent = (self.task_status["progress"] / self.task_status["max_progress"]) * 100
-                print(f"\r当前进度: {progress_percent:.1f}%", end="", flush=True)
+                logs.progress(logger, f"comfyui:{self.task_status['prompt_id']}", "当前进度: %.1f%%, 已等待 %.0fs",
+                              progress_percent, time.time() - start_time)
             
-            time.sleep(1)
-        
-        print("任务等待超时")
-        return "timeout"
+            deadline.sleep(1)
 
-    def upload_file(self, file_path: str, file_type: str = "input") -> Dict[str, Any]:
+    def _await_prompt(self, prompt_id: str, deadline: Deadline) -> str:
+        """启动监听并等待任务结束；超时或被取消时先把任务从 ComfyUI 上撤掉，释放 GPU 再抛出"""
+        self._start_websocket_listener(prompt_id)
+        try:
+            return self._wait_for_completion(deadline)
+        except Cancelled as e:
+            metrics.INTERRUPTED.inc(provider="comfyui", op="execute", reason=e.reason)
+            logger.warning("⏰ 放弃等待任务 %s: %s", prompt_id, e)
+            self.cancel_prompt(prompt_id)
+            raise
+
+    def cancel_prompt(self, prompt_id: str) -> None:
+        """从 ComfyUI 队列中删除任务，正在执行时中断它（尽力而为，失败只记日志）"""
+        try:
+            requests.post(f"{self.comfy_api_url}/queue", json={"delete": [prompt_id]}, timeout=self.REQUEST_TIMEOUT)
+            if self.task_status["prompt_id"] == prompt_id and self.task_status["status"] == "executing":
+                # 较新的 ComfyUI 只在 prompt_id 匹配时中断; 旧版本中断当前正在执行的任务, 即本任务
+                requests.post(f"{self.comfy_api_url}/interrupt", json={"prompt_id": prompt_id},
+                              timeout=self.REQUEST_TIMEOUT)
+            logger.info("⏹️ 已从 ComfyUI 撤下任务 %s", prompt_id)
+        except requests.RequestException as e:
+            logger.warning("⚠️ 撤下 ComfyUI 任务 %s 失败: %s", prompt_id, e)
+
+    def upload_file(self, file_path: str, file_type: str = "input",
+                    deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """
         上传文件到ComfyUI服务器[1](@ref)
         
         :param file_path: 本地文件路径
         :param file_type: 文件类型（input/output/temp）
+        :param deadline: 截止时间/取消令牌，默认不限时（单次请求仍有 TRANSFER_TIMEOUT 上限）
         :return: 上传文件的信息字典
         """
+        deadline = deadline or Deadline()
+        stat = os.stat(file_path)
+        cache_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+        if cache_key in self._uploaded:
+            return self._uploaded[cache_key]
+
         file_ext = file_path.split('.')[-1].lower()
         file_name = os.path.basename(file_path)
         
-        with open(file_path, "rb") as f:
+        with open(file_path, "rb") as f, metrics.track("comfyui", "upload"), deadline.guard():
             files = {'image': (file_name, f, f"{file_type}/{file_ext}")}
             data = {'type': 'input', 'overwrite': 'true'}
             
             response = requests.post(
                 f"{self.comfy_api_url}/upload/image", 
                 files=files, 
-                data=data
+                data=data,
+                timeout=deadline.timeout_for(self.TRANSFER_TIMEOUT)
             )
             
         if response.status_code == 200:
-            return response.json()
+            self._uploaded[cache_key] = response.json()
+            return self._uploaded[cache_key]
         else:
             response.raise_for_status()
 
@@ -182,22 +279,25 @@ class ComfyUIClient:
                         input_files: Dict[str, str],
                         params: Dict[str, Any],
                         output_dir: Optional[str]=None,
-                        file_name: Optional[str]=None) -> Dict[str, Any]:
+                        file_name: Optional[str]=None,
+                        deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """
         执行ComfyUI工作流[1,3](@ref)
         
         :param workflow_json: 工作流JSON配置
         :param input_files: 输入文件映射 {文件类型: 文件路径}
         :param params: 工作流参数
+        :param deadline: 截止时间/取消令牌，到期或被取消时撤下任务并抛出 DeadlineExceeded / Cancelled
         :return: 任务执行结果
         """
+        deadline = deadline or Deadline()
         # 1. 上传文件
         upload_info = {}
         for file_type, file_path in input_files.items():
-            print(f"上传文件: {file_path}")
-            upload_info[file_type] = self.upload_file(file_path)
+            logger.debug("上传文件: %s", file_path)
+            upload_info[file_type] = self.upload_file(file_path, deadline=deadline)
         
-        print(f"文件上传完成: {upload_info}")
+        logger.debug("文件上传完成: %s", upload_info)
         
         # 2. 配置工作流参数
         workflow_json["228"]["inputs"]["video"] = upload_info["video"]["name"]
@@ -209,63 +309,119 @@ class ComfyUIClient:
                 workflow_json["241"]["inputs"]["positive_prompt"] = params["prompt"]["positive"]
             if params["prompt"].get("negative"):
                 workflow_json["241"]["inputs"]["negative_prompt"] = params["prompt"]["negative"]
+        if "vocals" in upload_info:
+            # 使用整首歌预先分离好的人声: 裁剪同一区间后直接送入 Wav2Vec, 跳过本分镜的人声分离(303/304)
+            workflow_json["900"] = {
+                "inputs": {"audio": upload_info["vocals"]["name"], "audioUI": ""},
+                "class_type": "LoadAudio",
+            }
+            workflow_json["901"] = {
+                "inputs": {
+                    "start_time": params["time"]["start_time"],
+                    "end_time": params["time"]["end_time"],
+                    "audio": ["900", 0],
+                },
+                "class_type": "AudioCrop",
+            }
+            workflow_json["194"]["inputs"]["audio_1"] = ["901", 0]
+            workflow_json.pop("303", None)
+            workflow_json.pop("304", None)
         
         # 3. 提交任务
+        prompt_id = self._queue_prompt(workflow_json, deadline)
+        
+        with logs.context(provider="comfyui", prompt_id=prompt_id):
+            # 4. 启动监听并等待完成（超时或被取消时直接抛出, 不再去下载）
+            final_status = self._await_prompt(prompt_id, deadline)
+            
+            if final_status != "completed":
+                raise RuntimeError(f"ComfyUI 任务执行失败: {self.task_status['error'] or final_status}")
+            logger.info("任务执行完成")
+            
+            # 5. 下载结果
+            if not output_dir:
+                output_dir=self.save_dir
+            saved_paths = self.download_video_result(prompt_id=prompt_id, save_dir=output_dir, file_name=file_name,
+                                                     deadline=deadline)
+        
+        return saved_paths
+
+    def _queue_prompt(self, workflow_json: Dict[str, Any], deadline: Deadline) -> str:
+        """
+        提交工作流到ComfyUI队列，返回 prompt_id
+        """
         payload = {
             "prompt": workflow_json,
             "return_temp_files": False,
             "client_id": self.client_id
         }
         
-        response = requests.post(f'{self.comfy_api_url}/prompt', json=payload)
-        response.raise_for_status()
+        with metrics.track("comfyui", "submit", nodes=len(workflow_json)), deadline.guard():
+            response = requests.post(f'{self.comfy_api_url}/prompt', json=payload,
+                                     timeout=deadline.timeout_for(self.REQUEST_TIMEOUT))
+            response.raise_for_status()
         
         result = response.json()
         prompt_id = result["prompt_id"]
-        print(f"任务提交成功, Prompt ID: {prompt_id}")
-        
-        # 4. 启动监听并等待完成
-        self._start_websocket_listener(prompt_id)
-        final_status = self._wait_for_completion()
+        self.task_status["queued_at"] = time.time()
+        self._node_types = {str(node): spec.get("class_type", "unknown")
+                            for node, spec in workflow_json.items() if isinstance(spec, dict)}
+        logger.info("任务提交成功, Prompt ID: %s", prompt_id, extra={"provider": "comfyui", "prompt_id": prompt_id})
+        return prompt_id
+
+    def separate_vocals(self, audio_path: str, save_dir: str, deadline: Optional[Deadline] = None) -> str:
+        """
+        对整首歌执行人声分离工作流，返回下载到本地的人声文件路径
         
-        if final_status == "completed":
-            print("\n任务执行完成")
-        elif final_status == "failed":
-            print("\n任务执行失败！")
-        else:
-            print("\n任务状态未知或超时")
+        :param audio_path: 整首歌音频
+        :param save_dir: 保存目录
+        :param deadline: 截止时间/取消令牌
+        """
+        deadline = deadline or Deadline()
+        workflow_json = self.load_workflow(self.VOCAL_WORKFLOW)
+        workflow_json["1"]["inputs"]["audio"] = self.upload_file(audio_path, deadline=deadline)["name"]
+        
+        prompt_id = self._queue_prompt(workflow_json, deadline)
+        with logs.context(provider="comfyui", prompt_id=prompt_id):
+            final_status = self._await_prompt(prompt_id, deadline)
+            if final_status != "completed":
+                raise RuntimeError(f"人声分离未完成: {self.task_status['error'] or final_status}")
             
-        # 5. 下载结果
-        if not output_dir:
-            output_dir=self.save_dir
-        saved_paths = self.download_video_result(prompt_id=prompt_id, save_dir=output_dir, file_name=file_name)
-        
-        return saved_paths
+            saved_paths = self.download_video_result(prompt_id=prompt_id, target_node="4", save_dir=save_dir,
+                                                     deadline=deadline)
+        if not saved_paths:
+            raise RuntimeError("人声分离没有输出文件")
+        return saved_paths[-1]
 
     def download_video_result(self, prompt_id: str, 
                             target_node: str = "131",
                             save_dir: str = None,
-                            file_name: str = None) -> List[str]:
+                            file_name: str = None,
+                            deadline: Optional[Deadline] = None) -> List[str]:
         """
         下载生成的视频文件[1](@ref)
         
         :param prompt_id: 任务ID
         :param target_node: 目标节点ID
         :param save_dir: 保存目录
+        :param deadline: 截止时间/取消令牌
         :return: 下载的文件路径列表
         """
+        deadline = deadline or Deadline()
         # 查询历史记录
         history_url = f"{self.comfy_api_url}/history/{prompt_id}"
-        response = requests.get(history_url)
+        with metrics.track("comfyui", "history"), deadline.guard():
+            response = requests.get(history_url, timeout=deadline.timeout_for(self.REQUEST_TIMEOUT))
         
         if response.status_code != 200:
-            print(f"查询历史记录失败！状态码：{response.status_code}")
+            logger.warning("查询历史记录失败！状态码：%s", response.status_code)
             return []
         
         history_data = response.json()
         
         # 保存历史记录用于调试
-        with open(f"history_{prompt_id}.json", "w") as f:
+        os.makedirs(self.history_dir, exist_ok=True)
+        with open(os.path.join(self.history_dir, f"history_{prompt_id}.json"), "w") as f:
             json.dump(history_data, f, indent=2)
             
         task_info = history_data.get(prompt_id, {})
@@ -273,17 +429,17 @@ class ComfyUIClient:
         target_output = outputs.get(target_node, {})
         
         # 查找视频文件信息（尝试多个可能的字段）
-        video_fields = ['gifs', 'videos', 'images']
+        video_fields = ['gifs', 'videos', 'images', 'audio']
         videos_info = []
         
         for field in video_fields:
             if field in target_output:
                 videos_info = target_output[field]
-                print(f"在字段 '{field}' 中找到视频信息")
+                logger.debug("在字段 '%s' 中找到视频信息", field)
                 break
         
         if not videos_info:
-            print(f"在节点 {target_node} 的输出中未找到视频文件信息")
+            logger.warning("在节点 %s 的输出中未找到视频文件信息", target_node)
             return []
         
         # 创建保存目录
@@ -301,20 +457,29 @@ class ComfyUIClient:
             }
             
             download_url = f"{self.comfy_api_url}/view"
-            response = requests.get(download_url, params=params)
+            started = time.perf_counter()
+            with metrics.track("comfyui", "download", prompt_id=prompt_id) as span, deadline.guard():
+                response = requests.get(download_url, params=params,
+                                        timeout=deadline.timeout_for(self.TRANSFER_TIMEOUT))
+                span["bytes"] = len(response.content)
             
             if response.status_code == 200:
+                metrics.record_download("comfyui", time.perf_counter() - started, len(response.content))
                 if not file_name:
                     file_name = video_info['filename']
                 file_path = os.path.join(save_dir, file_name)
                 
-                with open(file_path, 'wb') as f:
+                # 先写临时文件再原子替换, 避免并发下载同名文件时互相覆盖出半个文件
+                tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'wb') as f:
                     f.write(response.content)
+                os.replace(tmp_path, file_path)
                 
                 saved_files.append(file_path)
-                print(f"视频已成功下载: {file_path}")
+                logger.info("视频已成功下载: %s", file_path)
             else:
-                print(f"下载视频失败！状态码：{response.status_code}")
+                metrics.ERRORS.inc(provider="comfyui", op="download")
+                logger.error("下载视频失败！状态码：%s", response.status_code)
         
         return saved_files
 
@@ -325,7 +490,7 @@ class ComfyUIClient:
         self.should_listen = False
         if self.websocket_thread and self.websocket_thread.is_alive():
             self.websocket_thread.join(timeout=5)
-        print("ComfyUI客户端已停止")
+        logger.debug("ComfyUI客户端已停止")
         
 # 使用重构后的客户端
 if __name__ == "__main__":
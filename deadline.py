@@ -0,0 +1,156 @@
+"""
+生成任务的截止时间与取消令牌
+
+原先海螺任务一直停在 Processing 时 query_task_status 会永远轮询下去，ComfyUI 等满一小时后照样去下载，
+所有 requests 调用也都没有超时：一个卡住的任务会悄无声息地永久占住一个工作线程。
+
+现在每个阶段（首帧/视频/对口型等）开始执行时创建一个 Deadline，一路传给客户端的每次网络请求和每个等待循环：
+    - 每次请求的超时取 min(请求本身的上限, 距截止时间的剩余时间)；
+    - 等待循环用 sleep 代替 time.sleep，到期或被取消时立即抛出，不再等下一次轮询；
+    - 取消父令牌（整个批次、用户中断）会同时取消所有子令牌。
+超时抛出 DeadlineExceeded，被取消抛出 Cancelled，调用方据此把任务记为 timeout / cancelled 而不是 failed。
+"""
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+# 单次 HTTP 请求的默认超时上限(秒)
+REQUEST_TIMEOUT = 60.0
+# 各阶段默认时限(秒), 从阶段真正开始执行时算起
+STAGE_TIMEOUTS: Dict[str, float] = {
+    "reference": 600,
+    "image": 600,
+    "first_frame": 600,
+    "video": 3600,
+    "lip_sync": 3600,
+    "vocals": 3600,
+}
+
+
+class Cancelled(Exception):
+    """任务被取消"""
+    reason = "cancelled"
+
+
+class DeadlineExceeded(Cancelled, TimeoutError):
+    """任务超过了截止时间"""
+    reason = "timeout"
+
+
+class Deadline:
+    """截止时间 + 取消令牌（线程安全，可以在多个线程间共享）"""
+
+    def __init__(self, timeout: Optional[float] = None, parent: Optional["Deadline"] = None,
+                 name: Optional[str] = None):
+        """
+        Args:
+            timeout: 从现在起的时限（秒），None 表示不限时（仍然可以被取消）
+            parent: 父令牌，子令牌的截止时间不晚于父令牌，父令牌被取消时子令牌一并取消
+            name: 出现在超时信息中的名字，例如阶段名
+        """
+        self.timeout = timeout
+        self.name = name or (parent.name if parent else None)
+        expires = None if timeout is None else time.monotonic() + timeout
+        if parent is not None and parent.expires_at is not None:
+            expires = parent.expires_at if expires is None else min(expires, parent.expires_at)
+        self.expires_at = expires
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._children: "weakref.WeakSet[Deadline]" = weakref.WeakSet()
+        if parent is not None:
+            parent._adopt(self)
+
+    def _adopt(self, child: "Deadline") -> None:
+        with self._lock:
+            self._children.add(child)
+            reason = self.reason
+        if reason is not None:
+            child.cancel(reason)
+
+    def child(self, timeout: Optional[float] = None, name: Optional[str] = None) -> "Deadline":
+        """派生一个子令牌（例如同一镜头的各个片段共用，一个失败时取消其余的）"""
+        return Deadline(timeout, parent=self, name=name)
+
+    def cancel(self, reason: str = "已取消") -> None:
+        """取消本令牌及其所有子令牌，正在 sleep 的线程立即醒来"""
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            children = list(self._children)
+        self._event.set()
+        for child in children:
+            child.cancel(reason)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def remaining(self) -> Optional[float]:
+        """距截止时间的剩余秒数，不限时返回 None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def error(self) -> Cancelled:
+        """当前状态对应的异常（已取消优先于超时）"""
+        if self.cancelled:
+            return Cancelled(self.reason)
+        what = f"{self.name} " if self.name else ""
+        return DeadlineExceeded(f"{what}超过时限 {self.timeout:g}s" if self.timeout else f"{what}超过截止时间")
+
+    def check(self) -> None:
+        """已取消或已超时时抛出 Cancelled / DeadlineExceeded"""
+        if self.cancelled or self.expired:
+            raise self.error()
+
+    def sleep(self, seconds: float) -> None:
+        """等待 seconds 秒；期间到期或被取消时立即抛出"""
+        self.check()
+        remaining = self.remaining()
+        self._event.wait(seconds if remaining is None else min(seconds, remaining))
+        self.check()
+
+    def timeout_for(self, cap: float = REQUEST_TIMEOUT) -> float:
+        """一次阻塞调用可用的超时: min(cap, 剩余时间)；已取消或已超时时抛出"""
+        self.check()
+        remaining = self.remaining()
+        return cap if remaining is None else max(0.001, min(cap, remaining))
+
+    @contextmanager
+    def guard(self) -> Iterator["Deadline"]:
+        """包住一次网络调用: 调用因超时/取消而失败时改为抛出 DeadlineExceeded / Cancelled"""
+        self.check()
+        try:
+            yield self
+        except Cancelled:
+            raise
+        except Exception as e:
+            if self.cancelled or self.expired:
+                raise self.error() from e
+            raise
+
+
+def for_stage(stage: str, parent: Optional[Deadline] = None,
+              timeouts: Optional[Dict[str, Optional[float]]] = None) -> Deadline:
+    """按阶段的默认时限创建令牌（timeouts 可覆盖 STAGE_TIMEOUTS，没有配置的阶段不限时）"""
+    timeout = (timeouts if timeouts is not None else STAGE_TIMEOUTS).get(stage)
+    return Deadline(timeout, parent=parent, name=stage)
+
+
+def parse_timeouts(items) -> Dict[str, Optional[float]]:
+    """解析命令行的 "阶段=秒数" 列表，秒数为 0 表示该阶段不限时"""
+    timeouts: Dict[str, Optional[float]] = {}
+    for item in items or []:
+        stage, sep, value = item.partition("=")
+        if not sep or not stage.strip():
+            raise ValueError(f"时限格式应为 阶段=秒数: {item!r}")
+        seconds = float(value)
+        timeouts[stage.strip()] = seconds if seconds > 0 else None
+    return timeouts
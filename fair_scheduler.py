@@ -0,0 +1,239 @@
+"""
+多个项目共用服务商并发上限的加权公平调度
+
+一个进程原先只服务一个 shots.json；同时渲染几支 MV 时只能各开一个进程，各自按自己的并发数往同一个
+海螺额度、同一台 ComfyUI 上压任务，谁先提交谁占满。这里把每个服务商的并发上限做成全局共享的工作线程池，
+各项目的任务按加权公平排队（start-time fair queuing）派发:
+    - 每个项目在每个服务商处有自己的 FIFO 队列，任务入队时打上虚拟开始时间
+      S = max(服务商当前虚拟时间, 该项目上一个任务的虚拟结束时间)，结束时间 F = S + 1 / 权重；
+    - 有空闲并发时派发所有项目队首中 S 最小的任务，并把服务商的虚拟时间推进到 S；
+    - 一次提交 100 个分镜的项目只是把自己的结束时间排得很远，后来的 10 个分镜的项目从当前虚拟时间开始排，
+      立即与它交替执行（权重相同时各占一半），空闲过的项目也不会攒下额度一次性抢占。
+
+executors(project) 返回与 ThreadPoolExecutor 接口相同的各服务商“通道”，直接交给 BatchRunner 使用；
+stats() 给出各项目各服务商的排队、执行、完成数，平均等待，占用时间和吞吐量。
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+import logs
+import metrics
+
+logger = logs.get_logger("fair_scheduler")
+
+
+class _Job:
+    __slots__ = ("project", "fn", "future", "start_tag", "enqueued", "context")
+
+    def __init__(self, project: str, fn: Callable[[], Any], start_tag: float):
+        self.project = project
+        self.fn = fn
+        self.future: Future = Future()
+        self.start_tag = start_tag
+        self.enqueued = time.monotonic()
+        # 提交方的上下文（日志字段、花费记账）跟着任务走到工作线程
+        self.context = contextvars.copy_context()
+
+
+class _Lane:
+    """某个项目在某个服务商处的提交通道（submit / shutdown 与 ThreadPoolExecutor 相同）"""
+
+    def __init__(self, scheduler: "FairScheduler", project: str, provider: str):
+        self.scheduler = scheduler
+        self.project = project
+        self.provider = provider
+        self._pending: List[Future] = []
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        def call():
+            # 后续阶段常在上一个阶段的回调线程里提交, 项目名不能只靠提交方的上下文
+            with logs.context(project=self.project):
+                return fn(*args, **kwargs)
+
+        future = self.scheduler.submit(self.project, self.provider, call)
+        self._pending = [f for f in self._pending if not f.done()] + [future]
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        """共享线程池不随项目关闭；wait=True 时等本项目在该服务商的任务结束"""
+        if wait:
+            for future in list(self._pending):
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+
+
+class FairScheduler:
+    """各服务商一个共享的工作线程池，多个项目按权重公平地分享"""
+
+    def __init__(self, capacity: Dict[str, int]):
+        """
+        Args:
+            capacity: 各服务商的并发上限 {"seedream": n, "hailuo": n, "comfyui": n}，所有项目合计不超过它
+        """
+        self.capacity = {provider: max(1, n) for provider, n in capacity.items()}
+        self._cond = threading.Condition()
+        # 服务商 -> 项目 -> 排队中的任务
+        self._queues: Dict[str, Dict[str, Deque[_Job]]] = {p: {} for p in self.capacity}
+        # 服务商 -> 项目 -> 上一个任务的虚拟结束时间
+        self._finish: Dict[str, Dict[str, float]] = {p: {} for p in self.capacity}
+        self._vtime: Dict[str, float] = {p: 0.0 for p in self.capacity}
+        self._weights: Dict[str, float] = {}
+        # 项目 -> [第一次提交的时刻, 最近一次完成的时刻]，用于计算吞吐量
+        self._active: Dict[str, List[Optional[float]]] = {}
+        # 项目 -> 服务商 -> 计数和耗时
+        self._stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    def register(self, project: str, weight: float = 1.0) -> None:
+        """登记项目及其权重（权重 2 的项目在竞争时分到两倍的并发）"""
+        if weight <= 0:
+            raise ValueError(f"项目 {project} 的权重应大于 0: {weight}")
+        with self._cond:
+            self._weights[project] = weight
+            self._active.setdefault(project, [None, None])
+            self._stats.setdefault(project, {
+                provider: {"submitted": 0, "running": 0, "done": 0, "failed": 0, "wait": 0.0, "busy": 0.0}
+                for provider in self.capacity
+            })
+
+    def executors(self, project: str) -> Dict[str, _Lane]:
+        """项目在各服务商处的提交通道，可直接作为 BatchRunner 的 executors"""
+        if project not in self._weights:
+            self.register(project)
+        return {provider: _Lane(self, project, provider) for provider in self.capacity}
+
+    def start(self) -> "FairScheduler":
+        """启动各服务商的工作线程（重复调用无副作用）"""
+        with self._cond:
+            if self._threads:
+                return self
+            self._stopped = False
+            self._threads = [
+                threading.Thread(target=self._work, args=(provider,), name=f"{provider}-{i}", daemon=True)
+                for provider, n in self.capacity.items() for i in range(n)
+            ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        """停止工作线程（执行中的任务会执行完，排队中的任务被取消）"""
+        with self._cond:
+            self._stopped = True
+            for queues in self._queues.values():
+                for queue in queues.values():
+                    for job in queue:
+                        job.future.cancel()
+                    queue.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def submit(self, project: str, provider: str, fn: Callable[[], Any]) -> Future:
+        """按项目的权重把任务排进服务商的公平队列，返回 Future"""
+        if provider not in self.capacity:
+            raise ValueError(f"未知的服务商: {provider}")
+        with self._cond:
+            if project not in self._weights:
+                self.register(project)
+            start = max(self._vtime[provider], self._finish[provider].get(project, 0.0))
+            self._finish[provider][project] = start + 1.0 / self._weights[project]
+            job = _Job(project, fn, start)
+            self._queues[provider].setdefault(project, deque()).append(job)
+            self._stats[project][provider]["submitted"] += 1
+            if self._active[project][0] is None:
+                self._active[project][0] = job.enqueued
+            queued = len(self._queues[provider][project])
+            self._cond.notify_all()
+        metrics.PROJECT_QUEUED.set(queued, project=project, provider=provider)
+        return job.future
+
+    def _next(self, provider: str) -> Optional[_Job]:
+        """取出该服务商所有项目队首中虚拟开始时间最小的任务（调用方持有锁）"""
+        heads = [queue for queue in self._queues[provider].values() if queue]
+        if not heads:
+            return None
+        queue = min(heads, key=lambda q: q[0].start_tag)
+        job = queue.popleft()
+        self._vtime[provider] = max(self._vtime[provider], job.start_tag)
+        return job
+
+    def _work(self, provider: str) -> None:
+        while True:
+            with self._cond:
+                job = self._next(provider)
+                while job is None and not self._stopped:
+                    self._cond.wait()
+                    job = self._next(provider)
+                if job is None:
+                    return
+                stats = self._stats[job.project][provider]
+                stats["running"] += 1
+                queued = len(self._queues[provider][job.project])
+            metrics.PROJECT_QUEUED.set(queued, project=job.project, provider=provider)
+            if not job.future.set_running_or_notify_cancel():
+                with self._cond:
+                    stats["running"] -= 1
+                continue
+            waited = time.monotonic() - job.enqueued
+            metrics.PROJECT_WAIT_SECONDS.observe(waited, project=job.project, provider=provider)
+            started = time.monotonic()
+            try:
+                result = job.context.run(job.fn)
+            except BaseException as e:
+                status = "failed"
+                job.future.set_exception(e)
+            else:
+                status = "done"
+                job.future.set_result(result)
+            with self._cond:
+                stats["running"] -= 1
+                stats[status] += 1
+                stats["wait"] += waited
+                stats["busy"] += time.monotonic() - started
+                self._active[job.project][1] = time.monotonic()
+            metrics.PROJECT_JOBS.inc(project=job.project, provider=provider, status=status)
+
+    def stats(self) -> Dict[str, Any]:
+        """各项目的吞吐统计
+
+        Returns:
+            {项目: {"weight", "done", "failed", "throughput_per_min": 从第一次提交到最近一次完成平均每分钟完成的任务数,
+             "providers": {服务商: {"queued", "running", "done", "failed", "avg_wait": 平均排队秒数,
+             "busy_seconds", "share": 占该服务商全部占用时间的比例}}}}
+        """
+        with self._cond:
+            busy_total = {p: sum(s[p]["busy"] for s in self._stats.values()) for p in self.capacity}
+            result = {}
+            for project, providers in self._stats.items():
+                rows = {}
+                for provider, s in providers.items():
+                    started = s["done"] + s["failed"]
+                    rows[provider] = {
+                        "queued": len(self._queues[provider].get(project, ())),
+                        "running": int(s["running"]),
+                        "done": int(s["done"]),
+                        "failed": int(s["failed"]),
+                        "avg_wait": round(s["wait"] / started, 2) if started else 0.0,
+                        "busy_seconds": round(s["busy"], 1),
+                        "share": round(s["busy"] / busy_total[provider], 3) if busy_total[provider] else 0.0,
+                    }
+                done = sum(r["done"] for r in rows.values())
+                first, last = self._active[project]
+                minutes = (last - first) / 60 if first is not None and last is not None else 0.0
+                result[project] = {
+                    "weight": self._weights[project],
+                    "done": done,
+                    "failed": sum(r["failed"] for r in rows.values()),
+                    "throughput_per_min": round(done / minutes, 2) if minutes > 0 else 0.0,
+                    "providers": rows,
+                }
+            return result
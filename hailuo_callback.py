@@ -0,0 +1,164 @@
+"""
+海螺视频生成的回调接收端
+
+MiniMax 的视频生成接口支持 callback_url：任务状态变化时服务商主动 POST 到该地址。
+原先 HailuoVideoGenerator 只会每 10 秒轮询一次，几十个分镜同时生成时绝大部分请求都是在问“好了没有”，
+而且任务完成后最多要晚一个轮询间隔才能发现。
+
+这里提供一个内嵌的 HTTP 接收端：提交任务时带上它的地址，等待任务的线程阻塞在该任务的更新队列上，
+收到回调立即返回；轮询只作为回调丢失时的兜底（见 HailuoVideoGenerator.CALLBACK_POLL_INTERVAL）。
+
+协议:
+    - 服务商先 POST {"challenge": "..."} 验证地址，需要在 3 秒内原样返回 {"challenge": "..."}；
+    - 之后每次状态变化 POST {"task_id", "status": processing/success/failed, "file_id", "base_resp"}。
+
+接收端监听在所有网卡上，回调本身没有签名。为了不让任何人都能伪造任务失败或注入 file_id，
+回调地址带一个进程内随机生成的令牌（?token=...），路径或令牌不对的请求一律拒绝。
+"""
+import hmac
+import json
+import queue
+import secrets
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import logs
+
+logger = logs.get_logger("hailuo_callback")
+
+
+class CallbackReceiver:
+    """接收海螺回调，并按 task_id 交给等待中的线程"""
+    PATH = "/hailuo/callback"
+    # 最多为多少个任务保留尚未被取走的回调（回调可能比 submit 的返回更早到达）
+    MAX_TASKS = 10_000
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 0, public_url: Optional[str] = None):
+        """
+        Args:
+            host, port: 监听地址，port 为 0 时自动选择
+            public_url: 服务商访问本接收端使用的地址（经过反向代理或公网映射时需要），
+                默认 http://<host>:<port>/hailuo/callback；两种情况都会在末尾加上 token 参数
+        """
+        handler = type("Handler", (_CallbackHandler,), {"receiver": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        # 只有提交任务时交给服务商的地址里有这个令牌
+        self.token = secrets.token_urlsafe(24)
+        local_host = "127.0.0.1" if host in ("", "0.0.0.0") else host
+        self.base_url = public_url or f"http://{local_host}:{self.port}{self.PATH}"
+        self.url = f"{self.base_url}{'&' if urlsplit(self.base_url).query else '?'}token={self.token}"
+        self.received = 0
+        self._lock = threading.Lock()
+        # task_id -> 该任务尚未被取走的状态更新
+        self._updates: "OrderedDict[str, queue.Queue]" = OrderedDict()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "CallbackReceiver":
+        """在后台线程中开始接收"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.server.serve_forever, name="hailuo-callback", daemon=True)
+            self._thread.start()
+            logger.info("📨 海螺回调接收端已启动: 监听 %s, 回调地址 %s", self.port, self.base_url)
+        return self
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self._thread = None
+
+    def _queue(self, task_id: str) -> queue.Queue:
+        with self._lock:
+            updates = self._updates.get(task_id)
+            if updates is None:
+                updates = self._updates[task_id] = queue.Queue()
+                while len(self._updates) > self.MAX_TASKS:
+                    self._updates.popitem(last=False)
+            return updates
+
+    def authorized(self, path: str) -> Optional[int]:
+        """检查请求路径和令牌，通过时返回 None，否则返回应答的 HTTP 状态码"""
+        parts = urlsplit(path)
+        if parts.path.rstrip("/") != self.PATH:
+            return 404
+        token = parse_qs(parts.query).get("token", [""])[0]
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            return 403
+        return None
+
+    def deliver(self, data: Dict[str, Any]) -> bool:
+        """收到一条状态更新（由 HTTP 处理线程调用），没有 task_id 时忽略"""
+        task_id = data.get("task_id")
+        if not task_id:
+            return False
+        self._queue(str(task_id)).put(data)
+        with self._lock:
+            self.received += 1
+        logger.debug("收到回调: %s", data, extra={"provider": "hailuo", "task_id": str(task_id)})
+        return True
+
+    def wait(self, task_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """等待该任务的下一条状态更新，超时返回 None"""
+        try:
+            return self._queue(task_id).get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def discard(self, task_id: str) -> None:
+        """任务结束后丢弃它剩余的更新"""
+        with self._lock:
+            self._updates.pop(task_id, None)
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    receiver: CallbackReceiver = None
+
+    def _reply(self, data: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        rejected = self.receiver.authorized(self.path)
+        if rejected is not None:
+            logger.warning("🚫 拒绝回调请求 %s (来自 %s)", urlsplit(self.path).path, self.client_address[0])
+            self._reply({"error": "not found" if rejected == 404 else "forbidden"}, status=rejected)
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except (ValueError, UnicodeDecodeError):
+            self._reply({"error": "invalid json"}, status=400)
+            return
+        if not isinstance(data, dict):
+            self._reply({"error": "invalid payload"}, status=400)
+            return
+        if "challenge" in data:
+            # 地址验证: 原样返回 challenge
+            self._reply({"challenge": data["challenge"]})
+            return
+        self.receiver.deliver(data)
+        self._reply({"status": "ok"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+_receivers: Dict[int, CallbackReceiver] = {}
+_receivers_lock = threading.Lock()
+
+
+def get_receiver(port: int, host: str = "0.0.0.0", public_url: Optional[str] = None) -> CallbackReceiver:
+    """返回监听该端口的接收端（同一进程内多个客户端共用），首次调用时创建并启动"""
+    with _receivers_lock:
+        receiver = _receivers.get(port)
+        if receiver is None:
+            receiver = _receivers[port] = CallbackReceiver(host, port, public_url).start()
+        return receiver
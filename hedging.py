@@ -0,0 +1,288 @@
+"""
+海螺长尾任务的对冲重投
+
+同一批次里总有少数海螺任务要跑到中位数的 3~5 倍，整批的完成时间就由它们决定。
+打开对冲后（cli run --hedge-percentile），每个片段提交后都按本批次同类任务的耗时分布计时：
+    - 超过该片段时长对应的第 P 百分位还没完成时，用完全相同的请求再提交一份；
+    - 两份中先成功的一份胜出，另一份不下载（服务商侧仍会计费，海螺没有取消接口）；
+    - 每个片段最多对冲一次，对冲的额外花费累计不超过本批次的预算，预算用完后不再对冲。
+耗时样本不足 min_samples 个时不对冲（没有可信的分布）。
+
+最先完成的总是最快的那些任务，只用已完成的耗时算百分位会把阈值压得很低，几乎每个还在跑的片段都会被对冲。
+因此还在跑的片段也算作样本: 它们的耗时“至少是已等待的时间”（删失样本），阈值取 Kaplan-Meier
+生存曲线上的第 P 百分位；还在跑的片段越多、等得越久，阈值就越高。
+
+对冲胜出时原任务不会马上放弃，而是继续（只查状态）跟踪到它完成，由此得到真实节省的时间；
+在此之前它一直作为还在跑的片段计入分布，完成后记下真实耗时，长尾不会因为被对冲掉而从分布里消失。
+片段的耗时一律从原任务提交时算起。批次结束时 close() 停止跟踪，还没完成的原任务按“至少节省到此刻”计。report() 给出对冲次数、胜负、额外花费和节省的时间，写进运行汇总。
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+import logs
+import metrics
+from budget import current as current_budget
+from deadline import Deadline
+
+logger = logs.get_logger("hedging")
+
+# 默认在超过第 90 百分位时对冲
+DEFAULT_PERCENTILE = 90.0
+# 未指定预算时, 对冲的额外花费上限占本批次视频费用估算的比例
+DEFAULT_BUDGET_RATIO = 0.1
+# 开始对冲前每种片段时长至少需要的耗时样本数
+MIN_SAMPLES = 5
+# 样本不足时隔多久重新检查一次阈值(秒)
+RECHECK_INTERVAL = 5.0
+
+
+def survival_quantile(finished: List[float], running: List[float], q: float) -> Optional[float]:
+    """Kaplan-Meier 估计的耗时分布的 q 分位数 (0 < q < 1)
+
+    Args:
+        finished: 已完成任务的耗时
+        running: 还在跑的任务已等待的时间（真实耗时至少这么长）
+        q: 分位
+
+    Returns:
+        分位数(秒)；还在跑的任务太多、估计的完成比例达不到 q 时返回 None
+    """
+    # 时间相同时完成的排在还在跑的前面（还在跑的任务在这一刻仍处于风险集中）
+    points = sorted([(t, False) for t in finished] + [(t, True) for t in running])
+    at_risk, survival = len(points), 1.0
+    for seconds, censored in points:
+        if not censored:
+            survival *= 1 - 1 / at_risk
+            if 1 - survival >= q - 1e-9:
+                return seconds
+        at_risk -= 1
+    return None
+
+
+class HedgePolicy:
+    """一个批次内共用的对冲策略（线程安全）"""
+
+    def __init__(self, percentile: float = DEFAULT_PERCENTILE, budget: float = 0.0,
+                 min_samples: int = MIN_SAMPLES):
+        """
+        Args:
+            percentile: 任务耗时超过同类任务耗时分布的第几百分位时对冲 (0~100)
+            budget: 本批次对冲最多额外花费多少元
+            min_samples: 每种片段时长至少有多少个耗时样本后才开始对冲
+        """
+        if not 0 < percentile < 100:
+            raise ValueError(f"百分位应在 0~100 之间: {percentile}")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = max(1, min_samples)
+        self._lock = threading.Lock()
+        # 片段时长 -> 已完成任务从提交到成功的耗时
+        self._samples: Dict[Any, List[float]] = {}
+        # 片段时长 -> 还在跑的片段 -> 提交时刻（包括对冲胜出后仍在跟踪的原任务）
+        self._running: Dict[Any, Dict[object, float]] = {}
+        self.spent = 0.0
+        self.stats = {"launched": 0, "hedge_won": 0, "original_won": 0, "skipped_budget": 0,
+                      "saved_seconds": 0.0, "saved_lower_bound": 0}
+        # 对冲胜出后仍在跟踪的原任务: 令牌 -> (对冲胜出的时刻, 片段)
+        self._following: Dict[Deadline, Any] = {}
+
+    def threshold(self, key: Any) -> Optional[float]:
+        """该类任务的对冲阈值(秒)：已完成和还在跑的片段一起估计的第 P 百分位，已完成的样本不足时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            finished = list(self._samples.get(key, ()))
+            running = [now - since for since in self._running.get(key, {}).values()]
+        if len(finished) < self.min_samples:
+            return None
+        return survival_quantile(finished, running, self.percentile / 100)
+
+    def observe(self, key: Any, seconds: float) -> None:
+        """记录一个完成任务的耗时"""
+        with self._lock:
+            self._samples.setdefault(key, []).append(seconds)
+
+    def _track(self, key: Any, since: float) -> object:
+        """登记一个还在跑的片段，返回它的句柄"""
+        clip = object()
+        with self._lock:
+            self._running.setdefault(key, {})[clip] = since
+        return clip
+
+    def _untrack(self, key: Any, clip: object) -> None:
+        with self._lock:
+            self._running.get(key, {}).pop(clip, None)
+
+    def _reserve(self, cost: float) -> bool:
+        """从对冲预算里预留一次重投的费用；本次运行的花费上限（见 budget.Budget）放不下时同样放弃"""
+        run_budget = current_budget()
+        with self._lock:
+            ok = (self.spent + cost <= self.budget + 1e-9
+                  and (run_budget is None or run_budget.affordable(cost)))
+            if ok:
+                self.spent += cost
+            self.stats["launched" if ok else "skipped_budget"] += 1
+        metrics.HEDGES.inc(outcome="launched" if ok else "skipped_budget")
+        return ok
+
+    def _release(self, cost: float) -> None:
+        """对冲任务没能提交成功，退回预留的预算"""
+        with self._lock:
+            self.spent -= cost
+            self.stats["launched"] -= 1
+        metrics.HEDGES.inc(outcome="submit_failed")
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.stats[outcome] += 1
+        metrics.HEDGES.inc(outcome=outcome)
+
+    def race(self, task_id: str, submit: Callable[[], str], await_task: Callable[[str, Deadline], Any],
+             key: Any, cost: float, deadline: Deadline) -> Any:
+        """等待已提交的任务，超过阈值时再提交一份，返回先成功的一份的结果
+
+        Args:
+            task_id: 刚提交的任务（从现在开始计时）
+            submit: 用同样的请求再提交一次，返回新的 task_id
+            await_task: 等待某个任务完成并返回结果，例如 query_task_status
+            key: 耗时分布的分组，例如片段时长
+            cost: 再提交一次的费用（元）
+            deadline: 整个片段的截止时间/取消令牌，两份任务各用它的一个子令牌
+
+        Returns:
+            胜出任务的 await_task 结果
+        """
+        started = time.monotonic()
+        clip = self._track(key, started)
+        following = False
+        tokens: Dict[Any, Deadline] = {}
+        labels: Dict[Any, str] = {}
+
+        def timed(tid: str, token: Deadline, since: float):
+            result = await_task(tid, token)
+            return result, time.monotonic() - since
+
+        # 败者可能正卡在一次查询请求里, 不等它的线程结束
+        pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+
+        def launch(tid: str, label: str, since: float):
+            token = deadline.child()
+            # 每个线程一份上下文副本, 日志仍然带着分镜和阶段
+            future = pool.submit(contextvars.copy_context().run, timed, tid, token, since)
+            tokens[future], labels[future] = token, label
+            return future
+
+        try:
+            pending = {launch(task_id, "original", started)}
+            decided = False
+            first_error: Optional[BaseException] = None
+            while pending:
+                timeout = None
+                if not decided:
+                    threshold = self.threshold(key)
+                    timeout = RECHECK_INTERVAL if threshold is None else max(0.0, started + threshold - time.monotonic())
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    error = future.exception()
+                    if error is not None:
+                        first_error = first_error or error
+                        continue
+                    result, seconds = future.result()
+                    if len(tokens) > 1:
+                        # 对冲胜出时原任务还没完成, 继续作为还在跑的片段计入分布, 完成后记下真实耗时
+                        following = self._settle(labels[future], key, clip, pending, tokens)
+                    if not following:
+                        self.observe(key, seconds)
+                    return result
+                if not pending or decided or deadline.cancelled or deadline.expired:
+                    continue
+                threshold = self.threshold(key)
+                if threshold is None or time.monotonic() - started < threshold:
+                    continue
+                # 每个片段只决定一次是否对冲
+                decided = True
+                remaining = deadline.remaining()
+                if remaining is not None and remaining < threshold:
+                    # 剩余时间不够再跑一个阈值长度的任务, 对冲只会白花钱
+                    continue
+                if not self._reserve(cost):
+                    logger.info("💸 对冲预算已用完 (%.2f/%.2f 元), 继续等待原任务 %s", self.spent, self.budget, task_id)
+                    continue
+                try:
+                    hedge_id = submit()
+                except Exception as e:
+                    self._release(cost)
+                    logger.warning("⚠️ 对冲任务提交失败, 继续等待原任务 %s - %s", task_id, e)
+                    continue
+                logger.info("🔁 任务 %s 已等待 %.0fs (超过 P%g=%.0fs), 重新提交为 %s",
+                            task_id, time.monotonic() - started, self.percentile, threshold, hedge_id)
+                # 片段的耗时从原任务提交时算起
+                pending.add(launch(hedge_id, "hedge", started))
+            raise first_error
+        finally:
+            if not following:
+                self._untrack(key, clip)
+            pool.shutdown(wait=False)
+
+    def _settle(self, winner: str, key: Any, clip: object, pending, tokens: Dict[Any, Deadline]) -> bool:
+        """记录一次对冲的结果；对冲胜出时继续跟踪原任务以测出节省的时间，原任务胜出时直接放弃对冲任务
+
+        Returns:
+            是否仍在跟踪原任务（此时由 _followed / close 注销片段）
+        """
+        if winner == "original":
+            for future in pending:
+                tokens[future].cancel("原任务已完成")
+            self._count("original_won")
+            return False
+        logger.info("🏁 对冲任务先完成, 继续跟踪原任务以统计节省的时间")
+        self._count("hedge_won")
+        won_at = time.monotonic()
+        for future in pending:
+            token = tokens[future]
+            with self._lock:
+                self._following[token] = (won_at, clip)
+            future.add_done_callback(lambda f, token=token: self._followed(f, key, token))
+        return bool(pending)
+
+    def _followed(self, future, key: Any, token: Deadline) -> None:
+        """被对冲掉的原任务结束了: 完成时记下样本和真实节省的时间"""
+        with self._lock:
+            won_at, clip = self._following.pop(token, (None, None))
+        if clip is not None:
+            self._untrack(key, clip)
+        if won_at is None or future.cancelled() or future.exception() is not None:
+            # 原任务失败, 或者已在 close 时按下限计入
+            return
+        _, seconds = future.result()
+        self.observe(key, seconds)
+        with self._lock:
+            self.stats["saved_seconds"] += max(0.0, time.monotonic() - won_at)
+
+    def close(self) -> None:
+        """批次结束: 停止跟踪仍未完成的原任务，它们节省的时间按“至少到此刻”计入"""
+        now = time.monotonic()
+        with self._lock:
+            following, self._following = self._following, {}
+            for won_at, clip in following.values():
+                self.stats["saved_seconds"] += now - won_at
+                self.stats["saved_lower_bound"] += 1
+                for running in self._running.values():
+                    running.pop(clip, None)
+        for token in following:
+            token.cancel("批次已结束")
+
+    def report(self) -> Dict[str, Any]:
+        """本批次对冲的汇总: 次数、胜负、额外花费和节省的时间（saved_lower_bound 个只是下限）"""
+        with self._lock:
+            samples = sum(len(v) for v in self._samples.values())
+            return {
+                "percentile": self.percentile,
+                "budget": round(self.budget, 2),
+                "spent": round(self.spent, 2),
+                **{k: v for k, v in self.stats.items() if k != "saved_seconds"},
+                "saved_seconds": round(self.stats["saved_seconds"], 1),
+                "samples": samples,
+            }
@@ -0,0 +1,558 @@
+"""
+进程内的后台任务服务
+
+批量生成原先直接跑在 Gradio 事件里：刷新页面、请求超时或另一个人再点一次按钮，
+都可能重复提交付费任务或丢掉结果。这里把任务放进 SQLite 持久化队列，由固定的工作线程池执行，
+界面只负责提交和轮询：
+  - 任务键由 (分镜 id, 阶段, 参数) 决定，相同的任务排队或执行中时重复提交只会挂到同一个任务上
+  - 一批任务的批次 id 由其任务键决定，多个浏览器会话点同一个按钮会看到同一个批次的进度
+  - 任务可以依赖另一个任务（重复分镜等代表分镜完成后再复用），被依赖的任务失败时一并失败
+  - 进程退出时还在执行的任务，下次启动后重新排队
+  - 任务分两个优先级通道: 单个分镜的交互操作（interactive）插到批量任务（batch）前面执行，
+    并预留少量工作线程只给交互任务用; 同时批量任务至少保有 batch_share 比例的工作线程，不会被交互任务饿死
+  - 每个服务商另有并发上限（provider_limits，默认 ComfyUI 同时只跑一个），通道的预留和保底在每个服务商内部同样适用
+  - 每个任务带一个按阶段时限创建的 Deadline，超时的任务记为 timeout、取消的记为 cancelled，工作线程立即释放
+  - 付费任务派发前按费用模型预留预估费用（见 budget.Budget），放不下时批量任务留在队列里暂停派发，
+    交互任务直接失败；同一通道里从未生成过的分镜先于重新生成（rerun）的分镜派发。花费上限只管本次启动以来
+    （或上次 reset_budget 以来）的花费；真实花费全部记入 spend 表，项目累计花费见 stats()["budget"]["total_spent"]
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import logs
+import metrics
+import tracing
+from budget import Budget, charging
+from deadline import Cancelled, Deadline, for_stage
+
+logger = logs.get_logger("jobs")
+
+ACTIVE = ("queued", "running")
+INTERACTIVE = "interactive"
+BATCH = "batch"
+LANES = (INTERACTIVE, BATCH)
+# 各阶段调用的服务商, 其他阶段（复用代表分镜的结果）只在本地执行
+STAGE_PROVIDERS = {"first_frame": "seedream", "video": "hailuo", "lip_sync": "comfyui"}
+LOCAL = "local"
+# 各服务商同时执行的任务数上限, 与 BatchRunner.DEFAULT_WORKERS 一致（一个 ComfyUI 客户端同一时刻只能跟踪一个工作流）
+PROVIDER_LIMITS = {"seedream": 10, "hailuo": 10, "comfyui": 1}
+
+
+def job_key(shot_id: Any, stage: str, params: Dict[str, Any]) -> str:
+    """任务的幂等键: 同一分镜、同一阶段、同样参数的请求得到同一个键"""
+    payload = json.dumps([shot_id, stage, params], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class JobService:
+    """SQLite 持久化队列 + 工作线程池"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        key TEXT PRIMARY KEY,
+        shot_index INTEGER NOT NULL,
+        shot_id TEXT,
+        stage TEXT NOT NULL,
+        params TEXT NOT NULL,
+        after TEXT,
+        status TEXT NOT NULL,
+        priority TEXT NOT NULL DEFAULT 'batch',
+        rerun INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        queued_at REAL,
+        started_at REAL,
+        finished_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, queued_at);
+    CREATE INDEX IF NOT EXISTS jobs_lane ON jobs (status, priority, queued_at);
+    CREATE TABLE IF NOT EXISTS batches (
+        id TEXT PRIMARY KEY,
+        stage TEXT NOT NULL,
+        keys TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS spend (
+        job_key TEXT,
+        stage TEXT NOT NULL,
+        amount REAL NOT NULL,
+        at REAL NOT NULL
+    );
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 runner: Callable[..., Optional[str]],
+                 max_workers: int = 20,
+                 interactive_reserve: int = 2,
+                 batch_share: float = 0.25,
+                 trace_dir: Optional[str] = None,
+                 timeouts: Optional[Dict[str, Optional[float]]] = None,
+                 estimator: Optional[Callable[[str, int, Dict[str, Any]], float]] = None,
+                 budget_limit: Optional[float] = None,
+                 provider_limits: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            db_path: 队列数据库路径
+            runner: 执行任务的函数 fn(阶段, 分镜下标, 参数, deadline=Deadline) -> 结果文件路径
+            max_workers: 工作线程数（即同时调用服务商的任务数上限）
+            interactive_reserve: 只给交互任务使用的工作线程数，批量任务最多占用其余线程
+            batch_share: 有批量任务排队时，批量任务至少占用的工作线程比例
+            trace_dir: 每个批次结束后把它的时间线写到 <trace_dir>/<批次 id>.json，为 None 时不导出
+            timeouts: 各阶段的时限(秒)，默认 deadline.STAGE_TIMEOUTS，没有配置的阶段不限时
+            estimator: 估算任务费用的函数 fn(阶段, 分镜下标, 参数) -> 元，为 None 时所有任务视为免费
+            budget_limit: 本次会话的花费上限(元)，None 为不限（仍然记账）；之前的会话记下的花费不计入
+            provider_limits: 覆盖 PROVIDER_LIMITS 中各服务商的并发上限，没有上限的服务商最多占用 max_workers 个线程
+        """
+        self.db_path = Path(db_path)
+        self.runner = runner
+        self.max_workers = max_workers
+        self.batch_max = max(1, max_workers - interactive_reserve)
+        self.batch_min = min(self.batch_max, max(1, int(max_workers * batch_share)))
+        self.interactive_reserve = interactive_reserve
+        self.batch_share = batch_share
+        self.provider_limits = {**PROVIDER_LIMITS, **(provider_limits or {})}
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 所有线程共用一个连接, 由 _cond 的锁串行化
+        self._db = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = {r["name"] for r in self._db.execute("PRAGMA table_info(jobs)")}
+        if columns and "priority" not in columns:
+            # 没有优先级通道之前创建的队列
+            self._db.execute("ALTER TABLE jobs ADD COLUMN priority TEXT NOT NULL DEFAULT 'batch'")
+        if columns and "rerun" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN rerun INTEGER NOT NULL DEFAULT 0")
+        self._db.executescript(self.SCHEMA)
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.trace_dir = Path(trace_dir) if trace_dir else None
+        self.timeouts = timeouts
+        # 本进程中提交、还没结束的批次 -> 提交时间
+        self._open_batches: Dict[str, float] = {}
+        # 正在执行的任务键 -> 它的截止时间/取消令牌
+        self._deadlines: Dict[str, Deadline] = {}
+        self.estimator = estimator
+        # 花费上限按会话计算, 否则界面上设的上限会变成整个项目永不清零的终身上限
+        self.session_started = time.time()
+        self.budget = Budget(budget_limit, on_charge=self._record_spend)
+        # 上次进程退出时还在执行的任务重新排队
+        with self._cond:
+            recovered = self._db.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        if recovered:
+            logger.info("♻️ %d 个上次中断的任务已重新排队", recovered)
+
+    def start(self) -> None:
+        """启动工作线程（重复调用无副作用）"""
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{n}", daemon=True)
+            for n in range(self.max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """停止工作线程（正在执行的任务会执行完，但不再领取新任务）"""
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+
+    def submit(self, shot_index: int, shot_id: Any, stage: str, params: Dict[str, Any],
+               after: Optional[str] = None, priority: str = BATCH, rerun: bool = False) -> str:
+        """提交一个任务，返回任务键
+
+        相同的任务正在排队或执行时直接返回已有任务（交互提交会把排队中的批量任务提到交互通道）；
+        已结束的任务重新排队（即重新生成）。rerun 表示该分镜已有这一阶段的素材，派发时排在从未生成过的分镜之后。
+        """
+        if priority not in LANES:
+            raise ValueError(f"未知的优先级: {priority}")
+        key = job_key(shot_id, stage, params)
+        with self._cond:
+            self._enqueue(key, shot_index, shot_id, stage, params, after, priority, rerun)
+            self._cond.notify_all()
+        return key
+
+    def _enqueue(self, key: str, shot_index: int, shot_id: Any, stage: str,
+                 params: Dict[str, Any], after: Optional[str], priority: str = BATCH, rerun: bool = False) -> None:
+        row = self._db.execute("SELECT status FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row and row["status"] in ACTIVE:
+            if priority == INTERACTIVE:
+                self._db.execute("UPDATE jobs SET priority = ? WHERE key = ? AND status = 'queued'", (priority, key))
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (key, shot_index, shot_id, stage, params, after, status, priority, "
+            "rerun, attempts, queued_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (key, shot_index, str(shot_id), stage, json.dumps(params, ensure_ascii=False, default=str),
+             after, priority, int(rerun), 0, time.time()),
+        )
+
+    def wait(self, key: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """等待任务结束并返回任务记录，超时抛出 TimeoutError"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                row = self._db.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    raise KeyError(f"任务不存在: {key}")
+                if row["status"] not in ACTIVE:
+                    return dict(row)
+                if deadline is not None and time.time() >= deadline:
+                    raise TimeoutError(f"等待任务超时: 分镜 {row['shot_id']} {row['stage']}")
+                self._cond.wait(timeout=1.0 if deadline is None else min(1.0, max(0.0, deadline - time.time())))
+
+    def call(self, shot_index: int, shot_id: Any, stage: str, params: Dict[str, Any],
+             priority: str = INTERACTIVE, timeout: Optional[float] = None) -> Optional[str]:
+        """提交任务并等待完成，返回结果文件路径；任务失败或被取消时抛出 RuntimeError"""
+        job = self.wait(self.submit(shot_index, shot_id, stage, params, priority=priority), timeout=timeout)
+        if job["status"] != "done":
+            raise RuntimeError(job["error"] or job["status"])
+        return job["result"]
+
+    def submit_batch(self, stage: str, jobs: Iterable[Dict[str, Any]]) -> str:
+        """提交一批任务，返回批次 id
+
+        jobs 的每一项为 {"shot_index", "shot_id", "stage", "params", "after": 依赖的 shot_index 或 None,
+        "rerun": 可选, 是否重新生成}。
+        同样的一批任务还有未结束的任务时，直接挂到正在运行的批次上，不重新排队任何任务。
+        """
+        jobs = list(jobs)
+        keys = {job["shot_index"]: job_key(job["shot_id"], job["stage"], job["params"]) for job in jobs}
+        batch_id = hashlib.sha1(json.dumps([stage, sorted(keys.values())]).encode()).hexdigest()[:16]
+        with self._cond:
+            if self._batch_active(batch_id):
+                return batch_id
+            self._db.execute("BEGIN")
+            try:
+                # 先提交被依赖的任务
+                for job in sorted(jobs, key=lambda j: j.get("after") is not None):
+                    after = keys.get(job.get("after")) if job.get("after") is not None else None
+                    self._enqueue(keys[job["shot_index"]], job["shot_index"], job["shot_id"],
+                                  job["stage"], job["params"], after, rerun=job.get("rerun", False))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO batches (id, stage, keys, created) VALUES (?, ?, ?, ?)",
+                    (batch_id, stage, json.dumps(list(keys.values())), time.time()),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._open_batches[batch_id] = tracing.now()
+            self._cond.notify_all()
+        return batch_id
+
+    def _export_finished_traces(self) -> None:
+        """把已经结束的批次的时间线导出为 Chrome trace"""
+        if self.trace_dir is None or not tracing.TRACER.enabled:
+            return
+        with self._cond:
+            finished = {batch_id: since for batch_id, since in self._open_batches.items()
+                        if not self._batch_active(batch_id)}
+            for batch_id in finished:
+                del self._open_batches[batch_id]
+        for batch_id, since in finished.items():
+            try:
+                path = self.trace_dir / f"{batch_id}.json"
+                tracing.export(str(path), since=since, metadata={"batch": batch_id})
+                logger.info("🧭 批次 %s 的时间线已保存至 %s", batch_id, path)
+            except Exception as e:
+                logger.warning("⚠️ 批次 %s 的时间线导出失败: %s", batch_id, e)
+
+    def _batch_keys(self, batch_id: str) -> List[str]:
+        row = self._db.execute("SELECT keys FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return json.loads(row["keys"]) if row else []
+
+    def _batch_active(self, batch_id: str) -> bool:
+        keys = self._batch_keys(batch_id)
+        if not keys:
+            return False
+        marks = ",".join("?" * len(keys))
+        return self._db.execute(
+            f"SELECT 1 FROM jobs WHERE key IN ({marks}) AND status IN {ACTIVE} LIMIT 1", keys
+        ).fetchone() is not None
+
+    def batch(self, batch_id: str) -> Dict[str, Any]:
+        """返回批次及其所有任务的状态
+
+        Returns:
+            {"id", "stage", "active", "jobs": [{"key", "shot_index", "shot_id", "stage", "params", "status",
+             "result", "error", "finished_at"}]}
+        """
+        with self._cond:
+            row = self._db.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"批次不存在: {batch_id}")
+            keys = json.loads(row["keys"])
+            marks = ",".join("?" * len(keys))
+            jobs = [dict(r) for r in self._db.execute(
+                f"SELECT key, shot_index, shot_id, stage, params, status, result, error, finished_at "
+                f"FROM jobs WHERE key IN ({marks}) ORDER BY shot_index", keys)] if keys else []
+        return {
+            "id": batch_id,
+            "stage": row["stage"],
+            "active": any(job["status"] in ACTIVE for job in jobs),
+            "jobs": [{**job, "params": json.loads(job["params"])} for job in jobs],
+        }
+
+    def active_batches(self, stage: Optional[str] = None) -> List[str]:
+        """还有未结束任务的批次 id（最新的在前）"""
+        with self._cond:
+            rows = self._db.execute("SELECT id, stage FROM batches ORDER BY created DESC").fetchall()
+            return [r["id"] for r in rows
+                    if (stage is None or r["stage"] == stage) and self._batch_active(r["id"])]
+
+    def recent_batches(self, stage: Optional[str] = None, limit: int = 10) -> List[str]:
+        """最近提交的批次 id（最新的在前）"""
+        with self._cond:
+            if stage is None:
+                rows = self._db.execute("SELECT id FROM batches ORDER BY created DESC LIMIT ?", (limit,))
+            else:
+                rows = self._db.execute("SELECT id FROM batches WHERE stage = ? ORDER BY created DESC LIMIT ?",
+                                        (stage, limit))
+            return [r["id"] for r in rows]
+
+    def cancel_batch(self, batch_id: str) -> int:
+        """取消批次中的任务，返回取消的任务数
+
+        排队中的任务直接记为 cancelled；正在执行的任务通过其 Deadline 取消，
+        客户端在下一次请求或等待时放弃（ComfyUI 任务会从队列中撤下），随后同样记为 cancelled。
+        """
+        with self._cond:
+            keys = self._batch_keys(batch_id)
+            if not keys:
+                return 0
+            marks = ",".join("?" * len(keys))
+            cancelled = self._db.execute(
+                f"UPDATE jobs SET status = 'cancelled', error = '已取消', finished_at = ? "
+                f"WHERE key IN ({marks}) AND status = 'queued'", [time.time(), *keys]
+            ).rowcount
+            running = [self._deadlines[key] for key in keys if key in self._deadlines]
+            self._cond.notify_all()
+        for deadline in running:
+            deadline.cancel("批次已取消")
+        cancelled += len(running)
+        self._export_finished_traces()
+        return cancelled
+
+    def _running(self) -> Dict[str, Dict[str, int]]:
+        """各服务商正在执行的任务数: {服务商: {通道: 数量}}，另有 "all" 为所有服务商合计"""
+        counts: Dict[str, Dict[str, int]] = {"all": {lane: 0 for lane in LANES}}
+        rows = self._db.execute(
+            "SELECT stage, priority, COUNT(*) AS n FROM jobs WHERE status = 'running' GROUP BY stage, priority")
+        for r in rows:
+            provider = counts.setdefault(STAGE_PROVIDERS.get(r["stage"], LOCAL), {lane: 0 for lane in LANES})
+            provider[r["priority"]] += r["n"]
+            counts["all"][r["priority"]] += r["n"]
+        return counts
+
+    def provider_limit(self, provider: str) -> int:
+        """服务商同时执行的任务数上限"""
+        return min(self.max_workers, max(1, self.provider_limits.get(provider, self.max_workers)))
+
+    def _lane_order(self, provider: str, running: Dict[str, int]) -> Optional[List[str]]:
+        """服务商内部可以领取的通道，按优先顺序排列；服务商已满时返回 None
+
+        与全局的通道规则相同: 预留 interactive_reserve 个位置只给交互任务（上限只有 1 时不预留），
+        批量任务少于 batch_share 比例时先给批量任务。
+        """
+        limit = self.provider_limit(provider)
+        if sum(running.values()) >= limit:
+            return None
+        batch_max = max(1, limit - self.interactive_reserve)
+        # 这里不保底 1 个, 否则上限为 1 的服务商（ComfyUI）有批量任务排队时交互任务永远排不上
+        batch_min = min(batch_max, int(limit * self.batch_share))
+        if running[BATCH] >= batch_max:
+            return [INTERACTIVE]
+        return [BATCH, INTERACTIVE] if running[BATCH] < batch_min else [INTERACTIVE, BATCH]
+
+    def _cost(self, row: sqlite3.Row) -> float:
+        if self.estimator is None:
+            return 0.0
+        return self.estimator(row["stage"], row["shot_index"], json.loads(row["params"]))
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """领取一个可以执行的任务（依赖已完成），没有时返回 None
+
+        交互任务优先；但批量任务占用的线程少于 batch_min 时先给批量任务，且批量任务最多占用 batch_max 个线程。
+        每个服务商的任务数不超过它的并发上限，服务商内部按同样的规则分配通道（见 _lane_order）。
+        同一通道内从未生成过的分镜先于重新生成的分镜。付费任务领取时按预估费用预留额度:
+        放不下的交互任务直接失败（点按钮的人立刻看到原因）；放不下的批量任务留在队列里，
+        排在它后面的付费任务也不再派发（不让低价值的任务插队），免费任务照常执行，直到上限调高或有预留退回。
+        """
+        running = self._running()
+        global_lanes = [BATCH, INTERACTIVE] if running["all"][BATCH] < self.batch_min else [INTERACTIVE, BATCH]
+        if running["all"][BATCH] >= self.batch_max:
+            global_lanes.remove(BATCH)
+        rows = self._db.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND "
+            "(after IS NULL OR after IN (SELECT key FROM jobs WHERE status = 'done')) "
+            "ORDER BY rerun, queued_at"
+        ).fetchall()
+        # 先按各服务商内部的通道顺序, 再按全局的通道顺序排列; 服务商已满或通道不可领取的任务留在队列里
+        candidates = []
+        for row in rows:
+            provider = STAGE_PROVIDERS.get(row["stage"], LOCAL)
+            lanes = self._lane_order(provider, running.get(provider, {lane: 0 for lane in LANES}))
+            lane = row["priority"]
+            if lanes is None or lane not in lanes or lane not in global_lanes:
+                continue
+            candidates.append((lanes.index(lane), global_lanes.index(lane), row))
+        candidates.sort(key=lambda c: c[:2])
+        blocked = None
+        blocked_lanes = set()
+        for _, _, row in candidates:
+            lane = row["priority"]
+            cost = self._cost(row)
+            if cost <= 0:
+                return self._start(row)
+            if lane not in blocked_lanes and self.budget.reserve(row["key"], cost):
+                if lane == BATCH:
+                    self.budget.resume()
+                return self._start(row)
+            reason = (f"花费上限不足: 分镜 {row['shot_id']} {row['stage']} 预计 ¥{cost:g}, "
+                      f"剩余 ¥{self.budget.remaining():.2f}")
+            if lane == INTERACTIVE:
+                self._finish(row["key"], "failed", error=reason)
+                continue
+            blocked_lanes.add(lane)
+            blocked = blocked or reason
+        if blocked:
+            self.budget.pause(f"{blocked}，批量任务暂停派发")
+        else:
+            self.budget.resume()
+        return None
+
+    def _start(self, row: sqlite3.Row) -> sqlite3.Row:
+        self._db.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE key = ?",
+            (time.time(), row["key"]),
+        )
+        return row
+
+    def stats(self, window: float = 3600.0) -> Dict[str, Any]:
+        """各优先级通道的队列指标
+
+        Args:
+            window: 统计等待时间和完成数的时间窗口（秒）
+
+        Returns:
+            {"workers", "batch_min", "batch_max", 通道: {"queued", "running", "done", "failed", "timeout",
+             "avg_wait", "max_wait": 窗口内开始执行的任务的排队时间（秒）, "oldest_queued": 最早排队任务已等待的时间},
+             "providers": {服务商: {"limit", "running"}},
+             "budget": 本次会话的花费上限、已花费、预留、剩余、各阶段花费和暂停原因（见 Budget.report），
+             另有 session_started 和 total_spent（spend 表中项目累计的花费）}
+        """
+        now = time.time()
+        result: Dict[str, Any] = {"workers": self.max_workers, "batch_min": self.batch_min, "batch_max": self.batch_max,
+                                  "budget": self.budget.report()}
+        with self._cond:
+            total = self._db.execute("SELECT SUM(amount) AS amount FROM spend").fetchone()["amount"]
+            result["budget"].update(session_started=self.session_started, total_spent=round(total or 0.0, 2))
+            running = self._running()
+            result["providers"] = {
+                provider: {"limit": self.provider_limit(provider), "running": sum(running.get(provider, {}).values())}
+                for provider in sorted(set(self.provider_limits) | set(running) - {"all"})
+            }
+            for lane in LANES:
+                counts = {r["status"]: r["n"] for r in self._db.execute(
+                    "SELECT status, COUNT(*) AS n FROM jobs WHERE priority = ? AND "
+                    "(status IN ('queued', 'running') OR finished_at >= ?) GROUP BY status", (lane, now - window))}
+                waits = self._db.execute(
+                    "SELECT AVG(started_at - queued_at) AS avg_wait, MAX(started_at - queued_at) AS max_wait "
+                    "FROM jobs WHERE priority = ? AND started_at >= ?", (lane, now - window)).fetchone()
+                oldest = self._db.execute(
+                    "SELECT MIN(queued_at) AS t FROM jobs WHERE priority = ? AND status = 'queued'", (lane,)
+                ).fetchone()["t"]
+                result[lane] = {
+                    **{status: counts.get(status, 0) for status in ("queued", "running", "done", "failed", "timeout")},
+                    "avg_wait": round(waits["avg_wait"] or 0.0, 2),
+                    "max_wait": round(waits["max_wait"] or 0.0, 2),
+                    "oldest_queued": round(now - oldest, 2) if oldest else 0.0,
+                }
+        return result
+
+    def set_budget(self, limit: Optional[float]) -> None:
+        """调整花费上限（元，None 为不限），调高后暂停的批量任务继续派发"""
+        with self._cond:
+            self.budget.set_limit(limit)
+            self._cond.notify_all()
+
+    def reset_budget(self) -> None:
+        """开始新的花费会话: 已花费清零（spend 表保留全部记录），因额度不足暂停的批量任务继续派发"""
+        with self._cond:
+            self.session_started = time.time()
+            self.budget.reset()
+            self._cond.notify_all()
+
+    def _record_spend(self, stage: str, amount: float, key: Optional[str]) -> None:
+        with self._cond:
+            self._db.execute("INSERT INTO spend (job_key, stage, amount, at) VALUES (?, ?, ?, ?)",
+                             (key, stage, amount, time.time()))
+
+    def _finish(self, key: str, status: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        with self._cond:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE key = ?",
+                (status, result, error, time.time(), key),
+            )
+            if status != "done":
+                # 依赖它的任务无法执行
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+                    "WHERE after = ? AND status = 'queued'",
+                    (f"依赖的任务未完成: {error}", time.time(), key),
+                )
+            self._cond.notify_all()
+
+    def _work(self) -> None:
+        while not self._stopped.is_set():
+            with self._cond:
+                job = self._claim()
+                if job is None:
+                    self._cond.wait(timeout=1.0)
+                    continue
+                # 时限从开始执行时算起, 排队时间不计入
+                deadline = self._deadlines[job["key"]] = for_stage(job["stage"], timeouts=self.timeouts)
+            started = time.perf_counter()
+            try:
+                with logs.context(shot=job["shot_id"], stage=job["stage"]), \
+                        charging(self.budget, job["stage"], job["key"]), \
+                        tracing.span(f"job.{job['stage']}", cat="job", shot=job["shot_id"], stage=job["stage"],
+                                     lane=job["priority"], attempt=job["attempts"] + 1,
+                                     waited=round(time.time() - job["queued_at"], 3)):
+                    result = self.runner(job["stage"], job["shot_index"], json.loads(job["params"]),
+                                         deadline=deadline)
+                self._finish(job["key"], "done", result=str(result) if result else None)
+                status = "done"
+            except Cancelled as e:
+                status = e.reason
+                logger.warning("⏰ 任务%s 分镜 %s %s: %s", "超时" if status == "timeout" else "已取消",
+                               job["shot_id"], job["stage"], e, extra={"shot": job["shot_id"], "stage": job["stage"]})
+                self._finish(job["key"], status, error=str(e))
+            except Exception as e:
+                logger.error("❌ 任务失败 分镜 %s %s: %s", job["shot_id"], job["stage"], e,
+                             extra={"shot": job["shot_id"], "stage": job["stage"]})
+                self._finish(job["key"], "failed", error=str(e))
+                status = "failed"
+            finally:
+                with self._cond:
+                    self._deadlines.pop(job["key"], None)
+                # 没用完的预留退回, 暂停的批量任务可能又放得下了
+                self.budget.release(job["key"])
+                with self._cond:
+                    self._cond.notify_all()
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage=job["stage"])
+            metrics.JOBS_TOTAL.inc(stage=job["stage"], status=status)
+            self._export_finished_traces()
@@ -0,0 +1,46 @@
+import threading
+from typing import Any, Callable
+
+
+class LazyClient:
+    """
+    API 客户端的延迟构造代理
+
+    第一次访问属性时才调用工厂函数创建真实客户端（以及导入其依赖的 SDK），
+    之后所有属性访问都转发给真实客户端。多线程同时首次访问时只会构造一次。
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        """
+        :param factory: 无参工厂函数，返回真实的客户端实例
+        """
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _resolve(self) -> Any:
+        """返回真实客户端，必要时先构造"""
+        instance = object.__getattribute__(self, "_instance")
+        if instance is None:
+            with object.__getattribute__(self, "_lock"):
+                instance = object.__getattribute__(self, "_instance")
+                if instance is None:
+                    instance = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+
+    @property
+    def is_created(self) -> bool:
+        """真实客户端是否已经被构造"""
+        return object.__getattribute__(self, "_instance") is not None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._resolve(), name, value)
+
+    def __repr__(self) -> str:
+        if self.is_created:
+            return f"LazyClient({object.__getattribute__(self, '_instance')!r})"
+        return "LazyClient(<未创建>)"
@@ -0,0 +1,164 @@
+"""
+结构化日志：工作线程只把日志记录放进队列，由单独的线程格式化并写出
+
+二十个工作线程和 ComfyUI 的 WebSocket 线程原先都直接 print，输出互相穿插，`\\r` 进度行每秒改写一次。
+这里统一改为标准 logging：
+    - 记录经 QueueHandler 放入内存队列，写 stderr 的工作只在监听线程里做，调用方不会被 I/O 阻塞；
+    - 每条记录自动带上当前上下文中的 分镜 id、阶段、服务商、task_id/prompt_id（见 context）；
+    - 输出为单行文本或 JSON 行（MV_LOG_FORMAT=json，或命令行 --log-json），便于日志聚合；
+    - 轮询类的进度通过 progress 限速输出，不再每次轮询打印一行。
+
+日志级别用环境变量 MV_LOG_LEVEL 设置（默认 INFO）。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+# 每条记录携带的上下文字段
+FIELDS = ("project", "shot", "stage", "provider", "task_id", "prompt_id")
+# 进度类事件的默认最小输出间隔(秒)
+PROGRESS_INTERVAL = 10.0
+
+_context: ContextVar[Dict[str, Any]] = ContextVar("mv_log_context", default={})
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+_progress_last: Dict[str, float] = {}
+_progress_lock = threading.Lock()
+
+
+@contextmanager
+def context(**fields) -> Iterator[Dict[str, Any]]:
+    """在 with 块内为本线程的日志记录附加上下文字段（值为 None 的字段忽略，可以嵌套）"""
+    merged = {**_context.get(), **{k: v for k, v in fields.items() if v is not None}}
+    token = _context.set(merged)
+    try:
+        yield merged
+    finally:
+        _context.reset(token)
+
+
+def current() -> Dict[str, Any]:
+    """当前线程的日志上下文（用于交给其他线程，见 context）"""
+    return dict(_context.get())
+
+
+class ContextFilter(logging.Filter):
+    """在调用方线程里把上下文字段写进记录（extra 中显式给出的字段优先）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = _context.get()
+        for name in FIELDS:
+            if getattr(record, name, None) is None:
+                setattr(record, name, ctx.get(name))
+        return True
+
+
+def _fields(record: logging.LogRecord) -> Dict[str, Any]:
+    fields = {name: getattr(record, name, None) for name in FIELDS}
+    if getattr(record, "event", None):
+        fields["event"] = record.event
+    return {k: v for k, v in fields.items() if v is not None}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "thread": record.threadName,
+            **_fields(record),
+            "message": record.getMessage(),
+        }
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """单行文本: [时间] 级别 消息  字段=值..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        level = "" if record.levelno == logging.INFO else f"{record.levelname} "
+        fields = " ".join(f"{k}={v}" for k, v in _fields(record).items())
+        return f"[{stamp}] {level}{record.getMessage()}" + (f"  ({fields})" if fields else "")
+
+
+def setup(level: Optional[str] = None, fmt: Optional[str] = None, stream: Optional[TextIO] = None) -> None:
+    """配置 "mv" 日志器（可重复调用，后一次覆盖前一次）
+
+    Args:
+        level: 日志级别，默认读取 MV_LOG_LEVEL，都没有时为 INFO
+        fmt: "text" 或 "json"，默认读取 MV_LOG_FORMAT
+        stream: 输出流，默认 stderr
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+        fmt = (fmt or os.getenv("MV_LOG_FORMAT") or "text").lower()
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.addFilter(ContextFilter())
+
+        logger = logging.getLogger("mv")
+        for old in list(logger.handlers):
+            logger.removeHandler(old)
+        logger.addHandler(handler)
+        logger.setLevel((level or os.getenv("MV_LOG_LEVEL") or "INFO").upper())
+        logger.propagate = False
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+
+
+def shutdown() -> None:
+    """写完队列中剩余的记录并停止监听线程"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回 "mv.<name>" 日志器，第一次调用时按环境变量完成默认配置"""
+    if _listener is None:
+        setup()
+    return logging.getLogger(f"mv.{name}")
+
+
+def progress(logger: logging.Logger, key: str, message: str, *args,
+             interval: float = PROGRESS_INTERVAL, force: bool = False, final: bool = False, **fields) -> bool:
+    """限速输出进度: 同一个 key 在 interval 秒内最多输出一次
+
+    force=True 时总是输出（例如状态发生变化）并重新计时；final=True 时总是输出并清除该 key 的记录。
+
+    Returns:
+        这次是否真正输出了
+    """
+    now = time.monotonic()
+    with _progress_lock:
+        last = _progress_last.get(key)
+        if not (force or final) and last is not None and now - last < interval:
+            return False
+        if final:
+            _progress_last.pop(key, None)
+        else:
+            _progress_last[key] = now
+    logger.info(message, *args, extra={"event": "progress", **fields})
+    return True
@@ -1,23 +1,66 @@
 import gradio as gr
 from shots_manager import ShotsManager
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from shot import Shot
 from typing import List, Dict, Any
 import os
 import asyncio
+import time
+
+import logs
+
+logger = logs.get_logger("ui")
+
 
 class MVGeneratorUI:
-    def __init__(self, shots_json_path: str = "shots.json"):
+    DEFAULT_AUDIO_PATH = "/root/shared-nvme/shuyiwang/MusicVideo_ProduXer/我不明白.mp3"
+    BATCH_WORKERS = 20
+    BATCH_STAGES = {"first_frame": "首帧", "video": "视频"}
+    # 批量任务进度的轮询间隔（秒）
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, shots_json_path: str = "shots.json", audio_path: str = DEFAULT_AUDIO_PATH):
         self.manager = ShotsManager(shots_json_path)
+        self.audio_path = audio_path
         self.current_shots_data = []
         self.script_json_dir = shots_json_path
-        # 分镜的图片展示和视频展示与其shot对应的地址由字典维护
-        self.shot_components = {i:{"img_output":None, "vid_output":None} for i, shot in enumerate(self.manager.shots)}
+        # 分镜浏览器: 只有一个详情面板, 绑定到当前选中的分镜
+        self.shot_selector = None
+        self.detail_outputs = []
+        # 界面默认展示低分辨率代理, 新素材落盘时在后台生成
+        self.proxies = self.manager.proxies()
+        # 批量任务交给后台任务服务执行, 界面只提交和轮询
+        self.jobs = self.manager.jobs(max_workers=self.BATCH_WORKERS)
+
+    def _display(self, path):
+        """界面展示用的路径: 优先低分辨率代理, 代理还没生成时立即退回原始文件"""
+        return self.proxies.display(path) if path else None
+
+    def _swap_in_proxies(self, shot_index, shown):
+        """代理生成完成后, 把详情面板中还在展示原始文件的素材换成代理（shown 为各组件当前展示的路径）"""
+        shown = list(shown or [None] * 3)
+        if shot_index is None or not self.manager.shots:
+            return [gr.update()] * 3 + [shown]
+        shot = self.manager.shots[min(int(shot_index), len(self.manager.shots) - 1)]
+        updates = []
+        for slot, path in enumerate((shot.image_path, shot.video_path, shot.lip_sync_path)):
+            proxy = self.proxies.get(path) if path else None
+            if proxy and proxy != shown[slot]:
+                shown[slot] = proxy
+                updates.append(proxy)
+            else:
+                updates.append(gr.update())
+        return updates + [shown]
+
+    def _full_resolution(self, shot_index: int):
+        """按需加载某个分镜的原始分辨率素材"""
+        shot = self.manager.shots[shot_index]
+        return shot.image_path, shot.video_path, shot.lip_sync_path
     
     def initialize_manager(self):
         """初始化管理器"""
         try:
-            self.manager = ShotsManager(self.script_json_dir)
+            # 复用已创建的客户端, 只重新读取脚本
+            self.manager.reload()
             return "✅ 管理器初始化成功"
         except Exception as e:
             return f"❌ 初始化失败: {str(e)}"
@@ -40,72 +83,195 @@ class MVGeneratorUI:
         """生成角色参考图"""
         try:
             path = self.manager.generate_reference()
-            return path, "✅ 角色参考图生成成功"
+            return self._display(path), "✅ 角色参考图生成成功"
         except Exception as e:
             return None, f"❌ 生成失败: {str(e)}"
     
+    def _batch_counts(self, state: Dict[str, Any]) -> Dict[str, int]:
+        counts = {"total": len(state["jobs"]), "done": 0, "failed": 0, "reused": 0, "cancelled": 0, "timeout": 0}
+        for job in state["jobs"]:
+            if job["status"] == "done":
+                counts["reused" if job["stage"].startswith("reuse_") else "done"] += 1
+            elif job["status"] in ("failed", "cancelled", "timeout"):
+                counts[job["status"]] += 1
+        return counts
+
+    def batch_progress_html(self) -> str:
+        """各阶段最近一个批次的进度条和计数, 以及两个优先级通道的队列指标"""
+        rows = []
+        for stage, label in self.BATCH_STAGES.items():
+            c = {"total": 0, "done": 0, "failed": 0, "reused": 0, "cancelled": 0, "timeout": 0}
+            batches = self.jobs.active_batches(stage) or self.jobs.recent_batches(stage, limit=1)
+            if batches:
+                c = self._batch_counts(self.jobs.batch(batches[0]))
+            finished = c["done"] + c["failed"] + c["reused"] + c["cancelled"] + c["timeout"]
+            rows.append(
+                f"<div><b>{label}</b> <progress value='{finished}' max='{max(c['total'], 1)}' "
+                f"style='width:50%'></progress> {finished}/{c['total']}　"
+                f"✅ {c['done']}　♻️ {c['reused']}　❌ {c['failed']}　⏰ {c['timeout']}　⏹️ {c['cancelled']}</div>"
+            )
+        stats = self.jobs.stats()
+        lanes = "　".join(
+            f"{label}: 排队 {stats[lane]['queued']} / 执行 {stats[lane]['running']}, "
+            f"平均等待 {stats[lane]['avg_wait']:g}秒"
+            for lane, label in (("interactive", "单个分镜"), ("batch", "批量"))
+        )
+        rows.append(f"<div>🚦 队列 ({stats['workers']} 个工作线程) {lanes}</div>")
+        rows.append(self._budget_html(stats["budget"]))
+        return "".join(rows)
+
+    def _budget_html(self, budget: Dict[str, Any]) -> str:
+        """花费、预留和剩余额度; 因额度不足暂停派发时给出原因"""
+        labels = {"first_frame": "首帧", "video": "视频", "reference": "参考图"}
+        stages = "　".join(f"{labels.get(stage, stage)} ¥{amount:g}" for stage, amount in budget["by_stage"].items())
+        if budget["limit"] is None:
+            line = f"💰 本次已花费 ¥{budget['spent']:g}（不限额）"
+        else:
+            line = (f"💰 本次已花费 ¥{budget['spent']:g} / 上限 ¥{budget['limit']:g}，"
+                    f"执行中预留 ¥{budget['reserved']:g}，剩余 ¥{budget['remaining']:g}")
+        total = f"　项目累计 ¥{budget['total_spent']:g}" if "total_spent" in budget else ""
+        html = f"<div>{line}" + (f"　({stages})" if stages else "") + total + "</div>"
+        if budget["paused"]:
+            html += f"<div>⏸️ {budget['paused']}，调高上限后继续</div>"
+        return html
+
+    def set_budget(self, limit):
+        """设置后台任务的花费上限（0 或留空为不限）"""
+        self.jobs.set_budget(float(limit) if limit else None)
+        return self.batch_progress_html()
+
+    def reset_budget(self):
+        """已花费清零, 花费上限从现在开始重新计算"""
+        self.jobs.reset_budget()
+        return self.batch_progress_html()
+
+    def _job_message(self, job: Dict[str, Any]) -> str:
+        sid = job["shot_id"]
+        what = "参考图" if job["stage"].endswith("first_frame") else "视频"
+        if job["status"] == "cancelled":
+            return f"⏹️ 分镜 {sid} 已取消"
+        if job["status"] == "timeout":
+            return f"⏰ 分镜 {sid} 超时: {job['error']}"
+        if job["status"] == "failed":
+            return f"❌ 分镜 {sid} 失败: {job['error']}"
+        if job["stage"].startswith("reuse_"):
+            return f"♻️ 分镜 {sid} 复用分镜 {job['params']['from']} 的{what}"
+        return f"✅ 分镜 {sid} {what}生成成功"
+
+    def watch_batch(self, batch_id: str):
+        """轮询后台批次, 每有分镜结束就更新状态、进度和刚完成分镜的预览
+
+        任务在后台任务服务中执行, 与本次请求无关: 关掉页面不会中断任务, 其他会话也可以随时挂到同一批次上。
+
+        Yields:
+            (状态文本, 进度 HTML, 首帧预览, 视频预览)
+        """
+        header, reported = [], set()
+        state = self.jobs.batch(batch_id)
+        if state["stage"] == "first_frame":
+            header = [f"⏭️ 分镜 {shot.id} 跳过（无角色）" for shot in self.manager.shots if not shot.character_in_scene]
+        yield "\n".join(header + ["⏳ 批量任务已提交到后台"]), self.batch_progress_html(), gr.update(), gr.update()
+        while True:
+            state = self.jobs.batch(batch_id)
+            finished = sorted((job for job in state["jobs"] if job["finished_at"] and job["key"] not in reported
+                               and job["status"] not in ("queued", "running")),
+                              key=lambda job: job["finished_at"])
+            if finished:
+                reported.update(job["key"] for job in finished)
+                lines = [self._job_message(job) for job in sorted(
+                    (job for job in state["jobs"] if job["key"] in reported), key=lambda job: job["finished_at"])]
+                frame, video = gr.update(), gr.update()
+                done = [job for job in finished if job["status"] == "done" and job["result"]]
+                if done:
+                    latest = self._display(done[-1]["result"])
+                    if state["stage"] == "first_frame":
+                        frame = latest
+                    else:
+                        video = latest
+                yield "\n".join(header + lines), self.batch_progress_html(), frame, video
+            if not state["active"]:
+                return
+            time.sleep(self.POLL_INTERVAL)
+
+    def watch_active_batch(self):
+        """挂到最近一个还在运行的批次上（刷新页面或另一个会话打开时）"""
+        batches = self.jobs.active_batches()
+        if not batches:
+            yield "没有正在运行的批量任务", self.batch_progress_html(), gr.update(), gr.update()
+            return
+        yield from self.watch_batch(batches[0])
+
+    def cancel_batch(self):
+        """取消所有运行中批次里排队中和执行中的分镜（执行中的分镜放弃等待，ComfyUI 任务从队列撤下）"""
+        cancelled = sum(self.jobs.cancel_batch(batch_id) for batch_id in self.jobs.active_batches())
+        logger.info("⏹️ 已取消 %d 个分镜", cancelled)
+
     def batch_generate_first_frames(self):
-        """并发生成所有分镜的修改参考图"""
-        if not self.manager or not hasattr(self.manager, "shots"):
-            return "❌ 请先初始化 manager"
+        """把所有分镜的首帧生成提交到后台任务服务, 并跟踪进度
 
-        results = []
-        new_images = [None] * len(self.manager.shots)
+        Yields:
+            (状态文本, 进度 HTML, 首帧预览, 视频预览)
+        """
+        if not self.manager or not hasattr(self.manager, "shots"):
+            yield "❌ 请先初始化 manager", self.batch_progress_html(), gr.update(), gr.update()
+            return
         # 如果没有参考图片, 抛出错误
         if not self.manager.reference_pic_dir:
-            return "❌ 请先生成全局参考形象"
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            # 只提交 character_in_scene 为 True 的 shot
-            futures = {
-                executor.submit(
-                    self.manager.generate_first_frame,
-                    shot_index=i,
-                    reference_dir=self.manager.reference_pic_dir,
-                    prompt=shot.stable_prompt
-                ): (i, shot.id)
-                for i, shot in enumerate(self.manager.shots) if getattr(shot, "character_in_scene", False)
-            }
-            for future in as_completed(futures):
-                idx, sid = futures[future]
-                try:
-                    future.result()
-                    results.append(f"✅ 分镜 {sid} 参考图生成成功")
-                    new_images[idx] = self.manager.shots[idx].image_path                
-                except Exception as e:
-                    results.append(f"❌ 分镜 {sid} 失败: {str(e)}")
-        for i, shot in enumerate(self.manager.shots):
-            if not getattr(shot, "character_in_scene", False):
-                results.append(f"⏭️ 分镜 {shot.id} 跳过（无角色）")
-        # 只返回具有"图像预览模块"new_images:
-        new_images = [new_images[i] for i in range(len(new_images)) if self.shot_components[i]["img_output"]]
-        return ["\n".join(results)] + new_images
+            yield "❌ 请先生成全局参考形象", self.batch_progress_html(), gr.update(), gr.update()
+            return
+        # 同样的一批任务已在运行时直接挂上去, 不会重复提交
+        batch_id = self.jobs.submit_batch("first_frame", self.manager.batch_jobs("first_frame"))
+        yield from self.watch_batch(batch_id)
 
     def batch_generate_videos(self):
-        """并发生成所有分镜的视频"""
+        """把所有分镜的视频生成提交到后台任务服务, 并跟踪进度
+
+        Yields:
+            (状态文本, 进度 HTML, 首帧预览, 视频预览)
+        """
         if not self.manager or not hasattr(self.manager, "shots"):
-            return "❌ 请先初始化 manager"
-
-        results = []
-        new_videos = [None] * len(self.manager.shots)
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = {
-                executor.submit(
-                    shot.generate_video,
-                    prompt=self.manager.prompts[i]["vid"],
-                    duration=shot.duration,
-                    use_image=shot.character_in_scene
-                ): (i, shot.id)
-                for i, shot in enumerate(self.manager.shots)
-            }
-            for future in as_completed(futures):
-                idx, sid = futures[future]
-                try:
-                    future.result()
-                    results.append(f"✅ 分镜 {sid} 视频生成成功")
-                    new_videos[idx] = self.manager.shots[idx].video_path
-                except Exception as e:
-                    results.append(f"❌ 分镜 {sid} 失败: {str(e)}")
-        return ["\n".join(results)] + new_videos
+            yield "❌ 请先初始化 manager", self.batch_progress_html(), gr.update(), gr.update()
+            return
+        batch_id = self.jobs.submit_batch("video", self.manager.batch_jobs("video"))
+        yield from self.watch_batch(batch_id)
+
+    def list_duplicate_clusters(self) -> List[List[Any]]:
+        """重新检测重复分镜，返回表格数据"""
+        shots = self.manager.shots
+        return [
+            [c["id"], ", ".join(str(i) for i in c["shot_ids"]), c["similarity"], c["exact"], c["enabled"],
+             " / ".join(sorted({shots[i].lyric for i in [c["representative"], *c["members"]]}))]
+            for c in self.manager.find_duplicate_shots()
+        ]
+
+    def toggle_cluster_reuse(self, cluster_id):
+        """切换某个重复簇是否复用素材"""
+        if cluster_id is None:
+            return self.list_duplicate_clusters()
+        clusters = self.manager.clusters or self.manager.find_duplicate_shots()
+        enabled = {c["id"]: c["enabled"] for c in clusters}
+        cluster_id = int(cluster_id)
+        if cluster_id in enabled:
+            self.manager.set_cluster_reuse(cluster_id, not enabled[cluster_id])
+        return self.list_duplicate_clusters()
+
+    def refresh_preview(self):
+        """刷新实时预览, 只重编码有变化的分镜片段"""
+        try:
+            preview = self.manager.preview(self.audio_path)
+            result = preview.refresh()
+            status = f"已完成 {result['ready']}/{result['total']} 个分镜, 本次更新: {result['updated'] or '无'}"
+            return preview.export(), status
+        except Exception as e:
+            return None, f"❌ 预览刷新失败: {str(e)}"
+
+    def assemble_mv(self):
+        """把当前所有分镜合成为完整 MV"""
+        try:
+            result = self.manager.assemble(self.audio_path, allow_missing=True)
+            return result["path"], f"✅ MV 合成完成, 时长 {result['duration']}秒"
+        except Exception as e:
+            return None, f"❌ 合成失败: {str(e)}"
     
     
     def create_shot_management_section(self) -> gr.Blocks:
@@ -134,6 +300,17 @@ class MVGeneratorUI:
                         interactive=False,
                         max_height=500
                     )
+
+            gr.Markdown("### 重复分镜 (每簇只生成代表分镜, 其余复用其首帧和视频)")
+            with gr.Row():
+                dedup_btn = gr.Button("检测重复分镜", variant="secondary")
+                cluster_id_input = gr.Number(label="簇ID", precision=0)
+                toggle_btn = gr.Button("切换该簇是否复用", variant="secondary")
+            clusters_table = gr.Dataframe(
+                headers=["簇ID", "分镜", "相似度", "完全相同", "复用", "歌词"],
+                datatype=["number", "str", "number", "bool", "bool", "str"],
+                interactive=False
+            )
             
             # 事件绑定
             ref_btn.click(
@@ -146,210 +323,303 @@ class MVGeneratorUI:
                 outputs=shots_table
             )
             
-            init_btn.click(
+            dedup_btn.click(
+                fn=self.list_duplicate_clusters,
+                outputs=clusters_table
+            )
+
+            toggle_btn.click(
+                fn=self.toggle_cluster_reuse,
+                inputs=cluster_id_input,
+                outputs=clusters_table
+            )
+            
+            self.init_event = init_btn.click(
                 fn=self.initialize_manager,
                 outputs=init_status
             ).then(
                 fn=self.list_shots,
                 outputs=shots_table
             )
+            self.shots_table = shots_table
         
         return section
     
     def create_batch_control_section(self) -> gr.Blocks:
         """"创建批量管理区: """
-        num_6s = 0
-        num_10s = 0
-        num_to_be_edited = 0
-        for shot in self.manager.shots:
-            if shot.duration <= 6:
-                num_6s += 1
-            else:
-                num_10s += 1
-            if shot.character_in_scene:
-                num_to_be_edited += 1
-        with gr.Blocks() as section:
+        cost = self.manager.estimate_batch_cost()
+        frame_cost, video_cost = cost["first_frame"], cost["video"]
+        with gr.Blocks():
             gr.Markdown("## 👥 批量管理 (以保存过的prompt为准)")
+            if cost["saved"]:
+                gr.Markdown(f"♻️ 重复分镜复用素材, 预计节省 ¥{cost['saved']:g}")
             
             with gr.Row():
-                batch_fir_btn = gr.Button(f"一键生成第一帧 💰估价: ¥{0.2*num_to_be_edited}", variant="secondary")
-                batch_vid_btn = gr.Button(f"一键生成所有视频 💰估价: ¥{2*num_6s+4*num_10s}", variant="secondary")
-            batch_status = gr.Textbox(label="批量任务状态", interactive=False, lines=10)
-        print(self.shot_components)
+                batch_fir_btn = gr.Button(f"一键生成第一帧 💰估价: ¥{frame_cost:g}", variant="secondary")
+                batch_vid_btn = gr.Button(f"一键生成所有视频 💰估价: ¥{video_cost:g}", variant="secondary")
+                cancel_btn = gr.Button("⏹️ 取消批量任务", variant="stop")
+                attach_btn = gr.Button("🔗 查看运行中的批次", variant="secondary")
+            with gr.Row():
+                budget_input = gr.Number(label="花费上限 (¥, 0 为不限)", value=self.jobs.budget.limit or 0,
+                                         minimum=0, scale=3)
+                budget_btn = gr.Button("💰 设置上限", variant="secondary", scale=1)
+                budget_reset_btn = gr.Button("🔄 花费清零", variant="secondary", scale=1)
+            batch_progress = gr.HTML(self.batch_progress_html)
+            # 队列指标定时刷新（没有在跟踪批次时也能看到单个分镜操作的排队情况）
+            queue_timer = gr.Timer(value=5)
+            with gr.Row():
+                batch_status = gr.Textbox(label="批量任务状态", interactive=False, lines=10, scale=2)
+                with gr.Column(scale=1):
+                    frame_preview = gr.Image(label="刚完成的首帧", type="filepath", height=200)
+                    video_preview = gr.Video(label="刚完成的视频", height=200)
+            with gr.Row():
+                assemble_btn = gr.Button("🎞️ 合成完整MV (缺少视频的分镜以黑场代替)", variant="primary")
+            assemble_status = gr.Textbox(label="合成状态", interactive=False)
+            mv_output = gr.Video(label="MV 成片", height=400)
+        # 批量任务在后台执行, 这里边轮询边输出每个完成的分镜, 结束后刷新详情面板中当前选中的分镜;
+        # 轮询不占用生成资源, 不限制并发, 多个会话可以同时跟踪同一批次
         batch_fir_btn.click(
             fn=self.batch_generate_first_frames,
-            outputs=[batch_status] + [self.shot_components[i]["img_output"] for i in range(len(self.manager.shots))if self.shot_components[i]["img_output"]]
+            outputs=[batch_status, batch_progress, frame_preview, video_preview],
+            concurrency_limit=None
+        ).then(
+            fn=self.load_shot,
+            inputs=self.shot_selector,
+            outputs=self.detail_outputs
         )
         batch_vid_btn.click(
             fn=self.batch_generate_videos,
-            outputs=[batch_status] + [self.shot_components[i]["vid_output"] for i in range(len(self.manager.shots))]
+            outputs=[batch_status, batch_progress, frame_preview, video_preview],
+            concurrency_limit=None
+        ).then(
+            fn=self.load_shot,
+            inputs=self.shot_selector,
+            outputs=self.detail_outputs
+        )
+        cancel_btn.click(fn=self.cancel_batch)
+        budget_btn.click(fn=self.set_budget, inputs=budget_input, outputs=batch_progress)
+        budget_reset_btn.click(fn=self.reset_budget, outputs=batch_progress)
+        queue_timer.tick(fn=self.batch_progress_html, outputs=batch_progress)
+        # 刷新页面或从另一个浏览器打开时, 可以重新挂到后台正在运行的批次上
+        attach_btn.click(
+            fn=self.watch_active_batch,
+            outputs=[batch_status, batch_progress, frame_preview, video_preview],
+            concurrency_limit=None
+        ).then(
+            fn=self.load_shot,
+            inputs=self.shot_selector,
+            outputs=self.detail_outputs
+        )
+        assemble_btn.click(
+            fn=self.assemble_mv,
+            outputs=[mv_output, assemble_status]
+        )
+
+    def create_preview_section(self):
+        """创建实时预览区: 未完成的分镜以首帧或黑场占位"""
+        with gr.Blocks() as section:
+            gr.Markdown("## 📺 实时预览 (未完成的分镜以首帧/黑场占位)")
+            with gr.Row():
+                preview_btn = gr.Button("刷新预览", variant="secondary")
+                auto_refresh = gr.Checkbox(label="每15秒自动刷新", value=False)
+            preview_status = gr.Textbox(label="预览状态", interactive=False)
+            preview_output = gr.Video(label="MV 预览", height=400)
+            timer = gr.Timer(value=15, active=False)
+
+        preview_btn.click(
+            fn=self.refresh_preview,
+            outputs=[preview_output, preview_status]
+        )
+        timer.tick(
+            fn=self.refresh_preview,
+            outputs=[preview_output, preview_status]
+        )
+        auto_refresh.change(
+            fn=lambda enabled: gr.Timer(active=enabled),
+            inputs=auto_refresh,
+            outputs=timer
         )
+        return section
         
-    def create_shot_detail_section(self, shot_index: int) -> gr.Blocks:
-        """为单个shot创建详细操作页面"""
+    def _shot_choices(self) -> List[tuple]:
+        """分镜选择器的选项: (显示文本, 分镜下标)"""
+        return [(f"分镜 {shot.id}: {shot.lyric}", i) for i, shot in enumerate(self.manager.shots)]
+
+    def _select_from_table(self, evt: gr.SelectData):
+        """点击分镜列表中的一行时切换详情面板"""
+        return evt.index[0]
+
+    def load_shot(self, shot_index):
+        """把详情面板的所有组件切换到指定分镜（顺序与 self.detail_outputs 一致）"""
+        if shot_index is None or not self.manager.shots:
+            return [gr.update()] * (len(self.detail_outputs) - 1) + [[None, None, None]]
+        shot_index = min(int(shot_index), len(self.manager.shots) - 1)
         shot = self.manager.shots[shot_index]
-        shot_id = shot.id
+        info = (f"## 🎬 分镜 {shot.id} 详情\n\n**歌词:** {shot.lyric}　"
+                f"**时长:** {shot.duration}秒　**唱歌:** {'是' if shot.sing else '否'}")
+        prompt_info = f"**静态Prompt:** {shot.stable_prompt}\n\n**动态Prompt:** {shot.dynamic_prompt}"
+        shown = [self._display(path) for path in (shot.image_path, shot.video_path, shot.lip_sync_path)]
+        return [
+            info,
+            gr.update(visible=shot.character_in_scene),
+            self.manager.reference_pic_dir,
+            shot.stable_prompt,
+            shown[0],
+            self.manager.prompts[shot_index]["vid"],
+            shot.duration,
+            prompt_info,
+            shown[1],
+            shown[2],
+            "", "", "", "",
+            shown,
+        ]
+
+    def create_shot_browser_section(self) -> gr.Blocks:
+        """创建分镜详情面板
+
+        整个页面只有一套详情组件, 通过选择器（或点击分镜列表中的行）绑定到某个分镜,
+        组件数量不随分镜数增长。
+        """
         with gr.Blocks() as section:
-            gr.Markdown(f"## 🎬 分镜 {shot_id} 详情")
-            
-            with gr.Row():
-                gr.Markdown(f"**歌词:** {shot.lyric}")
-                gr.Markdown(f"**时长:** {shot.duration}秒")
-                gr.Markdown(f"**唱歌:** {'是' if shot.sing else '否'}")
-            
+            gr.Markdown("## 📋 分镜详细操作")
+            selector = gr.Dropdown(choices=self._shot_choices(), value=0 if self.manager.shots else None,
+                                   label="选择分镜", interactive=True)
+            info = gr.Markdown()
+
             with gr.Tabs():
-                if shot.character_in_scene: 
-                    # Tab 1: 图像生成
-                    with gr.TabItem("🖼️ 图像生成"):
-                        with gr.Row():
-                            with gr.Column():
-                                gr.Markdown("### 修改第一帧图像")
-                                edit_img_input = gr.Image(
-                                    label="上传参考图进行修改",
-                                    type="filepath",
-                                    height=200,
-                                    value=self.manager.reference_pic_dir
-                                )
-                                edit_prompt = gr.Textbox(
-                                    label="修改Prompt (可选)",
-                                    value=shot.stable_prompt,
-                                    lines=2
-                                )
-                                edit_img_btn = gr.Button("修改图像", variant="secondary")
-                                edit_status = gr.Textbox(label="状态", interactive=False)
-                        
-                        img_output = gr.Image(
-                            label="图像预览",
-                            type="filepath",
-                            height=400,
-                            value=shot.image_path
-                        )
-                        # 保存组件引用
-                        self.shot_components[shot_index]["img_output"] = img_output
-                        print(f"shot_{shot_index} initialized!")
-                        
-                        # 图像修改事件
-                        
-                        edit_img_btn.click(
-                            fn=lambda img, prompt: self._edit_first_frame(shot_index, img, prompt),
-                            inputs=[edit_img_input, edit_prompt],
-                            outputs=[img_output, edit_status]
-                        )
-                
+                # Tab 1: 图像生成（仅角色出镜的分镜可见）
+                with gr.Tab("🖼️ 图像生成") as image_tab:
+                    with gr.Row():
+                        with gr.Column():
+                            gr.Markdown("### 修改第一帧图像")
+                            edit_img_input = gr.Image(
+                                label="上传参考图进行修改",
+                                type="filepath",
+                                height=200
+                            )
+                            edit_prompt = gr.Textbox(label="修改Prompt (可选)", lines=2)
+                            edit_img_btn = gr.Button("修改图像", variant="secondary")
+                            edit_status = gr.Textbox(label="状态", interactive=False)
+                    img_output = gr.Image(label="图像预览 (低分辨率)", type="filepath", height=400)
+
                 # Tab 2: 视频生成
-                with gr.TabItem("🎥 视频生成"):
+                with gr.Tab("🎥 视频生成"):
                     with gr.Row():
                         with gr.Column():
                             gr.Markdown("### 生成视频")
-                            # 如果角色不在分镜中, 就由hailuo掌管所有提示词
-                            if shot.character_in_scene:
-                                prompt = shot.dynamic_prompt
-                            else:
-                                prompt = shot.stable_prompt + shot.dynamic_prompt
-                            video_prompt = gr.Textbox(
-                                label="视频Prompt (可选)",
-                                value=prompt,
-                                lines=2
-                            )
-                            
+                            video_prompt = gr.Textbox(label="视频Prompt (可选)", lines=2)
                             video_duration = gr.Number(
-                                label="视频时长(秒, 6s以下生成6s, 6s以上生成10s)",
-                                value=shot.duration
+                                label="视频时长(秒, 6s以下生成6s, 10s以下生成10s, 更长的拆分为多段后拼接)"
                             )
                             video_btn = gr.Button("生成视频 (prompt以文本框中为准)", variant="primary")
                             video_status = gr.Textbox(label="状态", interactive=False)
-                        
+
                         with gr.Column():
                             gr.Markdown("### Prompt说明")
-                            gr.Markdown(f"**静态Prompt:** {shot.stable_prompt}")
-                            gr.Markdown(f"**动态Prompt:** {shot.dynamic_prompt}")
+                            prompt_info = gr.Markdown()
                             # 提供修改和恢复视频提示词的按钮
                             save_video_prompt = gr.Button("保存提示词 (不会修改原始json)")
                             restore_video_prompt = gr.Button("恢复默认提示词")
                             edit_video_prompt_output = gr.Textbox(label="修改结果", interactive=False)
-                            save_video_prompt.click(
-                                fn=lambda prompt: self._edit_prompt(True, prompt, shot_index),
-                                inputs=video_prompt,
-                                outputs=edit_video_prompt_output
-                            )
-                            #提供回复默认视频提示词的按钮
-                            restore_video_prompt.click(
-                                fn=lambda: (
-                                    self._restore_prompt(True, shot_index),
-                                    shot.dynamic_prompt if shot.character_in_scene else f"{shot.stable_prompt}, {shot.dynamic_prompt}"
-                                ),
-                                outputs=[edit_video_prompt_output, video_prompt]
-                            )
                         # 对口型按钮
                         lip_sync_btn = gr.Button("对口型", variant="primary")
                         lip_sync_status = gr.Textbox(label="状态", interactive=False)
-                    
-                    video_output = gr.Video(
-                        label="视频预览",
-                        height=400,
-                        value=shot.video_path
-                    )
-                    
-                    lip_sync_output = gr.Video(
-                        label="视频预览",
-                        height= 400,
-                        value=shot.lip_sync_path
-                    )
-                    
-                    # 保存组件引用
-                    self.shot_components[shot_index]["vid_output"] = video_output
-                    
-                    # 事件绑定
-                    video_btn.click(
-                        fn=lambda prompt, duration: self._generate_video(shot_index, prompt, duration, shot.character_in_scene),
-                        inputs=[video_prompt, video_duration],
-                        outputs=[video_output, video_status]
-                    )
-                    lip_sync_btn.click(
-                        fn=lambda : self._lip_sync(shot_index),
-                        outputs=[lip_sync_output, lip_sync_status]
-                    )
-                    
-                    
-        
+
+                    video_output = gr.Video(label="视频预览 (低码率)", height=400)
+                    lip_sync_output = gr.Video(label="对口型预览 (低码率)", height=400)
+                    full_res_btn = gr.Button("🔍 加载原始分辨率", variant="secondary")
+            # 素材刚生成时先展示原始文件, 代理在后台生成好后由定时器换上
+            shown = gr.State([None, None, None])
+            proxy_timer = gr.Timer(value=3)
+
+        self.shot_selector = selector
+        self.detail_outputs = [
+            info, image_tab, edit_img_input, edit_prompt, img_output,
+            video_prompt, video_duration, prompt_info, video_output, lip_sync_output,
+            edit_status, video_status, edit_video_prompt_output, lip_sync_status, shown,
+        ]
+
+        # 事件绑定: 所有操作都以当前选中的分镜为准; 生成操作的并发由任务服务控制, 这里不再排队
+        selector.change(fn=self.load_shot, inputs=selector, outputs=self.detail_outputs)
+        edit_img_btn.click(
+            fn=self._edit_first_frame,
+            inputs=[selector, edit_img_input, edit_prompt],
+            outputs=[img_output, edit_status],
+            concurrency_limit=None
+        )
+        save_video_prompt.click(
+            fn=lambda index, prompt: self._edit_prompt(True, prompt, index),
+            inputs=[selector, video_prompt],
+            outputs=edit_video_prompt_output
+        )
+        restore_video_prompt.click(
+            fn=lambda index: (self._restore_prompt(True, index), self.manager.prompts[index]["vid"]),
+            inputs=selector,
+            outputs=[edit_video_prompt_output, video_prompt]
+        )
+        video_btn.click(
+            fn=self._generate_video,
+            inputs=[selector, video_prompt, video_duration],
+            outputs=[video_output, video_status],
+            concurrency_limit=None
+        )
+        lip_sync_btn.click(
+            fn=self._lip_sync,
+            inputs=selector,
+            outputs=[lip_sync_output, lip_sync_status],
+            concurrency_limit=None
+        )
+        full_res_btn.click(
+            fn=self._full_resolution,
+            inputs=selector,
+            outputs=[img_output, video_output, lip_sync_output]
+        )
+        proxy_timer.tick(
+            fn=self._swap_in_proxies,
+            inputs=[selector, shown],
+            outputs=[img_output, video_output, lip_sync_output, shown],
+            show_progress="hidden"
+        )
         return section
-    
+
     def _generate_image(self, shot_index: int, prompt: str = None):
         """生成图像（内部方法）"""
         try:
             shot = self.manager.shots[shot_index]
             shot_id = shot.id
             path = shot.generate_image(prompt=prompt)
-            return path, f"✅ 分镜 {shot_id} 图像生成成功"
+            return self._display(path), f"✅ 分镜 {shot_id} 图像生成成功"
         except Exception as e:
             return None, f"❌ 图像生成失败: {str(e)}"
     
     def _edit_first_frame(self, shot_index: int, base_img: str=None, prompt: str = None):
-        """修改第一帧图像（内部方法）"""
+        """修改第一帧图像（内部方法, 走任务服务的交互优先级通道, 插到批量任务前面）"""
         try:
             shot=self.manager.shots[shot_index]
             shot_id = shot.id
-            path = self.manager.generate_first_frame(shot_index=shot_index, reference_dir=base_img, prompt=prompt)
-            return path, f"✅ 分镜 {shot_id} 图像修改成功"
+            params = {"reference_dir": base_img or self.manager.reference_pic_dir, "prompt": prompt}
+            path = self.jobs.call(shot_index, shot_id, "first_frame", params)
+            return self._display(path), f"✅ 分镜 {shot_id} 图像修改成功"
         except Exception as e:
             return None, f"❌ 图像修改失败: {str(e)}"
     
-    def _generate_video(self, shot_index: int, prompt: str = None, duration: float = None, character_in_scene: bool = True):
-        """生成视频（内部方法）"""
+    def _generate_video(self, shot_index: int, prompt: str = None, duration: float = None, character_in_scene: bool = None):
+        """生成视频（内部方法, 走任务服务的交互优先级通道）"""
         try:
             shot = self.manager.shots[shot_index]
             shot_id = shot.id
-            path = shot.generate_video(prompt=prompt, duration=duration, use_image=character_in_scene, )
-            return path, f"✅ 分镜 {shot_id} 视频生成成功"
+            if character_in_scene is None:
+                character_in_scene = shot.character_in_scene
+            params = {"prompt": prompt, "duration": duration, "use_image": character_in_scene}
+            path = self.jobs.call(shot_index, shot_id, "video", params)
+            return self._display(path), f"✅ 分镜 {shot_id} 视频生成成功"
         except Exception as e:
             return None, f"❌ 视频生成失败: {str(e)}"
     def _lip_sync(self, shot_index: int):
         try:
             shot = self.manager.shots[shot_index]
-            saved_paths = shot.video_lip_sync(
-                audio_path = "/root/shared-nvme/shuyiwang/MusicVideo_ProduXer/我不明白.mp3",
-            )
-            return str(saved_paths[-1]), f"done!"
+            path = self.jobs.call(shot_index, shot.id, "lip_sync", {"audio_path": self.audio_path})
+            return self._display(path), "done!"
         except Exception as e:
             return None, f"failed!{str(e)}"
     
@@ -370,26 +640,42 @@ class MVGeneratorUI:
             gr.Markdown("# 🎬 MV 分镜生成管理工具")
             
             # 主管理区域
-            management_section = self.create_shot_management_section()
+            self.create_shot_management_section()
+            # 分镜详情面板（只有一套组件, 绑定到选中的分镜）
+            self.create_shot_browser_section()
             # 批量任务管理区域
-            # 为每个shot创建独立Tab
-            if hasattr(self.manager, 'shots') and self.manager.shots:
-                gr.Markdown("## 📋 分镜详细操作")
-                
-                with gr.Tabs() as tabs:
-                    # 为每个shot创建一个Tab
-                    for shot_index, shot in enumerate(self.manager.shots):
-                        print(shot.start_time)
-                        with gr.Tab(f"分镜 {shot.id}"):
-                            self.create_shot_detail_section(shot_index=shot_index)
-            batch_section = self.create_batch_control_section()
+            self.create_batch_control_section()
+            self.create_preview_section()
+
+            # 点击分镜列表中的行即切换详情面板; 重新初始化后刷新选择器
+            self.shots_table.select(fn=self._select_from_table, outputs=self.shot_selector)
+            self.init_event.then(
+                fn=lambda: gr.update(choices=self._shot_choices(), value=0 if self.manager.shots else None),
+                outputs=self.shot_selector
+            ).then(
+                fn=self.load_shot,
+                inputs=self.shot_selector,
+                outputs=self.detail_outputs
+            )
+            demo.load(fn=self.load_shot, inputs=self.shot_selector, outputs=self.detail_outputs)
             return demo
 
 # 使用示例
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="MV 分镜生成管理界面")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", "9464")),
+                        help="Prometheus 指标端点端口（默认环境变量 METRICS_PORT 或 9464），0 表示不启动")
+    args = parser.parse_args()
+
     # 创建UI实例
     ui = MVGeneratorUI("shots.json")
     
+    # Prometheus 指标端点与 Gradio 并列
+    if args.metrics_port:
+        from metrics import start_metrics_server
+        start_metrics_server(args.metrics_port)
+
     # 生成UI并启动
     demo = ui.create_ui()
     demo.launch(
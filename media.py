@@ -0,0 +1,115 @@
+"""
+ffmpeg / ffprobe 的轻量封装
+
+所有剪辑相关的模块（成片合成、长镜头拼接等）都通过这里调用 ffmpeg，
+可用环境变量 FFMPEG_BIN / FFPROBE_BIN 指定可执行文件路径。
+"""
+import json
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+FFMPEG = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFPROBE = os.getenv("FFPROBE_BIN", "ffprobe")
+
+# 重编码时统一使用的视频编码参数
+VIDEO_CODEC_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "18"]
+
+
+class MediaError(RuntimeError):
+    """ffmpeg / ffprobe 执行失败"""
+
+
+def _run(cmd: List[str]) -> str:
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise MediaError(f"{Path(cmd[0]).name} 执行失败: {result.stderr.strip()[-800:]}")
+    return result.stdout
+
+
+def run_ffmpeg(args: List[str]) -> None:
+    """执行一条 ffmpeg 命令（自动覆盖输出、只输出错误）"""
+    _run([FFMPEG, "-hide_banner", "-loglevel", "error", "-y", *args])
+
+
+def _parse_rate(rate: str) -> float:
+    num, _, den = rate.partition("/")
+    return float(num) / float(den or 1) if float(den or 1) else 0.0
+
+
+def probe_video(path: str) -> Dict[str, Any]:
+    """读取视频流的编码参数和时长"""
+    out = _run([
+        FFPROBE, "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,width,height,pix_fmt,r_frame_rate:format=duration",
+        "-of", "json", str(path),
+    ])
+    data = json.loads(out)
+    if not data.get("streams"):
+        raise MediaError(f"没有视频流: {path}")
+    stream = data["streams"][0]
+    return {
+        "codec": stream.get("codec_name"),
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "pix_fmt": stream.get("pix_fmt") or "yuv420p",
+        "fps": round(_parse_rate(stream.get("r_frame_rate", "0/1")), 3),
+        "duration": float(data.get("format", {}).get("duration") or 0),
+    }
+
+
+def probe_keyframes(path: str) -> List[float]:
+    """返回视频流所有关键帧的时间戳（秒），只读包信息不解码"""
+    out = _run([
+        FFPROBE, "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(path),
+    ])
+    keyframes = []
+    for line in out.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            keyframes.append(float(pts))
+    return sorted(keyframes)
+
+
+def normalize_filter(target: Dict[str, Any]) -> str:
+    """缩放/补边/帧率/像素格式统一到目标参数 {"width", "height", "fps", "pix_fmt"}"""
+    w, h = target["width"], target["height"]
+    return (f"scale={w}:{h}:force_original_aspect_ratio=decrease,"
+            f"pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+            f"fps={target['fps']},format={target['pix_fmt']}")
+
+
+def concat_copy(paths: List[str], output: str,
+                extra_inputs: Optional[List[str]] = None,
+                extra_args: Optional[List[str]] = None) -> str:
+    """用 concat demuxer 无损拼接多个编码参数一致的片段
+
+    Args:
+        paths: 按顺序拼接的片段
+        output: 输出文件
+        extra_inputs: 追加在拼接输入之后的其他输入参数（例如音轨）
+        extra_args: 输出参数，默认 -c copy
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        for p in paths:
+            escaped = str(Path(p).resolve()).replace("'", r"'\''")
+            f.write(f"file '{escaped}'\n")
+        list_path = f.name
+    try:
+        run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, *(extra_inputs or []),
+                    *(extra_args or ["-c", "copy"]), str(output)])
+    finally:
+        os.unlink(list_path)
+    return str(output)
+
+
+def extract_frame(video_path: str, output: str, at_end: bool = False) -> str:
+    """截取视频的第一帧（或最后一帧）保存为图片"""
+    if at_end:
+        run_ffmpeg(["-sseof", "-0.5", "-i", str(video_path), "-update", "1", "-q:v", "2", str(output)])
+    else:
+        run_ffmpeg(["-i", str(video_path), "-frames:v", "1", "-q:v", "2", str(output)])
+    return str(output)
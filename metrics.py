@@ -0,0 +1,257 @@
+"""
+各阶段耗时、吞吐和错误的指标，以 Prometheus 文本格式暴露
+
+原先只有散落在各客户端里的 print，分不清一条 MV 慢在海螺排队、下载带宽还是 ComfyUI 的 GPU 时间。
+这里提供一个不依赖第三方库的最小指标注册表（Counter/Gauge/Histogram，带标签），
+客户端和任务服务在关键位置打点，start_metrics_server 在 Gradio 旁边起一个 /metrics 端点供 Prometheus 抓取。
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import logs
+import tracing
+from deadline import Cancelled
+
+logger = logs.get_logger("metrics")
+
+# 耗时（秒）和大小（字节）的默认分桶
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+BYTE_BUCKETS = tuple(1 << n for n in range(16, 31, 2))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.label_names}, 收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v:g}" for k, v in items]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = TIME_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各分桶计数（非累计）, 总和, 总数]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """记录 with 块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float("inf")), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {total:g}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def expose(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# 服务商: hailuo（MiniMax 海螺）、ark（方舟 Seedream）、comfyui
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "mv_provider_request_seconds", "单次服务商请求耗时（提交任务、查询状态、上传、下载等）", ("provider", "op")))
+QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "mv_provider_queue_seconds", "任务提交后在服务商处排队的时间", ("provider",)))
+RENDER_SECONDS = REGISTRY.register(Histogram(
+    "mv_provider_render_seconds", "任务开始执行到生成完成的时间", ("provider",)))
+DOWNLOAD_SECONDS = REGISTRY.register(Histogram(
+    "mv_download_seconds", "生成结果的下载耗时", ("provider",)))
+DOWNLOAD_BYTES = REGISTRY.register(Histogram(
+    "mv_download_bytes", "生成结果的大小（字节）", ("provider",), buckets=BYTE_BUCKETS))
+COMFYUI_NODE_SECONDS = REGISTRY.register(Histogram(
+    "mv_comfyui_node_seconds", "ComfyUI 每个节点的执行时间（根据 executing 消息计算）", ("node", "class_type")))
+INFLIGHT = REGISTRY.register(Gauge(
+    "mv_provider_inflight", "正在进行的请求/任务数", ("provider", "op")))
+ERRORS = REGISTRY.register(Counter(
+    "mv_provider_errors_total", "请求或任务失败次数", ("provider", "op")))
+INTERRUPTED = REGISTRY.register(Counter(
+    "mv_provider_interrupted_total", "因超过时限（timeout）或被取消（cancelled）而放弃的请求/任务数",
+    ("provider", "op", "reason")))
+HEDGES = REGISTRY.register(Counter(
+    "mv_hailuo_hedges_total",
+    "海螺对冲重投: launched / hedge_won / original_won / skipped_budget / submit_failed", ("outcome",)))
+BUDGET_SPENT = REGISTRY.register(Gauge(
+    "mv_budget_spent_yuan", "本次运行各阶段的真实花费（元）", ("stage",)))
+BUDGET_RESERVED = REGISTRY.register(Gauge(
+    "mv_budget_reserved_yuan", "已派发、尚未结束的任务预留的预估费用（元）"))
+BUDGET_REMAINING = REGISTRY.register(Gauge(
+    "mv_budget_remaining_yuan", "花费上限减去已花费和预留（元），不限额时不输出"))
+PROJECT_QUEUED = REGISTRY.register(Gauge(
+    "mv_project_queued", "多项目服务中各项目在各服务商处排队的任务数", ("project", "provider")))
+PROJECT_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "mv_project_wait_seconds", "多项目服务中任务从提交到开始执行的排队时间", ("project", "provider")))
+PROJECT_JOBS = REGISTRY.register(Counter(
+    "mv_project_jobs_total", "多项目服务中结束的任务数（done / failed）", ("project", "provider", "status")))
+BROKER_REDISPATCHED = REGISTRY.register(Counter(
+    "mv_broker_redispatched_total", "工作进程租约过期后被重新派发（或放弃）的任务数", ("stage",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "mv_stage_seconds", "后台任务各阶段（首帧/视频/对口型等）的执行时间", ("stage",)))
+JOBS_TOTAL = REGISTRY.register(Counter(
+    "mv_jobs_total", "结束的后台任务数", ("stage", "status")))
+
+
+@contextmanager
+def track(provider: str, op: str, **attrs) -> Iterator[Dict[str, Any]]:
+    """记录一次服务商调用: 进行中计数、耗时和失败次数，同时记一个追踪 span
+
+    返回 span 的属性字典，可以在块内补充属性（例如下载的字节数）。块内的日志带上服务商和 task_id/prompt_id。
+    因超时或取消而中断的调用单独计数（INTERRUPTED），不算作失败。
+    """
+    INFLIGHT.inc(provider=provider, op=op)
+    start = time.perf_counter()
+    try:
+        with logs.context(provider=provider, task_id=attrs.get("task_id"), prompt_id=attrs.get("prompt_id")), \
+                tracing.span(f"{provider}.{op}", cat="provider", **attrs) as span:
+            yield span
+    except Cancelled as e:
+        INTERRUPTED.inc(provider=provider, op=op, reason=e.reason)
+        raise
+    except Exception:
+        ERRORS.inc(provider=provider, op=op)
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, provider=provider, op=op)
+        INFLIGHT.dec(provider=provider, op=op)
+
+
+def record_download(provider: str, seconds: float, size: int) -> None:
+    DOWNLOAD_SECONDS.observe(seconds, provider=provider)
+    DOWNLOAD_BYTES.observe(size, provider=provider)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求很频繁, 不打印访问日志
+        pass
+
+
+def start_metrics_server(port: int = 9464, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """在后台线程中启动 /metrics 端点（与 Gradio 服务并列），返回 HTTP 服务器对象"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("📈 指标端点已启动: http://%s:%s/metrics", host, server.server_port)
+    return server
@@ -0,0 +1,200 @@
+"""
+MV 实时预览
+
+在分镜还在生成时维护一份 HLS 播放列表（preview/index.m3u8），时间轴上每个分镜对应一个低分辨率片段：
+还没有视频的分镜用首帧定格（没有首帧时用黑场）占位，分镜完成后只重编码它自己的片段，
+其余片段保持不变。整段预览 mp4 只是把现有片段流复制拼接，不会重新渲染。
+"""
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import logs
+from assembler import best_artifact, build_timeline
+from media import VIDEO_CODEC_ARGS, concat_copy, normalize_filter, run_ffmpeg
+
+logger = logs.get_logger("preview")
+
+
+class PreviewStream:
+    """维护 MV 时间轴的分段预览"""
+    # 预览统一使用 480p, 编码代价很小
+    TARGET = {"width": 854, "height": 480, "fps": 24.0, "pix_fmt": "yuv420p"}
+    PLAYLIST_NAME = "index.m3u8"
+
+    def __init__(self, shots: List[Any], output_dir: str, audio_path: Optional[str] = None):
+        """初始化预览
+
+        Args:
+            shots: 所有分镜（会在每次刷新时重新读取其当前素材）
+            output_dir: 预览文件目录
+            audio_path: 整首歌音轨，提供后每个片段带上对应区间的音频
+        """
+        self.shots = shots
+        self.output_dir = Path(output_dir)
+        self.audio_path = audio_path
+
+        # shot id -> {"signature", "path", "kind", "start", "duration"}
+        self.segments: Dict[int, Dict[str, Any]] = {}
+        self.version = 0
+        self._lock = threading.Lock()
+        self._export_path: Optional[str] = None
+        self._export_version = -1
+
+        # 后台刷新线程
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def playlist_path(self) -> Path:
+        return self.output_dir / self.PLAYLIST_NAME
+
+    @staticmethod
+    def _source_of(shot: Any) -> Tuple[str, Optional[str]]:
+        """分镜当前用于预览的素材: (类型, 路径)"""
+        video = best_artifact(shot)
+        if video:
+            return "video", video
+        if shot.image_path and os.path.exists(shot.image_path):
+            return "still", str(shot.image_path)
+        return "black", None
+
+    def _encode(self, kind: str, source: Optional[str], start: float, duration: float, output: str) -> None:
+        """把一个分镜编码成预览片段"""
+        target = self.TARGET
+        vf = normalize_filter(target)
+        if kind == "video":
+            inputs = ["-i", source]
+            vf += f",tpad=stop_mode=clone:stop_duration={duration:.3f}"
+        elif kind == "still":
+            inputs = ["-loop", "1", "-framerate", str(target["fps"]), "-i", source]
+        else:
+            size = f"{target['width']}x{target['height']}"
+            inputs = ["-f", "lavfi", "-i", f"color=c=black:s={size}:r={target['fps']}"]
+
+        if self.audio_path:
+            inputs += ["-ss", f"{start:.3f}", "-t", f"{duration:.3f}", "-i", str(self.audio_path)]
+            audio_args = ["-map", "0:v:0", "-map", "1:a:0", "-c:a", "aac", "-b:a", "128k", "-af", "apad"]
+        else:
+            audio_args = ["-an"]
+        run_ffmpeg([*inputs, "-t", f"{duration:.3f}", "-vf", vf, *audio_args,
+                    *VIDEO_CODEC_ARGS, "-output_ts_offset", f"{start:.3f}", "-f", "mpegts", output])
+
+    def _write_playlist(self, ordered: List[Dict[str, Any]]) -> None:
+        """原子地重写 m3u8 播放列表"""
+        target_duration = max([int(s["duration"]) + 1 for s in ordered] or [1])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for segment in ordered:
+            lines.append(f"#EXTINF:{segment['duration']:.3f},{segment['kind']}")
+            lines.append(os.path.basename(segment["path"]))
+        lines.append("#EXT-X-ENDLIST")
+        tmp = self.playlist_path.with_suffix(".m3u8.tmp")
+        tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(tmp, self.playlist_path)
+
+    def refresh(self) -> Dict[str, Any]:
+        """只重编码发生变化的片段并更新播放列表
+
+        Returns:
+            {"updated": 本次重编码的分镜 id, "ready": 已有真实视频的分镜数, "total": 分镜总数}
+        """
+        with self._lock:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            timeline = build_timeline(self.shots)
+            updated = []
+            for entry in timeline:
+                shot = entry["shot"]
+                kind, source = self._source_of(shot)
+                mtime = os.path.getmtime(source) if source else None
+                signature = (kind, source, mtime, round(entry["start"], 3), round(entry["duration"], 3))
+                current = self.segments.get(shot.id)
+                if current and current["signature"] == signature:
+                    continue
+
+                # 片段名带版本号, 避免播放器缓存旧片段
+                self.version += 1
+                path = str(self.output_dir / f"shot_{shot.id}_{self.version}.ts")
+                try:
+                    self._encode(kind, source, entry["start"], entry["duration"], path)
+                except Exception as e:
+                    logger.error("❌ 预览片段生成失败 shot %s: %s", shot.id, e)
+                    continue
+                if current and os.path.exists(current["path"]):
+                    os.remove(current["path"])
+                self.segments[shot.id] = {
+                    "signature": signature, "path": path, "kind": kind,
+                    "start": entry["start"], "duration": entry["duration"],
+                }
+                updated.append(shot.id)
+
+            # 删除已经不在时间轴上的分镜片段
+            alive = {entry["shot"].id for entry in timeline}
+            for shot_id in [sid for sid in self.segments if sid not in alive]:
+                stale = self.segments.pop(shot_id)
+                if os.path.exists(stale["path"]):
+                    os.remove(stale["path"])
+
+            ordered = [self.segments[e["shot"].id] for e in timeline if e["shot"].id in self.segments]
+            if updated or not self.playlist_path.exists():
+                self._write_playlist(ordered)
+            return {
+                "updated": updated,
+                "ready": sum(1 for s in ordered if s["kind"] == "video"),
+                "total": len(timeline),
+            }
+
+    def export(self) -> Optional[str]:
+        """把当前所有片段流复制拼接为一个 mp4（供不支持 HLS 的播放器使用）"""
+        with self._lock:
+            if not self.segments:
+                return None
+            if self._export_version == self.version and self._export_path and os.path.exists(self._export_path):
+                return self._export_path
+            ordered = sorted(self.segments.values(), key=lambda s: s["start"])
+            path = str(self.output_dir / f"preview_{self.version}.mp4")
+            extra_args = ["-c", "copy", "-movflags", "+faststart"]
+            if self.audio_path:
+                extra_args = ["-c:v", "copy", "-c:a", "copy", "-bsf:a", "aac_adtstoasc", "-movflags", "+faststart"]
+            concat_copy([s["path"] for s in ordered], path, extra_args=extra_args)
+            if self._export_path and self._export_path != path and os.path.exists(self._export_path):
+                os.remove(self._export_path)
+            self._export_path, self._export_version = path, self.version
+            return path
+
+    def request_refresh(self) -> None:
+        """通知后台线程刷新（多次通知会合并为一次）"""
+        self._wakeup.set()
+
+    def _run(self, interval: float) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(timeout=interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("❌ 预览刷新失败: %s", e)
+
+    def start(self, interval: float = 30.0) -> None:
+        """启动后台刷新线程，每 interval 秒或收到通知时刷新一次"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+        self.request_refresh()
+
+    def stop(self) -> None:
+        """停止后台刷新线程"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,216 @@
+"""
+一个进程同时渲染多支 MV
+
+每个项目是一个 ShotsManager（一份 shots.json 加它的输出目录），由各自的 BatchRunner 执行流水线，
+但所有项目的首帧/视频/对口型任务都交给同一个 FairScheduler: 服务商并发上限是全部项目合计的，
+各项目按权重公平分享（见 fair_scheduler）。项目之间的进度输出、日志、花费上限和汇总互不混淆。
+
+项目清单是一个 JSON 数组，每项:
+    {"script": "a/shots.json", "output_dir": "output_a", "name": "a", "weight": 2,
+     "audio": "a/song.mp3", "reference": null, "spend_limit": 100, "dedup": true}
+只有 script 必填；name 默认取脚本所在目录名（脚本直接在当前目录时取文件名），output_dir 默认 output_<name>。
+"""
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import logs
+from cli import BatchRunner
+from fair_scheduler import FairScheduler
+from shots_manager import ShotsManager
+
+logger = logs.get_logger("projects")
+
+# 运行期间输出各项目吞吐统计的默认间隔(秒)
+STATS_INTERVAL = 30.0
+
+
+def _project_name(script: str) -> str:
+    path = Path(script)
+    return path.parent.name or path.stem
+
+
+def load_projects(path: str) -> List[Dict[str, Any]]:
+    """读取项目清单，补全默认的项目名和输出目录
+
+    Raises:
+        ValueError: 清单格式错误、缺少 script 或项目名重复
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("项目清单应为非空的 JSON 数组")
+    projects, names = [], set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("script"):
+            raise ValueError(f"第 {i + 1} 个项目缺少 script")
+        script = Path(entry["script"])
+        name = entry.get("name") or _project_name(entry["script"])
+        if name in names:
+            raise ValueError(f"项目名重复: {name}（用 name 字段区分）")
+        names.add(name)
+        projects.append({
+            "name": name,
+            "script": str(script),
+            "output_dir": entry.get("output_dir") or f"output_{name}",
+            "weight": float(entry.get("weight", 1.0)),
+            "audio": entry.get("audio"),
+            "reference": entry.get("reference"),
+            "spend_limit": entry.get("spend_limit"),
+            "dedup": entry.get("dedup", True),
+        })
+    return projects
+
+
+class ProjectService:
+    """把多个项目的流水线放到一组共享的服务商并发上限下执行"""
+
+    def __init__(self,
+                 workers: Optional[Dict[str, int]] = None,
+                 stages: Optional[List[str]] = None,
+                 json_progress: bool = False,
+                 timeouts: Optional[Dict[str, Optional[float]]] = None,
+                 stream=sys.stderr):
+        """
+        Args:
+            workers: 各服务商的并发上限（所有项目合计），默认 BatchRunner.DEFAULT_WORKERS
+            stages: 每个项目执行的阶段，默认全部
+            json_progress: 进度是否以 JSON 行输出（每条带 project 字段）
+            timeouts: 各阶段的时限(秒)，覆盖各项目 manager.stage_timeouts
+            stream: 进度和统计的输出流
+        """
+        self.scheduler = FairScheduler({**BatchRunner.DEFAULT_WORKERS, **(workers or {})})
+        self.stages = stages
+        self.json_progress = json_progress
+        self.timeouts = timeouts
+        self.stream = stream
+        self.runners: Dict[str, BatchRunner] = {}
+        self._lock = threading.Lock()
+
+    def add(self, script: str, output_dir: Optional[str] = None, name: Optional[str] = None,
+            weight: float = 1.0, audio: Optional[str] = None, reference: Optional[str] = None,
+            spend_limit: Optional[float] = None, dedup: bool = True,
+            manager: Optional[ShotsManager] = None) -> BatchRunner:
+        """加入一个项目
+
+        Args:
+            script: shots.json 路径
+            output_dir: 输出目录，默认 output_<name>
+            name: 项目名，默认取脚本所在目录名
+            weight: 公平调度的权重
+            audio: 整首歌音频
+            reference: 已有的角色参考图
+            spend_limit: 该项目的花费上限（元）
+            dedup: 是否复用重复分镜的素材
+            manager: 已配置好的 ShotsManager（例如设置了回调或关闭了某些簇的复用），提供后忽略 script/output_dir
+
+        Returns:
+            该项目的 BatchRunner
+        """
+        name = name or _project_name(script)
+        if name in self.runners:
+            raise ValueError(f"项目名重复: {name}")
+        self.scheduler.register(name, weight)
+        manager = manager or ShotsManager(script, output_dir or f"output_{name}")
+        runner = BatchRunner(
+            manager,
+            stages=self.stages,
+            audio_path=audio,
+            reference_path=reference,
+            json_progress=self.json_progress,
+            dedup=dedup,
+            timeouts=self.timeouts,
+            spend_limit=spend_limit,
+            executors=self.scheduler.executors(name),
+            name=name,
+            stream=self.stream,
+        )
+        self.runners[name] = runner
+        return runner
+
+    def cancel(self, reason: str = "已取消") -> None:
+        """取消所有项目"""
+        for runner in self.runners.values():
+            runner.cancel(reason)
+
+    def stats(self) -> Dict[str, Any]:
+        """各项目的吞吐统计（见 FairScheduler.stats），另附各项目的花费"""
+        stats = self.scheduler.stats()
+        for name, runner in self.runners.items():
+            if name in stats:
+                stats[name]["spent"] = round(runner.budget.spent, 2)
+        return stats
+
+    def _emit_stats(self) -> None:
+        for name, row in self.stats().items():
+            fields = {
+                "project": name,
+                "done": row["done"],
+                "failed": row["failed"],
+                "per_min": row["throughput_per_min"],
+                "queued": sum(p["queued"] for p in row["providers"].values()),
+                "running": sum(p["running"] for p in row["providers"].values()),
+                "spent": row.get("spent", 0.0),
+            }
+            with self._lock:
+                if self.json_progress:
+                    line = json.dumps({"event": "project.stats", "time": round(time.time(), 3), **fields},
+                                      ensure_ascii=False)
+                else:
+                    detail = " ".join(f"{k}={v}" for k, v in fields.items())
+                    line = f"[{time.strftime('%H:%M:%S')}] project.stats {detail}"
+                print(line, file=self.stream, flush=True)
+
+    def run(self, stats_interval: float = STATS_INTERVAL) -> Dict[str, Any]:
+        """同时执行所有项目，全部结束后返回 {"wall_time", "projects": {名称: 汇总}, "stats": 吞吐统计}
+
+        Args:
+            stats_interval: 每隔多少秒输出一次各项目的吞吐统计，0 表示不输出
+        """
+        started = time.perf_counter()
+        summaries: Dict[str, Dict[str, Any]] = {}
+
+        def run_project(name: str, runner: BatchRunner) -> None:
+            try:
+                summaries[name] = runner.run()
+            except Exception as e:
+                logger.exception("❌ 项目 %s 执行失败", name)
+                summaries[name] = {"project": name, "error": str(e)}
+
+        self.scheduler.start()
+        threads = [
+            threading.Thread(target=run_project, args=(name, runner), name=f"project-{name}", daemon=True)
+            for name, runner in self.runners.items()
+        ]
+        for thread in threads:
+            thread.start()
+        logger.info("🎬 同时执行 %d 个项目, 服务商并发上限 %s", len(threads), self.scheduler.capacity)
+        try:
+            self._wait(threads, stats_interval)
+        except KeyboardInterrupt:
+            # 各项目取消执行中的阶段后照常输出汇总
+            self.cancel("用户中断")
+            self._wait(threads, 0)
+        finally:
+            self.scheduler.stop()
+        if stats_interval:
+            self._emit_stats()
+        return {
+            "wall_time": round(time.perf_counter() - started, 3),
+            "workers": self.scheduler.capacity,
+            "projects": {name: summaries.get(name) for name in self.runners},
+            "stats": self.stats(),
+        }
+
+    def _wait(self, threads: List[threading.Thread], stats_interval: float) -> None:
+        next_stats = time.monotonic() + stats_interval if stats_interval else None
+        for thread in threads:
+            while thread.is_alive():
+                # 主线程只在短超时里等待, 才能收到 Ctrl-C
+                thread.join(timeout=0.5)
+                if next_stats is not None and time.monotonic() >= next_stats:
+                    self._emit_stats()
+                    next_stats = time.monotonic() + stats_interval
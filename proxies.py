@@ -0,0 +1,140 @@
+"""
+界面预览用的低分辨率代理文件
+
+2K 首帧和原始码率视频直接交给浏览器会让页面非常慢。每当素材落盘时，
+在后台进程池中为它生成一份小的 JPEG 缩略图或低码率 MP4，界面默认展示代理，
+需要时再加载原始文件。界面从不等待代理: 还没生成时先展示原始文件，代理就绪后由定时器换上。
+代理按源文件内容（素材存储中的 blob 以哈希命名）缓存在 <输出目录>/proxies/ 下。
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+import logs
+from media import run_ffmpeg
+
+logger = logs.get_logger("proxies")
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+VIDEO_SUFFIXES = {".mp4", ".mov", ".mkv", ".webm"}
+
+
+def render_proxy(source: str, output: str, kind: str) -> str:
+    """（在子进程中执行）生成一个代理文件，先写临时文件再原子替换"""
+    tmp = f"{output}.{os.getpid()}.tmp{Path(output).suffix}"
+    if kind == "image":
+        run_ffmpeg(["-i", source, "-vf", f"scale='min({ProxyGenerator.THUMB_WIDTH},iw)':-2",
+                    "-frames:v", "1", "-q:v", "5", tmp])
+    else:
+        run_ffmpeg(["-i", source, "-vf", f"scale=-2:'min({ProxyGenerator.VIDEO_HEIGHT},ih)'",
+                    "-c:v", "libx264", "-preset", "veryfast", "-crf", "32", "-pix_fmt", "yuv420p",
+                    "-c:a", "aac", "-b:a", "64k", "-movflags", "+faststart", tmp])
+    os.replace(tmp, output)
+    return output
+
+
+class ProxyGenerator:
+    """在后台进程池中生成并缓存代理文件"""
+    PROXY_DIR = "proxies"
+    # 缩略图宽度、预览视频高度（像素）
+    THUMB_WIDTH = 480
+    VIDEO_HEIGHT = 360
+
+    def __init__(self, root: str, max_workers: int = 2):
+        """
+        Args:
+            root: 输出目录，代理保存在 <root>/proxies/
+            max_workers: 进程池大小
+        """
+        self.proxy_dir = Path(root).resolve() / self.PROXY_DIR
+        self.max_workers = max_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # 代理路径 -> 正在生成的任务
+        self._inflight: Dict[str, Future] = {}
+        # 生成失败过的代理路径，不再重复提交
+        self._failed: Set[str] = set()
+
+    @staticmethod
+    def kind_of(source: str) -> Optional[str]:
+        suffix = Path(source).suffix.lower()
+        if suffix in IMAGE_SUFFIXES:
+            return "image"
+        if suffix in VIDEO_SUFFIXES:
+            return "video"
+        return None
+
+    def proxy_path(self, source: str) -> Path:
+        """源文件对应的代理路径（素材存储中的 blob 直接用其哈希，其余文件用路径+大小+修改时间）"""
+        path = Path(source)
+        stem = path.stem
+        if len(stem) != 64:
+            stat = path.stat()
+            stem = hashlib.sha1(f"{path.resolve()}|{stat.st_size}|{stat.st_mtime}".encode()).hexdigest()
+        suffix = ".jpg" if self.kind_of(source) == "image" else ".mp4"
+        return self.proxy_dir / f"{stem}_proxy{suffix}"
+
+    def submit(self, source: Optional[str]) -> Optional[Future]:
+        """为源文件提交代理生成任务；代理已存在或类型不支持时返回 None"""
+        if not source or not os.path.exists(source) or not self.kind_of(source):
+            return None
+        output = self.proxy_path(source)
+        if output.exists() or str(output) in self._failed:
+            return None
+        with self._lock:
+            future = self._inflight.get(str(output))
+            if future:
+                return future
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            self.proxy_dir.mkdir(parents=True, exist_ok=True)
+            future = self._pool.submit(render_proxy, str(source), str(output), self.kind_of(source))
+            self._inflight[str(output)] = future
+        future.add_done_callback(lambda f, key=str(output): self._done(key, f))
+        return future
+
+    def _done(self, key: str, future: Future) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.exception():
+                self._failed.add(key)
+        if future.exception():
+            logger.warning("⚠️ 代理生成失败 %s: %s", key, future.exception())
+
+    def warm(self, sources: Iterable[Optional[str]]) -> None:
+        """为一批已有素材提交代理生成（不等待）"""
+        for source in sources:
+            try:
+                self.submit(source)
+            except Exception as e:
+                logger.warning("⚠️ 代理生成提交失败 %s: %s", source, e)
+
+    def get(self, source: Optional[str], wait: float = 0) -> Optional[str]:
+        """返回源文件的代理路径；还没生成时提交任务并最多等待 wait 秒，仍未完成返回 None"""
+        if not source or not os.path.exists(source) or not self.kind_of(source):
+            return None
+        output = self.proxy_path(source)
+        if output.exists():
+            return str(output)
+        future = self.submit(source)
+        if future is not None and wait > 0:
+            try:
+                future.result(timeout=wait)
+            except Exception:
+                # 超时或生成失败都先展示原始文件
+                return None
+        return str(output) if output.exists() else None
+
+    def display(self, source: Optional[str], wait: float = 0) -> Optional[str]:
+        """界面展示用的路径：优先代理，代理还没生成时提交任务并立即退回原始文件（界面在代理就绪后再换上）"""
+        return self.get(source, wait=wait) or source
+
+    def shutdown(self) -> None:
+        """关闭进程池"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
@@ -1,10 +1,71 @@
 import os
-import datetime
+import math
+import contextvars
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict, Any
-from SeedreamImageGenerator import SeedreamImageGenerator
-from HailuoVideoGenerator import HailuoVideoGenerator
-from comfyui import ComfyUIClient
+from typing import Optional, Dict, Any, List, Union, TYPE_CHECKING
+from artifact_store import ArtifactStore
+from deadline import Cancelled, Deadline, for_stage
+from media import concat_copy, extract_frame
+import budget
+import logs
+from tracing import span, traced
+
+logger = logs.get_logger("shot")
+
+if TYPE_CHECKING:
+    # 仅用于类型标注, 运行时由 ShotsManager 在首次使用时才导入客户端及其 SDK
+    from SeedreamImageGenerator import SeedreamImageGenerator
+    from HailuoVideoGenerator import HailuoVideoGenerator
+    from comfyui import ComfyUIClient
+    from song_preprocess import SongPreprocessor
+    from hedging import HedgePolicy
+
+
+def parse_timecode(value: Union[str, int, float]) -> float:
+    """把 "1:05" / "0:01:05.5" / "65" / 65 形式的时间转换为秒数"""
+    if isinstance(value, bool):
+        raise ValueError(f"无法解析时间: {value!r}")
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = str(value).strip().split(":")
+        if not 1 <= len(parts) <= 3:
+            raise ValueError(f"无法解析时间: {value!r}")
+        try:
+            numbers = [float(p) for p in parts]
+        except ValueError:
+            raise ValueError(f"无法解析时间: {value!r}") from None
+        seconds = 0.0
+        for number in numbers:
+            seconds = seconds * 60 + number
+    if seconds < 0:
+        raise ValueError(f"时间不能为负: {value!r}")
+    return seconds
+
+
+def format_timecode(value: Union[str, int, float]) -> str:
+    """把秒数格式化为 ComfyUI AudioCrop 使用的 "M:SS(.ss)" 形式，字符串原样返回"""
+    if isinstance(value, str):
+        return value
+    minutes, seconds = divmod(float(value), 60)
+    text = f"{int(minutes)}:{seconds:05.2f}"
+    return text[:-3] if text.endswith(".00") else text
+
+
+def timeline_order(shots: List[Any]) -> List[Any]:
+    """按在歌曲中的位置排列分镜: 有 startTime 的按 startTime，没有的紧跟在脚本中它前面的分镜之后
+
+    分镜 id 不代表时间顺序（脚本里常有后来插入的分镜，例如 id 35 位于 0:05）。
+    """
+    keys, last = [], float("-inf")
+    for shot in shots:
+        start = None if shot.start_time in (None, "") else parse_timecode(shot.start_time)
+        last = last if start is None else start
+        keys.append(last)
+    # 稳定排序: startTime 相同或缺失时保持脚本顺序
+    return [shot for _, shot in sorted(zip(keys, shots), key=lambda pair: pair[0])]
 
 
 class Shot:
@@ -12,15 +73,20 @@ class Shot:
     DEFAULT_DURATION = 6
     SHORT_DURATION = 6
     LONG_DURATION = 10
+    # 计费(元): 每张首帧图像, 以及不同时长的视频
+    IMAGE_COST = 0.2
+    VIDEO_COST = {SHORT_DURATION: 2, LONG_DURATION: 4}
     # 默认的保存路径
     DEFAULT_OUTPUT_DIR = "outputs"
     
     def __init__(self, 
-                 hailuo_client:HailuoVideoGenerator, 
-                 seedream_client:SeedreamImageGenerator, 
-                 comfyui_client:ComfyUIClient,
+                 hailuo_client: "HailuoVideoGenerator", 
+                 seedream_client: "SeedreamImageGenerator", 
+                 comfyui_client: "ComfyUIClient",
                  shot_config: dict, 
-                 output_dir: str = DEFAULT_OUTPUT_DIR
+                 output_dir: str = DEFAULT_OUTPUT_DIR,
+                 song_preprocessor: Optional["SongPreprocessor"] = None,
+                 store: Optional[ArtifactStore] = None
                 ):
         """初始化分镜实例
         
@@ -29,6 +95,8 @@ class Shot:
             seedream_client: Seedream图像生成客户端
             shot_config: 分镜配置字典
             output_dir: 输出目录路径
+            song_preprocessor: 整首歌预处理（人声分离缓存），为 None 时每次对口型单独分离人声
+            store: 素材存储，为 None 时在 output_dir 下单独创建
         """
         # 基础属性初始化
         self.id = shot_config["id"]
@@ -40,66 +108,114 @@ class Shot:
         self.character_in_scene = shot_config.get("character", False)
         self.start_time = shot_config.get("startTime", "")
         self.end_time = shot_config.get("endTime", "")
+        # 超长镜头拆分后的片段是否需要画面连续（连续则逐段生成，否则并行生成）
+        self.continuous = shot_config.get("continuous", True)
+        # 与其他分镜重复时是否允许复用代表分镜的素材（False 则总是单独生成）
+        self.reuse = shot_config.get("reuse", True)
 
-        # 输出目录管理
+        # 输出目录管理（首次写文件时才创建）
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.store = store or ArtifactStore(output_dir)
 
         # API 客户端
         self.seedream = seedream_client
         self.hailuo = hailuo_client
         self.comfyui = comfyui_client
+        self.song_preprocessor = song_preprocessor
 
-        # 中间结果路径
+        # 中间结果路径（从素材存储中恢复上次的当前版本）
         self.character_reference_path: Optional[str] = None
-        self.image_path: Optional[str] = None
-        self.video_path: Optional[str] = None
-        self.lip_sync_path: Optional[str] = None
-        
-    def _ensure_output_dir(self) -> None:
-        """确保输出目录存在"""
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-    
-    def _generate_timestamp(self) -> str:
-        """生成时间戳标识"""
-        return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")   
-    
-    def _construct_filename(self, prefix: str, extension: str) -> str:
-        """构造文件名"""
-        timestamp = self._generate_timestamp()
-        return f"shot_{self.id}_{prefix}_{timestamp}.{extension}"    
+        self.image_path: Optional[str] = self.store.current(self.owner, "image")
+        self.video_path: Optional[str] = self.store.current(self.owner, "video")
+        self.lip_sync_path: Optional[str] = self.store.current(self.owner, "lip_sync")
+
+    @property
+    def owner(self) -> str:
+        """本分镜在素材存储中的记录名"""
+        return f"shot_{self.id}"
+
+    def _save_artifact(self, kind: str, tmp_path: str, filename: Optional[str] = None, **meta) -> str:
+        """把生成好的临时文件存入素材存储并记为当前版本
+
+        Args:
+            kind: 素材类型 image/video/lip_sync
+            tmp_path: 客户端写好的临时文件
+            filename: 额外在输出目录下以该文件名放一个硬链接（兼容指定文件名的调用）
+            meta: 记录在版本信息中的参数（提示词、时长等）
+
+        Returns:
+            素材在存储中的路径
+        """
+        path = self.store.put(self.owner, kind, tmp_path, meta)
+        if filename:
+            self._export(path, filename)
+        return path
+
+    def _export(self, path: str, filename: str) -> None:
+        """在输出目录下以指定文件名放一份素材（优先硬链接，不额外占用空间）"""
+        target = self.output_dir / filename
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.store.temp_path(Path(filename).suffix)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, target)
+
+    @staticmethod
+    def _discard(tmp_path: str) -> None:
+        """生成失败时删除残留的临时文件"""
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def _log_failure(self, what: str, error: Exception) -> None:
+        """记录生成失败；超时和取消单独标出，与服务商报错区分开"""
+        if isinstance(error, Cancelled):
+            outcome = "超时" if error.reason == "timeout" else "已取消"
+            logger.warning("⏰ Shot %s: %s%s - %s", self.id, what, outcome, error)
+        else:
+            logger.error("❌ Shot %s: %s失败 - %s", self.id, what, error)
     
-    def generate_image(self, prompt: Optional[str] = None, filename: Optional[str] = None) -> str:
+    @traced("image")
+    def generate_image(self, prompt: Optional[str] = None, filename: Optional[str] = None,
+                       deadline: Optional[Deadline] = None) -> str:
         """生成分镜图像
         
         Args:
             prompt: 生成提示词，如为None则使用配置中的stable prompt
-            filename: 文件名，如为None则自动生成
+            filename: 额外在输出目录下保存的文件名，如为None则只保存在素材存储中
+            deadline: 截止时间/取消令牌，默认按 "image" 阶段的时限
             
         Returns:
             生成的图像文件路径
         """
+        deadline = deadline or for_stage("image")
         prompt = prompt or self.stable_prompt
-        filename = filename or self._construct_filename("image", "png")
-        save_path = str(self.output_dir / filename)
+        tmp_path = self.store.temp_path(".png")
 
         try:
-            url = self.seedream.generate_image(prompt=prompt, size="2K")
-            self.seedream.save_image_from_url(url, save_path)
+            url = self.seedream.generate_image(prompt=prompt, size="2K", deadline=deadline)
+            budget.charge(self.IMAGE_COST)
+            self.seedream.save_image_from_url(url, tmp_path, deadline=deadline)
+            save_path = self._save_artifact("image", tmp_path, filename, op="generate", prompt=prompt)
             self.image_path = save_path
-            print(f"✅ Shot {self.id}: 图像已保存 {save_path}")
+            logger.info("✅ Shot %s: 图像已保存 %s", self.id, save_path)
             return save_path
         except Exception as e:
-            print(f"❌ Shot {self.id}: 图像生成失败 - {str(e)}")
+            self._discard(tmp_path)
+            self._log_failure("图像生成", e)
             raise
     
-    def edit_image(self, base_img_path: str, prompt: Optional[str] = None, filename: Optional[str] = None) -> str:
+    @traced("first_frame")
+    def edit_image(self, base_img_path: str, prompt: Optional[str] = None, filename: Optional[str] = None,
+                   deadline: Optional[Deadline] = None) -> str:
         """基于现有图像编辑生成新图像
         
         Args:
             base_img_path: 基础图像路径
             prompt: 编辑提示词
             filename: 文件名
+            deadline: 截止时间/取消令牌，默认按 "first_frame" 阶段的时限
             
         Returns:
             编辑后的图像路径
@@ -107,18 +223,22 @@ class Shot:
         if not base_img_path or not os.path.exists(base_img_path):
             raise ValueError(f"基础图像路径无效: {base_img_path}")
             
+        deadline = deadline or for_stage("first_frame")
         prompt = prompt or self.stable_prompt
-        filename = filename or self._construct_filename("edited_image", "png")
-        save_path = str(self.output_dir / filename)
+        tmp_path = self.store.temp_path(".png")
 
         try:
-            url = self.seedream.edit_image(base_image_path=base_img_path, prompt=prompt)
-            self.seedream.save_image_from_url(url, save_path)
+            url = self.seedream.edit_image(base_image_path=base_img_path, prompt=prompt, deadline=deadline)
+            budget.charge(self.IMAGE_COST)
+            self.seedream.save_image_from_url(url, tmp_path, deadline=deadline)
+            save_path = self._save_artifact("image", tmp_path, filename, op="edit", prompt=prompt,
+                                            base_image=os.path.basename(str(base_img_path)))
             self.image_path = save_path
-            print(f"✅ Shot {self.id}: 图像编辑完成 {save_path}")
+            logger.info("✅ Shot %s: 图像编辑完成 %s", self.id, save_path)
             return save_path
         except Exception as e:
-            print(f"❌ Shot {self.id}: 图像编辑失败 - {str(e)}")
+            self._discard(tmp_path)
+            self._log_failure("图像编辑", e)
             raise
 
     def _determine_video_duration(self, duration: Optional[int] = None) -> int:
@@ -129,73 +249,210 @@ class Shot:
         else:
             return self.LONG_DURATION
 
+    def estimate_video_cost(self, duration: Optional[int] = None) -> float:
+        """估算生成本分镜视频的费用（长镜头按拆分后的片段累计）"""
+        return sum(self.VIDEO_COST[clip] for clip in self._plan_segments(duration))
+
+    def _plan_segments(self, duration: Optional[int] = None) -> List[int]:
+        """把镜头时长拆成服务商支持的片段时长
+
+        不超过 LONG_DURATION 时只有一个片段；更长的镜头在所有 6s/10s 组合中选择
+        总时长不短于目标、浪费最少、片段数最少的一种，例如 16s -> [10, 6]，12s -> [6, 6]。
+        """
+        duration = duration or self.duration
+        if duration <= self.LONG_DURATION:
+            return [self._determine_video_duration(duration)]
+        best = None
+        for n_long in range(math.ceil(duration / self.LONG_DURATION) + 1):
+            remaining = duration - n_long * self.LONG_DURATION
+            n_short = max(0, math.ceil(remaining / self.SHORT_DURATION))
+            plan = [self.LONG_DURATION] * n_long + [self.SHORT_DURATION] * n_short
+            key = (sum(plan), len(plan))
+            if best is None or key < best[0]:
+                best = (key, plan)
+        return best[1]
+
+    def _generate_clip(self, prompt: str, clip_duration: int, save_path: str,
+                       image_path: Optional[str], deadline: Deadline,
+                       hedge: Optional["HedgePolicy"] = None) -> str:
+        """向海螺提交一个片段并下载到 save_path，image_path 不为空时作为首帧
+
+        提供 hedge 时，任务耗时超过本批次的对冲阈值后会用同样的请求再提交一份，取先完成的一份。
+        """
+        def submit() -> str:
+            if image_path:
+                task_id = self.hailuo.invoke_image_to_video(prompt, image_path, duration=clip_duration,
+                                                            deadline=deadline)
+            else:
+                task_id = self.hailuo.invoke_text_to_video(prompt, duration=clip_duration, deadline=deadline)
+            # 任务一旦被接受就会计费（海螺没有取消接口）
+            budget.charge(self.VIDEO_COST[clip_duration])
+            return task_id
+
+        with span("shot.clip", shot=self.id, stage="video", duration=clip_duration):
+            task_id = submit()
+            if hedge is None:
+                file_id = self.hailuo.query_task_status(task_id, deadline=deadline)
+            else:
+                file_id = hedge.race(
+                    task_id, submit,
+                    lambda tid, token: self.hailuo.query_task_status(tid, deadline=token),
+                    key=clip_duration, cost=self.VIDEO_COST[clip_duration], deadline=deadline)
+            self.hailuo.fetch_video(file_id, save_path, deadline=deadline)
+        return save_path
+
+    def _generate_segments(self, prompt: str, plan: List[int], save_path: str,
+                           image_path: Optional[str], continuous: bool, deadline: Deadline,
+                           hedge: Optional["HedgePolicy"] = None) -> str:
+        """按片段计划生成长镜头并拼接为一个视频
+
+        continuous 为 True 时逐段生成，后一段以前一段的最后一帧作为首帧；
+        否则所有片段同时提交，整体耗时接近单个片段，其中一段失败时立即取消其余片段。
+        """
+        # 片段和中间帧都是临时文件, 拼接完成后删除
+        segment_paths = [self.store.temp_path(".mp4") for _ in plan]
+        frame_paths = []
+        try:
+            if continuous:
+                first_frame = image_path
+                for n, clip_duration in enumerate(plan):
+                    self._generate_clip(prompt, clip_duration, segment_paths[n], first_frame, deadline, hedge)
+                    logger.info("✅ Shot %s: 片段 %d/%d 完成", self.id, n + 1, len(plan))
+                    if n + 1 < len(plan):
+                        frame_paths.append(self.store.temp_path(".png"))
+                        first_frame = extract_frame(segment_paths[n], frame_paths[-1], at_end=True)
+            else:
+                segments = deadline.child()
+                with ThreadPoolExecutor(max_workers=len(plan)) as executor:
+                    # 每个片段带一份上下文副本, 日志字段和花费记账跟着片段走
+                    futures = [
+                        executor.submit(contextvars.copy_context().run, self._generate_clip, prompt, clip_duration,
+                                        segment_paths[n], image_path, segments, hedge)
+                        for n, clip_duration in enumerate(plan)
+                    ]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except Exception as e:
+                        # 长镜头缺一段就没有意义, 不再等其余片段
+                        segments.cancel(f"同一镜头的其他片段失败: {e}")
+                        deadline.check()
+                        raise
+            deadline.check()
+            concat_copy(segment_paths, save_path)
+        finally:
+            for path in segment_paths + frame_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        return save_path
+
+    @traced("video")
     def generate_video(self, 
                       prompt: Optional[str] = None, 
                       filename: Optional[str] = None, 
                       use_image: bool = True, 
-                      duration: Optional[int] = None) -> str:
+                      duration: Optional[int] = None,
+                      continuous: Optional[bool] = None,
+                      deadline: Optional[Deadline] = None,
+                      hedge: Optional["HedgePolicy"] = None) -> str:
         """生成分镜视频
+
+        超过 LONG_DURATION 的镜头会被拆成多个片段生成后拼接，见 _plan_segments。
         
         Args:
             prompt: 视频生成提示词
-            filename: 输出文件名
+            filename: 额外在输出目录下保存的文件名，如为None则只保存在素材存储中
             use_image: 是否使用已生成的图像作为基础
             duration: 视频时长
+            continuous: 长镜头的片段是否需要画面连续，默认取配置中的 continuous
+            deadline: 截止时间/取消令牌（覆盖所有片段），默认按 "video" 阶段的时限
+            hedge: 本批次的对冲策略，提供时长尾片段会被重新提交（见 hedging.HedgePolicy）
             
         Returns:
             生成的视频文件路径
         """
-        final_duration = self._determine_video_duration(duration)
-        filename = filename or self._construct_filename("video", "mp4")
-        save_path = str(self.output_dir / filename)
+        deadline = deadline or for_stage("video")
+        plan = self._plan_segments(duration)
+        continuous = self.continuous if continuous is None else continuous
+        tmp_path = self.store.temp_path(".mp4")
         
         try:
             if use_image and self.image_path:
                 prompt = prompt or self.dynamic_prompt
-                task_id = self.hailuo.invoke_image_to_video(prompt, self.image_path, duration=final_duration)
+                image_path = self.image_path
             else:
                 prompt = prompt or f"{self.stable_prompt}, {self.dynamic_prompt}"
-                task_id = self.hailuo.invoke_text_to_video(prompt, duration=final_duration)
+                image_path = None
 
-            file_id = self.hailuo.query_task_status(task_id)
-            self.hailuo.fetch_video(file_id, save_path)
+            if len(plan) == 1:
+                self._generate_clip(prompt, plan[0], tmp_path, image_path, deadline, hedge)
+            else:
+                logger.info("Shot %s: 时长 %ss 拆分为片段 %s (%s)", self.id, duration or self.duration, plan,
+                            "连续" if continuous else "并行")
+                self._generate_segments(prompt, plan, tmp_path, image_path, continuous, deadline, hedge)
+            save_path = self._save_artifact("video", tmp_path, filename, prompt=prompt, segments=plan,
+                                            first_frame=os.path.basename(image_path) if image_path else None)
             self.video_path = save_path
-            print(f"✅ Shot {self.id}: 视频已保存 {save_path}")
+            logger.info("✅ Shot %s: 视频已保存 %s", self.id, save_path)
             return save_path
         except Exception as e:
-            print(f"❌ Shot {self.id}: 视频生成失败 - {str(e)}")
+            self._discard(tmp_path)
+            self._log_failure("视频生成", e)
             raise
         
+    @traced("lip_sync")
     def video_lip_sync(self,
                        audio_path:str,
                        file_name: Optional[str] = None,
                        startTime: Optional[str] = None,
                        endTime: Optional[str] = None,
                        prompt: Optional[str] = None,
+                       deadline: Optional[Deadline] = None,
                        ):
-        """使用ComfyUI工作流对口型"""
+        """使用ComfyUI工作流对口型（deadline 默认按 "lip_sync" 阶段的时限，包括等待整首歌人声分离的时间）"""
         if not self.video_path:
             raise ValueError("本shot没有要对口型的视频!")
+        deadline = deadline or for_stage("lip_sync")
         input_files = {
             "video": self.video_path,
             "audio": audio_path,
         }
+        if self.song_preprocessor:
+            try:
+                input_files["vocals"] = self.song_preprocessor.get_vocals(audio_path, deadline=deadline)
+            except Exception as e:
+                # 本分镜已超时/被取消时直接放弃; 否则（预处理失败）退回到工作流内逐分镜分离人声
+                deadline.check()
+                logger.warning("⚠️ Shot %s: 整首歌人声不可用, 改为单独分离 - %s", self.id, e)
         if not startTime:
             startTime = self.start_time
         if not endTime:
             endTime = self.end_time
         params = {
             "time": {
-                "start_time": startTime,
-                "end_time": endTime
+                "start_time": format_timecode(startTime),
+                "end_time": format_timecode(endTime)
             }
         }
         if prompt:
             params["prompt"] = {"positive":prompt}
-        if not file_name:
-            file_name = self._construct_filename("lipSync", "mp4")
+        # ComfyUI 的结果先下载到唯一的临时文件, 再存入素材存储
+        tmp_path = self.store.temp_path(".mp4")
         workflow = self.comfyui.load_workflow(None)
-        saved_paths = self.comfyui.execute_workflow(workflow_json=workflow, input_files=input_files, params=params, output_dir=self.output_dir, file_name=file_name)
+        try:
+            downloaded = self.comfyui.execute_workflow(workflow_json=workflow, input_files=input_files, params=params,
+                                                       output_dir=str(self.store.tmp_dir),
+                                                       file_name=os.path.basename(tmp_path), deadline=deadline)
+        except Cancelled as e:
+            self._log_failure("对口型", e)
+            raise
+        if not downloaded:
+            raise RuntimeError(f"Shot {self.id}: 对口型没有输出文件")
+        saved_paths = [
+            self._save_artifact("lip_sync", path, file_name, prompt=prompt,
+                                start_time=params["time"]["start_time"], end_time=params["time"]["end_time"])
+            for path in dict.fromkeys(downloaded)
+        ]
         self.lip_sync_path = str(saved_paths[-1])
         return saved_paths
     
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+重复分镜检测
+
+副歌经常重复同一句歌词、几乎相同的 stable/dynamic 提示词。这里用纯本地的
+字符 shingle + MinHash/LSH 找出完全重复和近似重复的分镜并聚类，不需要任何模型：
+  1. 规范化文本（NFKC、小写、去掉标点和空白）
+  2. 取字符 3-gram 集合（中文按字即可）
+  3. MinHash 签名 + LSH 分桶找候选对，再用精确 Jaccard 相似度确认
+  4. 并查集合并为簇
+"""
+import unicodedata
+import zlib
+from typing import Any, Dict, Hashable, List, Set, Tuple
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """NFKC 规范化、转小写，并去掉标点、符号和空白"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in ("P", "S", "Z", "C"))
+
+
+def shingles(text: str, n: int = 3) -> Set[str]:
+    """字符 n-gram 集合，文本短于 n 时整体作为一个 shingle"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """MinHash 签名（multiply-shift 哈希族，numpy 向量化）"""
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+
+    def signature(self, items: Set[str]) -> np.ndarray:
+        if not items:
+            return np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        x = np.array([zlib.crc32(s.encode("utf-8")) for s in items], dtype=np.uint64)
+        # (a*x + b) mod 2^64 取高 32 位
+        hashed = (np.outer(x, self.a) + self.b) >> np.uint64(32)
+        return hashed.min(axis=0)
+
+
+def find_duplicates(items: List[Tuple[Hashable, str, Hashable]],
+                    threshold: float = 0.8,
+                    bands: int = 32) -> List[Dict[str, Any]]:
+    """找出文本相似度不低于 threshold 的重复项并聚类
+
+    Args:
+        items: [(键, 文本, 分组)]，只有分组相同的项才可能被判为重复
+        threshold: Jaccard 相似度阈值
+        bands: LSH 分桶数（签名长度需能被整除）
+
+    Returns:
+        [{"keys": [...], "similarity": 簇内合并时的最低相似度, "exact": 是否全部规范化后完全相同}]
+    """
+    hasher = MinHasher()
+    rows = hasher.num_perm // bands
+    normalized = [normalize_text(text) for _, text, _ in items]
+    sets = [shingles(text) for text in normalized]
+    signatures = [hasher.signature(s) for s in sets]
+
+    # LSH: 任意一个分段签名完全相同即为候选对
+    candidates: Set[Tuple[int, int]] = set()
+    for band in range(bands):
+        buckets: Dict[Tuple[Hashable, bytes], List[int]] = {}
+        for i, sig in enumerate(signatures):
+            if not normalized[i]:
+                continue
+            key = (items[i][2], sig[band * rows:(band + 1) * rows].tobytes())
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    candidates.add((members[x], members[y]))
+
+    parent = list(range(len(items)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    pair_similarity: Dict[Tuple[int, int], float] = {}
+    for i, j in sorted(candidates):
+        similarity = jaccard(sets[i], sets[j])
+        if similarity >= threshold:
+            pair_similarity[(i, j)] = similarity
+            parent[find(i)] = find(j)
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(len(items)):
+        groups.setdefault(find(i), []).append(i)
+
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        member_set = set(members)
+        sims = [s for (i, j), s in pair_similarity.items() if i in member_set and j in member_set]
+        clusters.append({
+            "keys": [items[i][0] for i in members],
+            "similarity": round(min(sims), 3),
+            "exact": len({normalized[i] for i in members}) == 1,
+        })
+    return clusters
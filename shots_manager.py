@@ -1,42 +1,102 @@
 import json
 import os
 from pathlib import Path
-from shot import Shot
+from typing import Any, Dict, List, Optional, Tuple
+from shot import Shot, parse_timecode
 from character import CharacterReference
-from SeedreamImageGenerator import SeedreamImageGenerator
-from HailuoVideoGenerator import HailuoVideoGenerator
-from comfyui import ComfyUIClient
+from lazy_client import LazyClient
+from song_preprocess import SongPreprocessor
+from artifact_store import ArtifactStore
+from deadline import STAGE_TIMEOUTS, Deadline
+from tracing import span
+import budget
+import logs
 from dotenv import load_dotenv
 
 
 class ShotsManager:
+    COMFYUI_SERVER = "localhost:8190"
+    # 提示词 shingle 的 Jaccard 相似度达到该值即视为重复分镜
+    DUPLICATE_THRESHOLD = 0.8
+
     def __init__(self, json_path: str, output_dir: str = "output_final"):
-        """管理一场 MV 的所有 Shot"""
+        """管理一场 MV 的所有 Shot
+
+        API 客户端（及其 SDK）在第一次真正调用时才会创建，输出目录也在第一次写文件时才创建，
+        因此只读取/校验脚本时不会有额外开销。
+        """
         self.json_path = Path(json_path)
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
         self.reference_pic_dir = None
+        self._preview = None
+        self._gc = None
+        self._proxies = None
+        self._jobs = None
+        # 关闭了素材复用的重复簇 id（重新加载脚本后仍然保留）
+        self._reuse_disabled = set()
         # 加载环境变量
         load_dotenv()
         self.hailuo_api_key = os.getenv("MINIMAX_API_KEY") 
         self.seedream_api_key = os.getenv("ARK_API_KEY")
+        # 海螺回调: 接收端监听端口和服务商访问它的地址, 不设置端口时只轮询
+        port = os.getenv("HAILUO_CALLBACK_PORT")
+        self.hailuo_callback_port: Optional[int] = int(port) if port else None
+        self.hailuo_callback_url: Optional[str] = os.getenv("HAILUO_CALLBACK_URL")
+        # 各阶段的时限(秒), 批量执行和后台任务服务按它创建每个阶段的 Deadline
+        self.stage_timeouts: Dict[str, Optional[float]] = dict(STAGE_TIMEOUTS)
+        # 后台任务服务每次会话的花费上限(元), None 为不限; 环境变量 MV_BUDGET 或 cli ui --spend-limit
+        limit = os.getenv("MV_BUDGET")
+        self.budget_limit: Optional[float] = float(limit) if limit else None
+        # 分布式执行的任务队列地址（见 broker.open_broker），设置后后台任务由工作进程执行; 环境变量 MV_BROKER 或 cli ui --broker
+        self.broker_url: Optional[str] = os.getenv("MV_BROKER") or None
         
-        # 初始化全局API客户端
-        self.seedream = SeedreamImageGenerator(
+        # 所有客户端生成的素材统一存入内容寻址存储
+        self.store = ArtifactStore(self.output_dir)
+
+        # 全局API客户端（延迟构造）
+        self.seedream = LazyClient(self._create_seedream)
+        self.hailuo = LazyClient(self._create_hailuo)
+        self.comfyui = LazyClient(self._create_comfyui)
+        # 整首歌的人声分离只做一次, 所有唱歌分镜共用
+        self.song_preprocessor = SongPreprocessor(self.comfyui, cache_dir=self.output_dir / "cache")
+        
+        # 初始化shots和Character
+        self.reload()
+
+    def _create_seedream(self):
+        from SeedreamImageGenerator import SeedreamImageGenerator
+        return SeedreamImageGenerator(
             api_key=self.seedream_api_key,
             output_dir=self.output_dir
         )
-        self.hailuo = HailuoVideoGenerator(
+
+    def _create_hailuo(self):
+        from HailuoVideoGenerator import HailuoVideoGenerator
+        callbacks = None
+        if self.hailuo_callback_port is not None:
+            from hailuo_callback import get_receiver
+            callbacks = get_receiver(self.hailuo_callback_port, public_url=self.hailuo_callback_url)
+        return HailuoVideoGenerator(
             api_key=self.hailuo_api_key,
-            output_dir=self.output_dir
+            output_dir=self.output_dir,
+            callbacks=callbacks
         )
-        self.comfyui = ComfyUIClient(
-            server_address="localhost:8190", 
-            save_dir=self.output_dir
+
+    def _create_comfyui(self):
+        from comfyui import ComfyUIClient
+        return ComfyUIClient(
+            server_address=self.COMFYUI_SERVER, 
+            save_dir=str(self.store.tmp_dir),
+            history_dir=str(self.store.history_dir)
         )
-        
-        # 初始化shots和Character
+
+    def reload(self):
+        """重新读取脚本并重建所有 Shot，复用已有的 API 客户端"""
         self.shots, self.character_description = self._load_shots()
+        # 重复分镜聚类在第一次用到时才计算
+        self.clusters: Optional[List[Dict[str, Any]]] = None
+        if self._preview is not None:
+            self._preview.shots = self.shots
         # 初始化一个字典用来存放所有提示词
         self.prompts = {}
         for i, shot in enumerate(self.shots):
@@ -44,7 +104,6 @@ class ShotsManager:
                 self.prompts[i] = {"pic":shot.stable_prompt, "vid":shot.dynamic_prompt}
             else:
                 self.prompts[i] = {"pic":None, "vid":f"{shot.stable_prompt}, {shot.dynamic_prompt}"}
-        
                 
     def _load_shots(self):
         """从 JSON 文件读取配置并实例化所有 Shot"""
@@ -53,7 +112,8 @@ class ShotsManager:
         character_description = CharacterReference(
             seedream_client=self.seedream,
             character_config=data["character_description"],
-            output_dir=self.output_dir)
+            output_dir=self.output_dir,
+            store=self.store)
         shots = []
         for shot_config in data["shots"]:
             shot = Shot(
@@ -61,11 +121,66 @@ class ShotsManager:
                 seedream_client=self.seedream,
                 comfyui_client=self.comfyui,
                 shot_config=shot_config,
-                output_dir=self.output_dir
+                output_dir=self.output_dir,
+                song_preprocessor=self.song_preprocessor,
+                store=self.store
             )
             shots.append(shot)
         return shots, character_description
 
+    @staticmethod
+    def validate_script(data: Dict[str, Any]) -> List[str]:
+        """校验脚本结构，返回发现的问题列表（为空表示通过）"""
+        problems = []
+        if not isinstance(data, dict):
+            return ["脚本顶层必须是 JSON 对象"]
+        if not isinstance(data.get("character_description"), str) or not data["character_description"].strip():
+            problems.append("缺少 character_description")
+        shots = data.get("shots")
+        if not isinstance(shots, list) or not shots:
+            problems.append("shots 必须是非空列表")
+            return problems
+
+        seen_ids = set()
+        for n, shot in enumerate(shots):
+            where = f"shots[{n}]"
+            if not isinstance(shot, dict):
+                problems.append(f"{where}: 必须是 JSON 对象")
+                continue
+            shot_id = shot.get("id")
+            if not isinstance(shot_id, int) or isinstance(shot_id, bool):
+                problems.append(f"{where}: id 必须是整数")
+            elif shot_id in seen_ids:
+                problems.append(f"{where}: id {shot_id} 重复")
+            else:
+                seen_ids.add(shot_id)
+                where = f"shot {shot_id}"
+            for key in ("lyric", "stable", "dynamic"):
+                if key in shot and not isinstance(shot[key], str):
+                    problems.append(f"{where}: {key} 必须是字符串")
+            if not shot.get("stable") and not shot.get("dynamic"):
+                problems.append(f"{where}: stable 与 dynamic 至少需要一个")
+            duration = shot.get("duration", Shot.DEFAULT_DURATION)
+            if isinstance(duration, bool) or not isinstance(duration, (int, float)) or duration <= 0:
+                problems.append(f"{where}: duration 必须是正数")
+            for key in ("sing", "character", "continuous", "reuse"):
+                if key in shot and not isinstance(shot[key], bool):
+                    problems.append(f"{where}: {key} 必须是布尔值")
+
+            times = {}
+            for key in ("startTime", "endTime"):
+                if shot.get(key) in (None, ""):
+                    continue
+                try:
+                    times[key] = parse_timecode(shot[key])
+                except ValueError as e:
+                    problems.append(f"{where}: {key} {e}")
+            if len(times) == 2 and times["endTime"] <= times["startTime"]:
+                problems.append(f"{where}: endTime 必须晚于 startTime")
+            if shot.get("sing") and len(times) != 2:
+                problems.append(f"{where}: 唱歌的分镜需要 startTime 和 endTime 用于对口型")
+        return problems
+
     def list_shots(self):
         """打印所有 shot 的基本信息"""
         print("character:", self.character_description.description)
@@ -79,18 +194,342 @@ class ShotsManager:
                 return shot
         raise ValueError(f"Shot {shot_id} not found")
     
-    def generate_reference(self):
+    def generate_reference(self, deadline: Optional[Deadline] = None):
         """根据character_description生成角色参考照"""
-        self.reference_pic_dir = self.character_description.generate_image()
+        with logs.context(stage="reference"), span("manager.reference", stage="reference"):
+            self.reference_pic_dir = self.character_description.generate_image(deadline=deadline)
+        budget.charge(Shot.IMAGE_COST)
         return self.reference_pic_dir
     
-    def generate_first_frame(self, shot_index, reference_dir: str = None, prompt: str = None):
+    def generate_first_frame(self, shot_index, reference_dir: str = None, prompt: str = None,
+                             deadline: Optional[Deadline] = None):
         """修改角色参考图以生成第一帧图像"""
         shot = self.shots[shot_index]
         if reference_dir:
-            return shot.edit_image(base_img_path=reference_dir, prompt=prompt)
+            return shot.edit_image(base_img_path=reference_dir, prompt=prompt, deadline=deadline)
         else:
-            return shot.edit_image(base_img_path=self.reference_pic_dir, prompt=prompt)
+            return shot.edit_image(base_img_path=self.reference_pic_dir, prompt=prompt, deadline=deadline)
+
+    def find_duplicate_shots(self, threshold: float = None) -> List[Dict[str, Any]]:
+        """找出提示词完全相同或近似相同的分镜（如重复的副歌）并聚类
+
+        只有 character 相同、且没有设置 "reuse": false 的分镜才会被归为一簇。
+        每簇以时长最长的分镜为代表，它的视频足够覆盖其余分镜，合成时再各自裁剪；簇 id 取代表分镜的 id。
+
+        Returns:
+            [{"id", "representative": 代表分镜下标, "members": 复用代表素材的分镜下标,
+              "shot_ids", "similarity", "exact", "enabled"}]
+        """
+        from shot_dedup import find_duplicates
+        threshold = self.DUPLICATE_THRESHOLD if threshold is None else threshold
+        items = [
+            (i, f"{shot.stable_prompt} {shot.dynamic_prompt}", shot.character_in_scene)
+            for i, shot in enumerate(self.shots) if shot.reuse
+        ]
+        clusters = []
+        for found in find_duplicates(items, threshold=threshold):
+            indices = sorted(found["keys"], key=lambda i: (-self.shots[i].duration, self.shots[i].id))
+            cluster_id = self.shots[indices[0]].id
+            clusters.append({
+                "id": cluster_id,
+                "representative": indices[0],
+                "members": sorted(indices[1:]),
+                "shot_ids": sorted(self.shots[i].id for i in indices),
+                "similarity": found["similarity"],
+                "exact": found["exact"],
+                "enabled": cluster_id not in self._reuse_disabled,
+            })
+        self.clusters = sorted(clusters, key=lambda c: c["id"])
+        return self.clusters
+
+    def set_cluster_reuse(self, cluster_id: int, enabled: bool):
+        """打开/关闭某个重复簇的素材复用，关闭后簇内分镜各自单独生成"""
+        if enabled:
+            self._reuse_disabled.discard(cluster_id)
+        else:
+            self._reuse_disabled.add(cluster_id)
+        for cluster in self.clusters or []:
+            if cluster["id"] == cluster_id:
+                cluster["enabled"] = enabled
+
+    def reuse_plan(self) -> Dict[int, int]:
+        """返回 {重复分镜下标: 代表分镜下标}，只包含启用复用的簇"""
+        if self.clusters is None:
+            self.find_duplicate_shots()
+        return {
+            member: cluster["representative"]
+            for cluster in self.clusters if cluster["enabled"]
+            for member in cluster["members"]
+        }
+
+    def audio_window(self, shot_index: int) -> Optional[Tuple[float, float]]:
+        """分镜对口型使用的音频区间（秒），没有完整起止时间时返回 None"""
+        shot = self.shots[shot_index]
+        if shot.start_time in (None, "") or shot.end_time in (None, ""):
+            return None
+        return parse_timecode(shot.start_time), parse_timecode(shot.end_time)
+
+    def reuse_from_representative(self, shot_index: int, representative_index: int) -> bool:
+        """让重复分镜直接使用代表分镜的首帧和视频
+
+        视频不需要重新生成，合成时会按各自在时间轴上的时长裁剪；
+        对口型只有在音频区间相同且代表分镜已经完成对口型时才直接复用。
+
+        Returns:
+            是否还需要为该分镜单独对口型
+        """
+        shot = self.shots[shot_index]
+        source = self.shots[representative_index]
+        meta = {"reused_from": source.id}
+        for kind in ("image", "video"):
+            path = getattr(source, f"{kind}_path")
+            if self.store.contains(path):
+                # 同一个 blob 记入重复分镜的版本, 不复制文件
+                self.store.reference(shot.owner, kind, path, meta)
+            setattr(shot, f"{kind}_path", path)
+        if not shot.sing:
+            return False
+        window = self.audio_window(shot_index)
+        if source.lip_sync_path and window is not None and window == self.audio_window(representative_index):
+            if self.store.contains(source.lip_sync_path):
+                self.store.reference(shot.owner, "lip_sync", source.lip_sync_path, meta)
+            shot.lip_sync_path = source.lip_sync_path
+            return False
+        # 视频换成了代表分镜的, 之前的对口型结果已经失效
+        shot.lip_sync_path = None
+        return True
+
+    def estimate_batch_cost(self, reuse: bool = True) -> Dict[str, float]:
+        """估算批量生成首帧和视频的费用
+
+        Args:
+            reuse: 是否按重复簇复用素材计算（重复分镜不再单独计费）
+
+        Returns:
+            {"first_frame", "video", "saved": 因复用省下的费用}
+        """
+        skipped = set(self.reuse_plan()) if reuse else set()
+        cost = {"first_frame": 0.0, "video": 0.0, "saved": 0.0}
+        for i, shot in enumerate(self.shots):
+            frame = shot.IMAGE_COST if shot.character_in_scene else 0.0
+            video = shot.estimate_video_cost()
+            if i in skipped:
+                cost["saved"] += frame + video
+            else:
+                cost["first_frame"] += frame
+                cost["video"] += video
+        return {key: round(value, 2) for key, value in cost.items()}
+
+    def assemble(self, audio_path: str, output_path: str = None, allow_missing: bool = False):
+        """把所有分镜按歌曲时间轴合成为完整 MV"""
+        from assembler import MVAssembler
+        with span("manager.assemble", stage="assemble", shots=len(self.shots)):
+            return MVAssembler(self.shots, audio_path, self.output_dir).assemble(
+                output_path=output_path, allow_missing=allow_missing)
+
+    def align_to_song(self, audio_path: str, tolerance: float = None, write: bool = False):
+        """分析歌曲节奏, 把每个分镜的起止时间吸附到节拍上并写回分镜
+
+        Args:
+            audio_path: 整首歌音频
+            tolerance: 吸附容差(秒), 默认半拍
+            write: 是否同时把数值时间写回脚本 JSON
+
+        Returns:
+            {"tempo", "beats", "problems": 调整前的时间轴问题, "timing": 每个分镜的新时间（按时间顺序）}
+
+        Raises:
+            ValueError: 分镜边界不是递增的（此时不修改分镜也不写回脚本）
+        """
+        import audio_analysis
+        analysis = audio_analysis.analyze_song(audio_path, cache_dir=self.output_dir / "cache")
+        problems = audio_analysis.validate_timeline(self.shots, analysis.duration)
+        timing = audio_analysis.propose_timing(self.shots, analysis, tolerance)
+        audio_analysis.apply_timing(self.shots, timing)
+        if write:
+            self.save_timing()
+        return {
+            "tempo": round(analysis.tempo, 2),
+            "beats": len(analysis.beats),
+            "song_duration": round(analysis.duration, 3),
+            "problems": problems,
+            "timing": timing,
+        }
+
+    def save_timing(self):
+        """把分镜当前的 startTime/endTime/duration 写回脚本 JSON（其余字段保持不变）"""
+        with open(self.json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        by_id = {shot.id: shot for shot in self.shots}
+        for shot_config in data["shots"]:
+            shot = by_id.get(shot_config["id"])
+            if shot is None:
+                continue
+            shot_config["startTime"] = shot.start_time
+            shot_config["endTime"] = shot.end_time
+            shot_config["duration"] = shot.duration
+        tmp_path = self.json_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.json_path)
+
+    def _referenced_artifacts(self) -> List[str]:
+        """内存中分镜和角色参考当前正在使用的文件，垃圾回收不会删除它们"""
+        paths = [self.reference_pic_dir, self.character_description.image_path]
+        for shot in self.shots:
+            paths += [shot.image_path, shot.video_path, shot.lip_sync_path]
+        return [p for p in paths if p]
+
+    def garbage_collector(self, budget_bytes: int = None, keep_versions: int = 3):
+        """返回本项目的素材垃圾回收器，首次调用时创建
+
+        Args:
+            budget_bytes: 磁盘预算（字节），默认读取环境变量 ARTIFACT_BUDGET（如 "50G"），都没有时不按预算淘汰
+            keep_versions: 每个分镜每类素材保留的版本数
+        """
+        if self._gc is None:
+            from artifact_gc import ArtifactGC, parse_size
+            if budget_bytes is None and os.getenv("ARTIFACT_BUDGET"):
+                budget_bytes = parse_size(os.getenv("ARTIFACT_BUDGET"))
+            self._gc = ArtifactGC(
+                self.store,
+                budget_bytes=budget_bytes,
+                keep_versions=keep_versions,
+                # 只回收本项目输出目录下的文件: 当前目录里的 history_*.json、generated_videos/ 不属于任何项目
+                # （ComfyUI 的下载和任务历史已经写在素材存储的 tmp/ 和 history/ 下）
+                legacy=[
+                    # 旧版本留下的时间戳命名的输出
+                    (self.output_dir, "shot_*_*.*"),
+                    (self.output_dir, "character_reference_*.png"),
+                    # 界面代理随时可以重新生成
+                    (self.output_dir / "proxies", "*"),
+                ],
+                pinned=self._referenced_artifacts,
+            )
+        return self._gc
+
+    def proxies(self):
+        """返回界面预览用的代理生成器，首次调用时创建
+
+        创建后每当有新素材落盘就在后台生成代理，并为已有素材补齐代理。
+        """
+        if self._proxies is None:
+            from proxies import ProxyGenerator
+            self._proxies = ProxyGenerator(self.output_dir)
+            self.store.add_listener(lambda owner, kind, path: self._proxies.submit(path))
+            self._proxies.warm(self._referenced_artifacts())
+        return self._proxies
+
+    def batch_jobs(self, stage: str) -> List[Dict[str, Any]]:
+        """生成批量任务列表（以保存过的 prompt 为准）
+
+        重复分镜不单独生成, 而是在代表分镜完成后复用其素材（"reuse_" 前缀的阶段）。
+
+        Args:
+            stage: "first_frame" 或 "video"
+
+        Returns:
+            [{"shot_index", "shot_id", "stage", "params", "after": 依赖的代表分镜下标或 None,
+              "rerun": 该分镜是否已有这一阶段的素材（重新生成的价值低于从未生成过的分镜）}]
+        """
+        reuse_plan = self.reuse_plan()
+        jobs = []
+        for i, shot in enumerate(self.shots):
+            if stage == "first_frame":
+                # 只为角色出镜的分镜生成首帧
+                if not shot.character_in_scene:
+                    continue
+                params = {"reference_dir": self.reference_pic_dir, "prompt": shot.stable_prompt}
+                rerun = bool(shot.image_path)
+            else:
+                params = {"prompt": self.prompts[i]["vid"], "duration": shot.duration,
+                          "use_image": shot.character_in_scene}
+                rerun = bool(shot.video_path)
+            if i in reuse_plan:
+                leader = reuse_plan[i]
+                jobs.append({"shot_index": i, "shot_id": shot.id, "stage": f"reuse_{stage}",
+                             "params": {"from": self.shots[leader].id}, "after": leader, "rerun": rerun})
+            else:
+                jobs.append({"shot_index": i, "shot_id": shot.id, "stage": stage, "params": params, "after": None,
+                             "rerun": rerun})
+        return jobs
+
+    def job_cost(self, stage: str, shot_index: int, params: Dict[str, Any]) -> float:
+        """按费用模型估算一个任务的花费（元），复用和对口型不花钱"""
+        shot = self.shots[shot_index]
+        if stage == "first_frame":
+            return shot.IMAGE_COST
+        if stage == "video":
+            return shot.estimate_video_cost(params.get("duration"))
+        return 0.0
+
+    def run_job(self, stage: str, shot_index: int, params: Dict[str, Any],
+                deadline: Optional[Deadline] = None) -> Optional[str]:
+        """执行一个任务（由任务服务的工作线程调用），返回结果文件路径"""
+        shot = self.shots[shot_index]
+        if stage == "first_frame":
+            return self.generate_first_frame(shot_index, reference_dir=params["reference_dir"],
+                                             prompt=params["prompt"], deadline=deadline)
+        if stage == "video":
+            return shot.generate_video(prompt=params["prompt"], duration=params["duration"],
+                                       use_image=params["use_image"], deadline=deadline)
+        if stage == "lip_sync":
+            saved_paths = shot.video_lip_sync(audio_path=params["audio_path"], deadline=deadline)
+            return str(saved_paths[-1])
+        if stage.startswith("reuse_"):
+            leader = next(i for i, s in enumerate(self.shots) if s.id == params["from"])
+            source = self.shots[leader]
+            if stage == "reuse_first_frame":
+                if self.store.contains(source.image_path):
+                    self.store.reference(shot.owner, "image", source.image_path, {"reused_from": source.id})
+                shot.image_path = source.image_path
+                return shot.image_path
+            self.reuse_from_representative(shot_index, leader)
+            return shot.video_path
+        raise ValueError(f"未知的任务阶段: {stage}")
+
+    def job_runner(self):
+        """后台任务服务执行任务的函数: 设置了 broker_url 时交给工作进程（broker.RemoteRunner），否则在本进程执行"""
+        if not self.broker_url:
+            return self.run_job
+        from broker import RemoteRunner, open_broker
+        return RemoteRunner(open_broker(self.broker_url), self)
+
+    def use_broker(self, url: Optional[str]):
+        """切换任务队列（None 为在本进程执行），已创建的后台任务服务之后领取的任务即按新的方式执行"""
+        self.broker_url = url
+        if self._jobs is not None:
+            self._jobs.runner = self.job_runner()
+            self._jobs.provider_limits = self.job_provider_limits()
+
+    def job_provider_limits(self) -> Dict[str, int]:
+        """后台任务服务的服务商并发上限: 在本进程执行时 ComfyUI 等客户端是共用的，按 PROVIDER_LIMITS 限制；
+        交给工作进程时由各工作进程自己限制（见 worker.STAGE_LIMITS），这里不再限制"""
+        from job_service import PROVIDER_LIMITS
+        return {} if self.broker_url else dict(PROVIDER_LIMITS)
+
+    def jobs(self, max_workers: int = 20):
+        """返回本项目的后台任务服务（队列保存在 <输出目录>/jobs.sqlite3），首次调用时创建并启动
+
+        批量任务和界面上单个分镜的操作共用这一个工作线程池，后者走交互优先级通道。
+        付费任务按 job_cost 预留费用，超过 budget_limit 时暂停派发。每个服务商的并发数按 job_provider_limits 限制。
+        设置了 broker_url 时工作线程只负责发布和等待，生成阶段由工作进程执行（见 broker.py）。
+        """
+        if self._jobs is None:
+            from job_service import JobService
+            self._jobs = JobService(self.output_dir / "jobs.sqlite3", self.job_runner(), max_workers=max_workers,
+                                    trace_dir=self.output_dir / "traces", timeouts=self.stage_timeouts,
+                                    estimator=self.job_cost, budget_limit=self.budget_limit)
+            self._jobs.provider_limits = self.job_provider_limits()
+            self._jobs.start()
+        return self._jobs
+
+    def preview(self, audio_path: str = None):
+        """返回本项目的实时预览（HLS 分段播放列表），首次调用时创建"""
+        if self._preview is None:
+            from preview import PreviewStream
+            self._preview = PreviewStream(self.shots, self.output_dir / "preview", audio_path)
+        return self._preview
 
 if __name__ == "__main__":
     manager = ShotsManager(
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from pathlib import Path
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+import logs
+from deadline import Deadline, for_stage
+
+if TYPE_CHECKING:
+    from comfyui import ComfyUIClient
+
+logger = logs.get_logger("song")
+
+
+def song_hash(audio_path: str, chunk_size: int = 1 << 20) -> str:
+    """按文件内容计算歌曲哈希，作为预处理结果的缓存键"""
+    digest = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SongPreprocessor:
+    """
+    整首歌级别的音频预处理
+
+    对整首歌只做一次人声分离（MelBandRoFormer），结果按歌曲哈希缓存在磁盘上，
+    之后每个唱歌分镜的对口型都直接裁剪缓存的人声，不再在 GPU 上为每个分镜重复分离。
+    多个分镜同时请求同一首歌时只会触发一次分离，其余请求等待同一个结果。
+    """
+    STEM_DIR = "stems"
+
+    def __init__(self, comfyui_client: "ComfyUIClient", cache_dir: str = "cache"):
+        """
+        :param comfyui_client: 用于执行人声分离工作流的 ComfyUI 客户端
+        :param cache_dir: 缓存目录，人声保存在 <cache_dir>/stems/<歌曲哈希>_vocals.*
+        """
+        self.comfyui = comfyui_client
+        self.cache_dir = Path(cache_dir)
+        self._lock = threading.Lock()
+        # 歌曲哈希 -> 正在进行的分离任务
+        self._inflight: Dict[str, Future] = {}
+        # (路径, 大小, 修改时间) -> 哈希，避免每次都重新读取整首歌
+        self._hashes: Dict[Tuple[str, int, float], str] = {}
+
+    def _hash_of(self, audio_path: str) -> str:
+        stat = os.stat(audio_path)
+        key = (os.path.abspath(audio_path), stat.st_size, stat.st_mtime)
+        if key not in self._hashes:
+            self._hashes[key] = song_hash(audio_path)
+        return self._hashes[key]
+
+    def cached_vocals(self, audio_path: str) -> Optional[str]:
+        """返回已缓存的人声文件，没有缓存时返回 None"""
+        stem_dir = self.cache_dir / self.STEM_DIR
+        if not stem_dir.exists():
+            return None
+        prefix = f"{self._hash_of(audio_path)}_vocals"
+        for path in stem_dir.iterdir():
+            if path.stem == prefix:
+                return str(path)
+        return None
+
+    def get_vocals(self, audio_path: str, deadline: Optional[Deadline] = None) -> str:
+        """返回整首歌的人声文件，必要时先执行一次分离（阻塞直到完成）
+
+        等待别的线程进行中的分离时，到达 deadline 或被取消只放弃本次等待，不影响那次分离本身。
+        """
+        cached = self.cached_vocals(audio_path)
+        if cached:
+            return cached
+
+        key = self._hash_of(audio_path)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            deadline = deadline or Deadline()
+            while True:
+                try:
+                    return future.result(timeout=deadline.timeout_for(1.0))
+                except FutureTimeout:
+                    # 分离本身超时（DeadlineExceeded 也是 TimeoutError）时原样抛出
+                    if future.done():
+                        raise
+
+        try:
+            path = self._separate(audio_path, key, deadline or for_stage("vocals"))
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _separate(self, audio_path: str, key: str, deadline: Deadline) -> str:
+        """调用 ComfyUI 分离人声并原子地写入缓存"""
+        stem_dir = self.cache_dir / self.STEM_DIR
+        stem_dir.mkdir(parents=True, exist_ok=True)
+        logger.info("开始整首歌人声分离: %s", audio_path)
+        saved = self.comfyui.separate_vocals(audio_path, save_dir=str(stem_dir), deadline=deadline)
+        # 保留 ComfyUI 输出的扩展名, 下载完成后再改名, 缓存中不会出现半个文件
+        ext = os.path.splitext(saved)[1] or ".flac"
+        final_path = stem_dir / f"{key}_vocals{ext}"
+        os.replace(saved, final_path)
+        logger.info("✅ 人声已缓存: %s", final_path)
+        return str(final_path)
@@ -0,0 +1,126 @@
+"""
+整次运行的时间线追踪，导出为 Chrome trace（chrome://tracing 或 Perfetto 打开）
+
+调并发参数时需要看到一次 MV 生成到底是怎么跑的：哪些分镜重叠、线程在哪里空等、每个阶段等了多久。
+分镜各阶段（首帧/视频/片段/对口型）、后台任务和每次服务商调用都会记一个 span（分镜 id、阶段、尝试次数、字节数等作为属性），
+ComfyUI 的节点执行记在单独的一条时间轨道上。
+
+追踪默认常开：每个 span 只是往有上限的环形缓冲区里追加一个元组，开销在微秒级；
+每个批次结束时按时间窗口把缓冲区中的事件导出为 trace.json。设置环境变量 MV_TRACE=0 可关闭。
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+import logs
+
+
+class Tracer:
+    """记录 span 并按时间窗口导出 Chrome trace"""
+
+    def __init__(self, max_events: int = 100_000, enabled: bool = True):
+        """
+        Args:
+            max_events: 缓冲区最多保留的事件数，超出后丢弃最早的事件
+            enabled: 是否记录
+        """
+        self.enabled = enabled
+        self._events: deque = deque(maxlen=max_events)
+        # perf_counter 精度高但没有绝对起点, 换算成 time.time() 的秒数以便和外部时间对齐
+        self._offset = time.time() - time.perf_counter()
+        # 线程 id -> 线程名; 虚拟轨道名 -> 虚拟线程 id
+        self._threads: Dict[int, str] = {}
+        self._tracks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        """当前时间（秒，与 time.time() 同一时间基准）"""
+        return time.perf_counter() + self._offset
+
+    def _tid(self) -> int:
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        return tid
+
+    def _track(self, name: str) -> int:
+        with self._lock:
+            if name not in self._tracks:
+                self._tracks[name] = -(len(self._tracks) + 1)
+                self._threads[self._tracks[name]] = name
+            return self._tracks[name]
+
+    @contextmanager
+    def span(self, name: str, cat: str = "stage", **args) -> Iterator[Dict[str, Any]]:
+        """记录 with 块的 span；返回属性字典，可以在块内继续补充属性（例如下载的字节数）"""
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            end = time.perf_counter()
+            self._events.append((name, cat, start + self._offset, end - start, self._tid(), args))
+
+    def complete(self, name: str, start: float, end: float, cat: str = "stage",
+                 track: Optional[str] = None, **args) -> None:
+        """补记一个已经结束的 span（start/end 为 time.time() 秒），track 不为空时记在同名的虚拟轨道上"""
+        if not self.enabled:
+            return
+        tid = self._track(track) if track else self._tid()
+        self._events.append((name, cat, start, max(0.0, end - start), tid, args))
+
+    def export(self, path: str, since: Optional[float] = None, until: Optional[float] = None,
+               metadata: Optional[Dict[str, Any]] = None) -> int:
+        """把与 [since, until] 有重叠的事件写成 Chrome trace JSON，返回写出的事件数"""
+        events = [e for e in list(self._events)
+                  if (since is None or e[2] + e[3] >= since) and (until is None or e[2] <= until)]
+        origin = since if since is not None else min((e[2] for e in events), default=0.0)
+        pid = os.getpid()
+        trace = [
+            {"name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+             "ts": round((start - origin) * 1e6, 1), "dur": round(duration * 1e6, 1), "args": args}
+            for name, cat, start, duration, tid, args in events
+        ]
+        used = {e[4] for e in events}
+        trace += [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in list(self._threads.items()) if tid in used
+        ]
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "otherData": metadata or {}},
+                      f, ensure_ascii=False, default=str)
+        os.replace(tmp, path)
+        return len(events)
+
+
+TRACER = Tracer(enabled=os.getenv("MV_TRACE", "1") != "0")
+span = TRACER.span
+complete = TRACER.complete
+now = TRACER.now
+export = TRACER.export
+
+
+def traced(stage: str):
+    """Shot 方法的装饰器: 整个方法记一个 span，属性带上分镜 id 和阶段（同时作为日志上下文）"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            shot = getattr(self, "id", None)
+            with logs.context(shot=shot, stage=stage), TRACER.span(f"shot.{stage}", shot=shot, stage=stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
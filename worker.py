@@ -0,0 +1,246 @@
+"""
+领取队列任务的工作进程（cli worker）
+
+每个工作进程有自己的工作目录和 API 客户端（读取本机的 .env / 环境变量），按 --concurrency 开几个线程循环:
+领取任务（带租约，只领取还有空闲名额的阶段，见 STAGE_LIMITS）-> 从队列素材区下载脚本和输入文件 -> 在本地 ShotsManager 上执行 run_job -> 把结果放回素材区。
+后台线程每隔三分之一租约为执行中的任务续约；协调端取消了任务或租约已被接管时，取消本地的 Deadline 放弃执行。
+工作进程随时可以停止或崩溃: 用同一个 --worker-id 重启时先交回自己名下的任务，否则等租约过期后由其他进程接手。
+"""
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import logs
+import metrics
+from broker import KIND_ATTRS, LEASE_SECONDS, REMOTE_STAGES, RESULT_KINDS, Broker
+from budget import Budget, charging
+from deadline import Cancelled, Deadline
+from shots_manager import ShotsManager
+
+logger = logs.get_logger("worker")
+
+# 没有任务时隔多久再领取一次(秒)
+IDLE_INTERVAL = 1.0
+# 各阶段同时执行的任务数上限（没有列出的阶段只受 concurrency 限制）:
+# 一个 ComfyUI 客户端同一时刻只能跟踪一个工作流, 与 BatchRunner.DEFAULT_WORKERS["comfyui"] 一致
+STAGE_LIMITS = {"lip_sync": 1}
+
+
+class Worker:
+    """从队列领取生成阶段并在本机执行"""
+
+    def __init__(self,
+                 broker: Broker,
+                 work_dir: str = "worker_data",
+                 worker_id: Optional[str] = None,
+                 stages: Iterable[str] = REMOTE_STAGES,
+                 concurrency: int = 4,
+                 lease_seconds: float = LEASE_SECONDS,
+                 comfyui_server: Optional[str] = None,
+                 stage_limits: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            broker: 任务队列
+            work_dir: 本机工作目录（脚本、输入文件缓存和各项目的素材存储）
+            worker_id: 工作进程名，重启时沿用同一个名字可以立即交回未完成的任务，默认 <主机名>-<进程号>
+            stages: 只领取这些阶段（例如 GPU 机器只跑 lip_sync）
+            concurrency: 同时执行的任务数
+            lease_seconds: 租约时长（秒）
+            comfyui_server: 本机使用的 ComfyUI 地址，默认 ShotsManager.COMFYUI_SERVER
+            stage_limits: 覆盖 STAGE_LIMITS 的各阶段并发上限
+        """
+        unknown = [stage for stage in stages if stage not in REMOTE_STAGES]
+        if unknown:
+            raise ValueError(f"未知阶段: {', '.join(unknown)}（可选: {','.join(REMOTE_STAGES)}）")
+        self.broker = broker
+        self.work_dir = Path(work_dir)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.stages = list(stages)
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds
+        self.comfyui_server = comfyui_server
+        self.stage_limits = {**STAGE_LIMITS, **(stage_limits or {})}
+        self._lock = threading.Lock()
+        # 阶段 -> 正在领取或执行的任务数
+        self._busy: Dict[str, int] = {}
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+        # (项目, 脚本哈希) -> 本地的 ShotsManager
+        self._managers: Dict[Tuple[str, str], ShotsManager] = {}
+        # (项目, 分镜下标) -> 锁, 同一个分镜的任务不同时执行（它们共用 Shot 上的素材路径）
+        self._shot_locks: Dict[Tuple[str, int], threading.Lock] = {}
+        # 执行中的任务键 -> 本地的截止时间/取消令牌
+        self._active: Dict[str, Deadline] = {}
+        self.stats = {"done": 0, "failed": 0, "timeout": 0, "cancelled": 0, "lost": 0}
+
+    def start(self) -> "Worker":
+        """交回上次以同一名字领取、未完成的任务，然后启动工作线程和续约线程"""
+        released = self.broker.release_worker(self.worker_id)
+        if released:
+            logger.info("♻️ 交回上次未完成的 %d 个任务", released)
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._loop, name=f"worker-{n}", daemon=True) for n in range(self.concurrency)
+        ] + [threading.Thread(target=self._heartbeat, name="worker-lease", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        logger.info("🛠️ 工作进程 %s 已启动: 阶段 %s, 并发 %d", self.worker_id, ",".join(self.stages), self.concurrency)
+        return self
+
+    def stop(self, reason: str = "工作进程退出") -> None:
+        """停止领取新任务，放弃执行中的任务并把它们交回队列"""
+        self._stopped.set()
+        with self._lock:
+            active = list(self._active.values())
+        for deadline in active:
+            deadline.cancel(reason)
+        for thread in self._threads:
+            thread.join(timeout=10)
+        self.broker.release_worker(self.worker_id)
+
+    def run_forever(self) -> None:
+        """启动并一直运行到 Ctrl-C"""
+        try:
+            self.start()
+            while not self._stopped.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            logger.info("🛑 正在退出, 执行中的任务交回队列")
+        finally:
+            self.stop()
+
+    def _claim(self) -> List[str]:
+        """为每个还有空闲名额的阶段先占一个名额，返回这些阶段（领取前占位，两个线程不会同时领到同一个受限阶段）"""
+        with self._lock:
+            claimed = []
+            for stage in self.stages:
+                limit = self.stage_limits.get(stage)
+                if limit is None or self._busy.get(stage, 0) < limit:
+                    self._busy[stage] = self._busy.get(stage, 0) + 1
+                    claimed.append(stage)
+            return claimed
+
+    def _unclaim(self, stages: Iterable[str]) -> None:
+        with self._lock:
+            for stage in stages:
+                self._busy[stage] -= 1
+
+    def _loop(self) -> None:
+        while not self._stopped.is_set():
+            stages = self._claim()
+            job = None
+            try:
+                if stages:
+                    job = self.broker.lease(self.worker_id, stages, self.lease_seconds)
+            except Exception as e:
+                logger.warning("⚠️ 领取任务失败: %s", e)
+            finally:
+                # 没领到的阶段立即让出名额
+                self._unclaim([stage for stage in stages if job is None or stage != job["stage"]])
+            if job is None:
+                self._stopped.wait(IDLE_INTERVAL)
+                continue
+            try:
+                self._execute(job)
+            finally:
+                self._unclaim([job["stage"]])
+
+    def _heartbeat(self) -> None:
+        """定时续约；协调端取消了任务或租约已被接管时放弃本地执行"""
+        while not self._stopped.wait(self.lease_seconds / 3):
+            with self._lock:
+                active = dict(self._active)
+            try:
+                lost = self.broker.renew(self.worker_id, active, self.lease_seconds)
+            except Exception as e:
+                logger.warning("⚠️ 续约失败: %s", e)
+                continue
+            for key in lost:
+                active[key].cancel("协调端已取消任务或租约已被接管")
+
+    def _manager(self, project: str, script: Dict[str, str]) -> ShotsManager:
+        """项目在本机的 ShotsManager，脚本有新版本时重新加载"""
+        with self._lock:
+            manager = self._managers.get((project, script["sha256"]))
+            if manager is None:
+                project_dir = self.work_dir / project
+                path = project_dir / "scripts" / f"{script['sha256'][:16]}.json"
+                if not path.exists():
+                    self.broker.fetch_blob(script, str(path))
+                manager = ShotsManager(str(path), str(project_dir))
+                if self.comfyui_server:
+                    manager.COMFYUI_SERVER = self.comfyui_server
+                self._managers[(project, script["sha256"])] = manager
+            return manager
+
+    def _input(self, ref: Dict[str, str]) -> str:
+        """把输入文件下载到本机缓存（按内容哈希，下载过的不再下载）"""
+        path = self.work_dir / "inputs" / f"{ref['sha256']}{ref['suffix']}"
+        if not path.exists():
+            tmp = path.with_name(f".{os.getpid()}-{threading.get_ident()}{ref['suffix']}")
+            self.broker.fetch_blob(ref, str(tmp))
+            os.replace(tmp, path)
+        return str(path)
+
+    def _execute(self, job: Dict[str, Any]) -> None:
+        key, stage, payload = job["key"], job["stage"], job["payload"]
+        deadline = Deadline(payload.get("timeout"), name=stage)
+        with self._lock:
+            self._active[key] = deadline
+        spend = Budget()
+        started = time.perf_counter()
+        status, result, error = "failed", None, None
+        try:
+            manager = self._manager(payload["project"], payload["script"])
+            index = payload["shot_index"]
+            shot = manager.shots[index]
+            with self._lock:
+                shot_lock = self._shot_locks.setdefault((payload["project"], index), threading.Lock())
+            with shot_lock, logs.context(project=payload["project"], shot=shot.id, stage=stage), \
+                    charging(spend, stage, key):
+                logger.info("📦 领取任务 (第 %d 次)", job["attempt"])
+                params = dict(payload["params"])
+                inputs = {name: self._input(ref) for name, ref in payload["inputs"].items()}
+                if stage == "first_frame":
+                    params["reference_dir"] = inputs.get("reference")
+                elif stage == "video":
+                    shot.image_path = inputs.get("image")
+                elif stage == "lip_sync":
+                    shot.video_path = inputs["video"]
+                    params["audio_path"] = inputs["audio"]
+                path = manager.run_job(stage, index, params, deadline=deadline)
+                kind = RESULT_KINDS[stage]
+                versions = manager.store.load_record(shot.owner).get(kind) or [{}]
+                meta = {k: v for k, v in versions[-1].items() if k not in ("path", "sha256", "size", "created")}
+                result = {**self.broker.put_blob(path), "meta": meta}
+                setattr(shot, KIND_ATTRS[kind], path)
+            status = "done"
+        except Cancelled as e:
+            status, error = e.reason, str(e)
+        except Exception as e:
+            logger.error("❌ 任务 %s 失败: %s", key, e)
+            error = str(e)
+        finally:
+            with self._lock:
+                self._active.pop(key, None)
+        if self._stopped.is_set() and status == "cancelled":
+            # 工作进程退出时放弃的任务不报告结果, stop 把它交回队列
+            return
+        # 失败前已经提交的付费请求同样要计入协调端的花费
+        result = {**(result or {}), "spent": round(spend.spent, 4)}
+        try:
+            accepted = self.broker.complete(key, self.worker_id, status, result=result, error=error)
+        except Exception as e:
+            logger.warning("⚠️ 报告任务 %s 的结果失败, 等待租约过期后重新派发: %s", key, e)
+            accepted = False
+        with self._lock:
+            self.stats[status if accepted else "lost"] += 1
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+        metrics.JOBS_TOTAL.inc(stage=stage, status=status)
+        if not accepted:
+            logger.warning("⚠️ 任务 %s 的租约已不属于本进程, 结果被丢弃", key)
+        elif status == "cancelled" and spend.spent:
+            logger.warning("💸 已放弃的任务 %s 已花费 ¥%.2f, 协调端不再等待, 未计入其预算", key, spend.spent)